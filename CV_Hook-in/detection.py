@@ -0,0 +1,276 @@
+# File: detection.py
+
+# Contains:
+#   Class
+#	DetectionStage class - marker detection for several Senders on one thread.
+#	A full frame search runs on a downscaled image, for one camera at a time
+#	every 'search_interval' seconds (a quarter of that when a camera has
+#	nothing to track). In between every marker found is tracked by searching a small region
+#	around its last corners at full resolution. New frames of all the cameras
+#	are handled together (sender.FrameGroup) and read through the mapped
+#	views of the Senders. Detections are reported to a callback and/or a queue,
+#	nothing is drawn on the frames.
+#	Detection class - a marker: camera, id, corners (4x2, frame pixels), pts and
+#	wall-clock time of the frame, and whether it came from tracking
+#   Functions
+#	aruco() - detector for ArUco markers (cv2.aruco)
+#	qr() - detector for QR codes (cv2.QRCodeDetector)
+#	engine_process() - the stage as a processing.ProcessingEngine function, so
+#	searching and tracking run in a worker process per camera
+#	detections() - Detection objects for what a stage found in a frame
+#	A detector is any function grey image -> [(id, corners)], an ALVAR detector
+#	can be dropped in the same way
+
+
+import time
+import queue
+import threading
+import numpy as np
+import cv2
+import sender as s
+
+
+class Detection:
+	def __init__(self, camera, id, corners, pts, wallclock, tracked):
+		self.camera = camera
+		self.id = id
+		self.corners = corners
+		self.pts = pts
+		self.wallclock = wallclock
+		self.tracked = tracked
+
+
+	def __repr__(self):
+		return 'Detection(%s, %s, %s, %s)' % (self.camera, self.id,
+			self.corners.astype(int).tolist(), 'tracked' if self.tracked else 'search')
+
+
+def aruco(dictionary='DICT_4X4_50'):
+	d = cv2.aruco.getPredefinedDictionary(getattr(cv2.aruco, dictionary))
+	if hasattr(cv2.aruco, 'ArucoDetector'):
+		detector = cv2.aruco.ArucoDetector(d, cv2.aruco.DetectorParameters())
+		detect_markers = detector.detectMarkers
+	else:
+		# OpenCV < 4.7
+		params = cv2.aruco.DetectorParameters_create()
+		detect_markers = lambda grey: cv2.aruco.detectMarkers(grey, d, parameters=params)
+
+	def detect(grey):
+		corners, ids, rejected = detect_markers(grey)
+		if ids is None: return []
+		return [(int(i), c.reshape(4, 2)) for i, c in zip(ids.flatten(), corners)]
+	return detect
+
+
+def qr():
+	detector = cv2.QRCodeDetector()
+
+	def detect(grey):
+		ok, decoded, points, straight = detector.detectAndDecodeMulti(grey)
+		if not ok or points is None: return []
+		# codes that were found but not decoded have no id to track them by
+		return [(data, p.reshape(4, 2)) for data, p in zip(decoded, points) if data]
+	return detect
+
+
+def detections(camera, pts, found, wallclock=None):
+	if wallclock is None: wallclock = time.time()
+	return [Detection(camera, id, np.asarray(corners, dtype=np.float32), pts, wallclock, tracked)
+		for id, corners, tracked in found]
+
+
+_worker = None	# (DetectionStage, _Camera) of an engine worker process
+
+
+def engine_process(src, dst, detector='aruco', **options):
+	# runs in a ProcessingEngine worker (workers=None, the tracks are of the one
+	# camera the process serves), options go to DetectionStage. Returns
+	# [(id, corners as lists, tracked)], it is pickled back to the engine
+	global _worker
+	if _worker is None:
+		_worker = (DetectionStage(globals()[detector](), queue_size=None, **options), _Camera('worker'))
+	stage, cam = _worker
+	now = time.monotonic()
+	if stage.due(cam, now):
+		cam.last_search = now
+		found = stage.search(cam, src)
+	else:
+		found = stage.track(cam, src)
+	return [(id, corners.tolist(), tracked) for id, corners, tracked in found]
+
+
+class _Track:
+	def __init__(self, id, corners):
+		self.id = id
+		self.corners = corners
+		self.misses = 0
+
+
+class _Camera:
+	def __init__(self, name):
+		self.name = name
+		self.tracks = {}
+		self.last_search = 0.0
+
+
+class DetectionStage:
+	def __init__(self, detect, search_interval=1.0, search_scale=0.5, margin=0.5,
+			max_misses=3, on_detection=None, queue_size=0):
+		# detect - detector function, see aruco()/qr()
+		# search_scale - of the frame for full searches, markers smaller than
+		# about 1/search_scale of the detector's minimum size are only found at 1.0
+		# margin - of the marker size added on every side of its region
+		# max_misses - tracked frames without the marker before it is dropped
+		# on_detection(camera, [Detection]) is called from the stage thread for
+		# every processed frame, the same lists go to self.queue when queue_size
+		# is not None (0 for unbounded, the oldest is dropped when it is full)
+		self.detect = detect
+		self.search_interval = search_interval
+		self.search_scale = search_scale
+		self.margin = margin
+		self.max_misses = max_misses
+		self.on_detection = on_detection
+		self.queue = queue.Queue(queue_size) if queue_size is not None else None
+		self.cameras = {}
+		self.group = None
+		self.thread = None
+		self.running = False
+		self.searches = 0
+		self.tracked = 0
+
+
+	def add_camera(self, sender, name):
+		if self.running:
+			print('ERROR: cameras must be added before the detection stage is started')
+			return
+		self.cameras[sender] = _Camera(name)
+
+
+	def start(self):
+		self.running = True
+		self.group = s.FrameGroup(self.cameras)
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+
+	def stop(self):
+		self.running = False
+		self.thread.join()
+		self.group.close()
+
+
+	def run(self):
+		while self.running:
+			frames = self.group.wait_any(timeout=0.5)
+			if not frames:
+				if not all(sender.running for sender in self.cameras): break
+				continue
+			# at most one full search per round, given to the camera that
+			# waited longest, so the search cost isn't paid by every camera at once
+			now = time.monotonic()
+			due = [sender for sender in frames if self.due(self.cameras[sender], now)]
+			search = min(due, key=lambda sender: self.cameras[sender].last_search) if due else None
+			for sender, frame in frames.items():
+				self.handle(sender, frame, sender is search, now)
+
+
+	def process(self, sender, frame):
+		# one frame, for a scheduler.Scheduler driving the stage instead of start()
+		now = time.monotonic()
+		self.handle(sender, frame, self.due(self.cameras[sender], now), now)
+
+
+	def due(self, cam, now):
+		# a camera with nothing to track searches four times as often
+		return now - cam.last_search >= self.search_interval / (1 if cam.tracks else 4)
+
+
+	def handle(self, sender, frame, search, now):
+		cam = self.cameras[sender]
+		try:
+			with frame.view() as view:
+				if search:
+					cam.last_search = now
+					found = self.search(cam, view)
+				else:
+					found = self.track(cam, view)
+		except Exception as e:
+			print('ERROR: detection on', cam.name, ':', e)
+			return
+		self.report(cam, frame, found)
+
+
+	def grey(self, image):
+		if image.ndim == 2 or image.shape[2] == 1:
+			return image.reshape(image.shape[:2])
+		return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY if image.shape[2] == 3 else cv2.COLOR_BGRA2GRAY)
+
+
+	def search(self, cam, view):
+		self.searches += 1
+		scale = self.search_scale
+		small = cv2.resize(view, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale != 1.0 else view
+		found = [(id, corners / scale, False) for id, corners in self.detect(self.grey(small))]
+		# a search replaces the tracks, markers it missed get the usual misses
+		seen = set()
+		for id, corners, tracked in found:
+			seen.add(id)
+			cam.tracks[id] = _Track(id, corners)
+		self.age(cam, seen)
+		return found
+
+
+	def track(self, cam, view):
+		height, width = view.shape[:2]
+		found = []
+		seen = set()
+		for track in list(cam.tracks.values()):
+			x0, y0 = track.corners.min(axis=0)
+			x1, y1 = track.corners.max(axis=0)
+			mx = (x1 - x0) * self.margin
+			my = (y1 - y0) * self.margin
+			x0 = max(0, int(x0 - mx))
+			y0 = max(0, int(y0 - my))
+			x1 = min(width, int(x1 + mx) + 1)
+			y1 = min(height, int(y1 + my) + 1)
+			if x1 - x0 < 8 or y1 - y0 < 8: continue
+			# the region is a view, only its grey version is a new image
+			self.tracked += 1
+			for id, corners in self.detect(self.grey(view[y0:y1, x0:x1])):
+				if id != track.id or id in seen: continue
+				corners = corners + (x0, y0)
+				track.corners = corners
+				seen.add(id)
+				found.append((id, corners, True))
+		self.age(cam, seen)
+		return found
+
+
+	def age(self, cam, seen):
+		for id in list(cam.tracks):
+			if id in seen:
+				cam.tracks[id].misses = 0
+				continue
+			cam.tracks[id].misses += 1
+			if cam.tracks[id].misses > self.max_misses:
+				del cam.tracks[id]
+
+
+	def report(self, cam, frame, found):
+		found = detections(cam.name, frame.pts, found)
+		if self.on_detection is not None:
+			self.on_detection(cam.name, found)
+		if self.queue is not None:
+			try:
+				self.queue.put_nowait((cam.name, found))
+			except queue.Full:
+				try:
+					self.queue.get_nowait()
+				except queue.Empty:
+					pass
+				self.queue.put_nowait((cam.name, found))
+
+
+	def stats(self):
+		return {'searches': self.searches, 'tracked': self.tracked,
+			'tracks': {c.name: sorted(map(str, c.tracks)) for c in self.cameras.values()}}
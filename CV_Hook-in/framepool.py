@@ -0,0 +1,120 @@
+# File: framepool.py
+
+# Contains:
+#   Class
+#	FramePool class - a ring of preallocated numpy frames. A frame mapped out of a
+#	Gst buffer is only valid while the sample is held, so a consumer that wants
+#	to keep a frame copies it into the next slot of the ring instead of having a
+#	new array allocated for every sample.
+#	Frame class - a sample pulled from appsink with its sequence number and pts.
+#   Functions
+#	frame_layout() - height, width, channels and row stride of the frames in a caps
+#	map_sample() - context manager that maps a Gst sample read-only and yields a
+#	numpy view of its pixels. The view is only zero-copy when the Python
+#	bindings hand out MapInfo.data as a memoryview of the mapped memory. With
+#	the GStreamer 1.14 / older PyGObject of the TX2 it is a bytes copy of the
+#	buffer, so every map costs one copy; zero_copy() tells which case it is
+#	numpy is only imported once the first frame is handled, so building and
+#	starting the pipelines doesn't wait for it
+
+
+from contextlib import contextmanager
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+
+ZERO_COPY = None	# set by the first map_sample(), see zero_copy()
+
+
+def zero_copy():
+	# True if frames are read in place, False if the bindings copy every
+	# buffer on map, None before the first frame
+	return ZERO_COPY
+
+
+class FramePool:
+	def __init__(self, size=4):
+		# a slot is reused after 'size' copies, so a consumer can keep at most
+		# size-1 frames around before the oldest one is overwritten
+		self.size = size
+		self.shape = None
+		self.ring = []
+		self.index = 0
+
+
+	def reset(self, shape):
+		import numpy as np
+		self.shape = shape
+		self.ring = [np.empty(shape, dtype=np.uint8) for i in range(self.size)]
+		self.index = 0
+
+
+	def copy(self, view):
+		import numpy as np
+		# caps can change mid stream (e.g. resolution), reallocate only then
+		if view.shape != self.shape:
+			self.reset(view.shape)
+		slot = self.ring[self.index]
+		np.copyto(slot, view)
+		self.index = (self.index + 1) % self.size
+		return slot
+
+
+class Frame:
+	def __init__(self, sample, seq):
+		# holding the sample keeps the buffer (and its memory) alive
+		self.sample = sample
+		self.seq = seq
+		self.pts = sample.get_buffer().pts
+
+
+	def view(self):
+		return map_sample(self.sample)
+
+
+	def copy(self, pool):
+		with map_sample(self.sample) as view:
+			return pool.copy(view)
+
+
+def frame_layout(caps):
+	struct = caps.get_structure(0)
+	height = struct.get_value('height')
+	width = struct.get_value('width')
+	fmt = struct.get_value('format')
+	if fmt in ('BGRx', 'RGBx', 'BGRA', 'RGBA'): channels = 4
+	elif fmt == 'GRAY8': channels = 1
+	elif fmt == 'NV12':
+		# Y plane followed by the interleaved half height UV plane, seen as
+		# one single channel image the way cv2.COLOR_YUV2BGR_NV12 expects
+		return height * 3 // 2, width, 1, (width + 3) // 4 * 4
+	else: channels = 3
+	# packed formats are padded to 4 byte rows by videoconvert
+	stride = (width * channels + 3) // 4 * 4
+	return height, width, channels, stride
+
+
+@contextmanager
+def map_sample(sample):
+	global ZERO_COPY
+	import numpy as np
+	buff = sample.get_buffer()
+	height, width, channels, stride = frame_layout(sample.get_caps())
+	ok, info = buff.map(Gst.MapFlags.READ)
+	if not ok:
+		raise RuntimeError('Unable to map buffer for reading')
+	try:
+		if ZERO_COPY is None:
+			ZERO_COPY = isinstance(info.data, memoryview)
+			if not ZERO_COPY:
+				print('framepool: MapInfo.data is a %s, every frame is copied once on map'
+					% type(info.data).__name__)
+		# with a memoryview the view points straight at the buffer memory, it
+		# must not be used after the with block ends (the buffer is unmapped there)
+		view = np.ndarray((height, width, channels), dtype=np.uint8,
+				buffer=info.data, strides=(stride, channels, 1))
+		view.flags.writeable = False
+		yield view
+	finally:
+		buff.unmap(info)
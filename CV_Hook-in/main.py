@@ -1,6 +1,7 @@
 # UPDATED: 11/8/2020
 
-# TO DO: Change from QR detection to ALVAR detection
+# TO DO: Change from QR detection to ALVAR detection (a detector function for
+# detection.DetectionStage, see detection.aruco() and detection.qr())
 
 # This program starts a Gstreamer pipeline sends it camera frames to OpenCV.
 # OpenCV has the ability to process the video (currently does not) and sends the frames
@@ -8,84 +9,116 @@
 
 
 import sys
-import numpy as np
-import cv2
-#from ar_markers import detect_markers
-#from pyzbar.pyzbar import decode #for QR (and bar) code detection
+import time
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import gi
 gi.require_version('Gst', '1.0')
-gi.require_version('Gtk', '3.0')
-from gi.repository import Gst, Gtk
+from gi.repository import Gst, GLib
 import sender
+import metrics
 
 
 def main():
 	Gst.init(None)
 
-	cam_pipe = sender.get_pipeline('tx2', 'cam4')
-	cam_pipe2 = sender.get_pipeline('file', 'testvideo0')
-	cam_pipe3 = sender.get_pipeline('tx2', 'cam3')
-	cam = sender.Sender(cam_pipe)
-	cam2 = sender.Sender(cam_pipe2)
-	cam3 = sender.Sender(cam_pipe3)
-
-	out = cv2.VideoWriter(sender.get_pipeline_out('192.168.2.0', '8080'), 1, 30.0, (640,480), True)
-	out2 = cv2.VideoWriter(sender.get_pipeline_out('192.168.2.0', '8081'), 1, 30.0, (640,480), True)
-	out3 = cv2.VideoWriter(sender.get_pipeline_out('192.168.2.0', '8082'), 1, 30.0, (640,480), True)
-
-	if not out.isOpened():
-		print('videowriter for cam1 not open')
-	if not out2.isOpened():
-		print('videowriter for cam2 not open')
-	if not out3.isOpened():
-		print('videowriter for cam3 not open')
-
-	while True:
-		# Wait for the next frame
-		if not cam.frame_available():
-			continue
-		if not cam2.frame_available():
-			continue
-		if not cam3.frame_available():
-			continue
-
-		frame = cam.get_frame()
-		# color correction for receiver end
-		img = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-		frame2 = cam2.get_frame()
-		img2 = cv2.cvtColor(frame2, cv2.COLOR_RGB2BGR)
-		frame3 = cam3.get_frame()
-		img3 = cv2.cvtColor(frame3, cv2.COLOR_RGB2BGR)
-
-		# Simple Aruco detection
-		#markers = detect_markers(frame)
-		#for marker in markers:
-		#	marker.highlite_marker(frame)
-
-		# for qr_code in decode(frame):
-		#	myData = qr_code.data.decode('utf-8')
-		#	print(myData)
-		#	pts = np.array([qr_code.polygon], np.int32)
-		#	pts = pts.reshape((-1,1,2))
-		#	cv2.polylines(frame, [pts], True, (255, 0, 255), 5) #box around qr code
-			# uncomment below 2 for decoded QR string to appear above QR Code
-		#	pts2 = qr_code.rect
-		#	cv2.putText(frame, myData, (pts2[0], pts2[1]), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (255,0,255), 2)
-
-		out.write(img)
-		out2.write(img2)
-		out3.write(img3)
-		#cv2.imshow('frame', frame)
-
-		if cv2.waitKey(1) & 0xFF == ord('q'):
-			break
-
-	cam.release()
-	cam2.release()
-	cam3.release()
-	out.release()
-	out2.release()
-	out3.release()
+	# the bus watches of the Senders (errors, EOS, QOS, startup stages) are
+	# dispatched by a GLib main loop, on its own thread like in ../sender.py
+	loop = GLib.MainLoop()
+	threading.Thread(target=loop.run, daemon=True).start()
+
+	# every camera is built and set playing on its own thread (a v4l2 open
+	# blocks), OpenCV and the vision modules are imported in the meantime.
+	# Each Sender prints a STARTUP line once its first frame reaches OpenCV.
+	pool = ThreadPoolExecutor(4)
+	starting = [pool.submit(sender.Sender, sender.get_pipeline(machine, source, 'BGR'), name=name)
+		for machine, source, name in (('tx2', 'cam4', 'cam4'), ('file', 'testvideo0', 'testvideo0'),
+			('tx2', 'cam3', 'cam3'))]
+	import cv2
+	import scheduler
+	import detection
+	import processing
+
+	# the encoders of the outgoing streams start in parallel too
+	writer = lambda port: cv2.VideoWriter(sender.get_pipeline_out('192.168.2.0', port), 1, 30.0, (640,480), True)
+	out, out2, out3 = pool.map(writer, ('8080', '8081', '8082'))
+	cam, cam2, cam3 = [f.result() for f in starting]
+	pool.shutdown()
+	writers = [out, out2, out3]
+
+	# the cameras and the encoders are released whatever happens below
+	try:
+		cam.enable_metrics('cam4')
+		cam2.enable_metrics('testvideo0')
+		cam3.enable_metrics('cam3')
+		metrics.serve(9102)
+
+		if not out.isOpened():
+			print('videowriter for cam1 not open')
+		if not out2.isOpened():
+			print('videowriter for cam2 not open')
+		if not out3.isOpened():
+			print('videowriter for cam3 not open')
+
+		# the stereo matching and the marker detection run in worker processes, a
+		# process per camera (processing.ProcessingEngine), off this process and
+		# its GIL. The threads here only pick the frames and wait for the results
+		engine = processing.ProcessingEngine()
+
+		# cam3 is the side-by-side stereo camera, its disparity map goes out as a
+		# fourth stream at a few frames per second
+		stereo = cam3.enable_stereo(rate=5.0, scale=0.5)
+		stereo.attach(engine)
+		out_depth = cv2.VideoWriter(sender.get_pipeline_out('192.168.2.0', '8083', 'GRAY8'), 1, 5.0,
+			stereo.size((480, 640)), False)
+		writers.append(out_depth)
+		if not out_depth.isOpened():
+			print('videowriter for cam3 disparity not open')
+		else:
+			stereo.writer = out_depth
+
+		# markers are searched for on the side, the results come back here
+		# instead of being drawn on the outgoing frames
+		search = functools.partial(detection.engine_process, detector='aruco')
+		detectors = {c: engine.add_camera(c, None, out_shape=(1, 1, 1), process=search) for c in (cam, cam2, cam3)}
+		engine.start(listen=False)
+
+		def process(sender, frame):
+			result = engine.process_frame(detectors[sender], frame)
+			return None if result is None else result[0]
+
+		def on_result(camera, frame, found):
+			for d in detection.detections(camera, frame.pts, found):
+				print('MARKER', camera, d.id, d.corners.astype(int).tolist(), d.pts)
+
+		# the pipelines already deliver BGR, every frame goes straight out at the
+		# camera rate, detection gets the newest frame of each camera as often as
+		# 20 ms of work per frame interval allows (cam4 first). A scheduler thread
+		# per camera so the detection processes run side by side
+		sched = scheduler.Scheduler(process, budget=20.0, workers=3, on_result=on_result)
+		sched.add_camera(cam, out, 'cam4', priority=2)
+		sched.add_camera(cam2, out2, 'testvideo0')
+		sched.add_camera(cam3, out3, 'cam3')
+		sched.start()
+
+		try:
+			while all(c.running for c in (cam, cam2, cam3)):
+				time.sleep(1.0)
+		except KeyboardInterrupt:
+			pass
+
+		sched.stop()
+		stereo.close()
+		engine.stop()
+		print('scheduler:', sched.stats())
+		print('processing:', engine.stats())
+	finally:
+		for c in (cam, cam2, cam3):
+			c.release()
+		for w in writers:
+			w.release()
+		loop.quit()
 
 
 if __name__ == '__main__':
@@ -8,7 +8,6 @@
 import sys
 import gi
 gi.require_version('Gst', '1.0')
-gi.require_version('Gtk', '3.0')
 gi.require_version('GstVideo', '1.0')
 from gi.repository import Gst, GLib, GObject
 
@@ -0,0 +1,336 @@
+# File: processing.py
+
+# Contains:
+#   Class
+#	SharedFrameRing class - a fixed number of frame slots in multiprocessing
+#	shared memory with a state word per slot. Frames cross to a worker process
+#	with a single copy and nothing is pickled but (camera, seq, slot).
+#	ProcessingEngine class - runs the CV processing for every camera in worker
+#	processes (one per camera or a shared pool). Frames are written into the
+#	camera's input ring straight from the Sender appsink callback and the
+#	processed frames are handed to the camera's output VideoWriter in order.
+#	Started with listen=False it only processes the frames it is given with
+#	process_frame(), which blocks the calling thread (not the GIL) until the
+#	worker is done - scheduler.py's worker threads pick the frames this way.
+#	A worker process that dies (crash, OOM kill) is restarted, and the frames
+#	it took with it are given up on after 'stall' seconds so they don't hold
+#	up the ring and every later result of the camera.
+#   Functions
+#	worker() - worker process loop
+#	annotate() - default processing function, copies the frame to the output
+#	(the pipelines deliver the format OpenCV needs, see sender.get_pipeline())
+
+
+import time
+import queue
+import threading
+import collections
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+
+FREE = 0
+FILLED = 1
+
+
+class SharedFrameRing:
+	def __init__(self, shape, slots=4, name=None):
+		# name=None creates (and later unlinks) the block, otherwise attach to it
+		self.shape = tuple(shape)
+		self.slots = slots
+		self.owner = name is None
+		header = 8 * slots
+		size = header + int(np.prod(self.shape)) * slots
+		self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+		self.state = np.ndarray((slots,), dtype=np.int64, buffer=self.shm.buf)
+		self.frames = np.ndarray((slots,) + self.shape, dtype=np.uint8,
+				buffer=self.shm.buf, offset=header)
+		if self.owner:
+			self.state[:] = FREE
+		self.next = 0
+
+
+	@property
+	def name(self):
+		return self.shm.name
+
+
+	def acquire(self):
+		# next free slot, None if the consumer has fallen behind
+		for i in range(self.slots):
+			slot = (self.next + i) % self.slots
+			if self.state[slot] == FREE:
+				self.next = (slot + 1) % self.slots
+				return slot
+		return None
+
+
+	def close(self):
+		# the numpy views export the buffer, drop them before closing
+		self.state = None
+		self.frames = None
+		self.shm.close()
+		if self.owner:
+			self.shm.unlink()
+
+
+class _Camera:
+	def __init__(self, sender, writer, shape, out_shape, slots, process):
+		self.sender = sender
+		self.writer = writer
+		self.process = process
+		self.ring_in = SharedFrameRing(shape, slots)
+		self.ring_out = SharedFrameRing(out_shape, slots)
+		self.pending = collections.deque()
+		self.submitted = {}	# seq -> (slot, monotonic time) until the result is released
+		self.done = {}
+		self.last_seq = 0
+		self.dropped = 0
+		self.processed = 0
+		self.lost = 0
+		self.tasks = None
+		self.listener = None
+
+
+class ProcessingEngine:
+	def __init__(self, process=None, workers=None, slots=4, on_result=None, stall=2.0):
+		# process(src, dst) runs in the workers, it must be a module level function.
+		# workers=None starts a worker per camera, an int starts a shared pool.
+		# on_result(cam, seq, info) gets whatever process() returned, in order.
+		# stall - seconds after which a frame submitted before a worker died is lost
+		if process is None: process = annotate
+		self.process = process
+		self.workers = workers
+		self.slots = slots
+		self.on_result = on_result
+		self.stall = stall
+		self.cameras = {}
+		self.procs = []
+		self.proc_args = []	# to restart a worker that died
+		self.died = None	# monotonic time a worker was last found dead
+		self.collector = None
+		self.ctx = mp.get_context('spawn')	# forking a process with Gst threads is unsafe
+		self.results = self.ctx.Queue()
+		self.waiting = {}	# (cam, seq) -> [threading.Event, (info, output)] for process_frame()
+		self.lock = threading.Lock()
+		self.running = False
+
+
+	def add_camera(self, sender, writer, shape=(480, 640, 3), out_shape=None, process=None):
+		# process overrides the engine's process for this camera (module level
+		# function or a functools.partial of one)
+		if self.running:
+			print('ERROR: cameras must be added before the engine is started')
+			return None
+		cam = len(self.cameras)
+		if out_shape is None: out_shape = shape
+		self.cameras[cam] = _Camera(sender, writer, shape, out_shape, self.slots, process or self.process)
+		return cam
+
+
+	def start(self, listen=True):
+		# listen=False: no frame is taken from the Senders, see process_frame()
+		self.running = True
+		rings = {cam: (c.ring_in.name, c.ring_in.shape, c.ring_out.name, c.ring_out.shape, self.slots, c.process)
+			for cam, c in self.cameras.items()}
+		if self.workers is None:
+			for c in self.cameras.values():
+				c.tasks = self.ctx.Queue()
+				self.proc_args.append((rings, c.tasks, self.results))
+		else:
+			tasks = self.ctx.Queue()
+			for c in self.cameras.values():
+				c.tasks = tasks
+			for i in range(self.workers):
+				self.proc_args.append((rings, tasks, self.results))
+		for args in self.proc_args:
+			proc = self.ctx.Process(target=worker, args=args, daemon=True)
+			proc.start()
+			self.procs.append(proc)
+		self.collector = threading.Thread(target=self.collect, daemon=True)
+		self.collector.start()
+		if not listen:
+			return
+		for cam, c in self.cameras.items():
+			c.listener = lambda sender, cam=cam: self.submit(cam, sender.latest)
+			c.sender.add_listener(c.listener)
+
+
+	def submit(self, cam, frame):
+		# runs on the Sender's streaming thread: one copy into shared memory
+		c = self.cameras[cam]
+		if not self.running or frame is None or frame.seq <= c.last_seq:
+			return False
+		c.last_seq = frame.seq
+		slot = c.ring_in.acquire()
+		if slot is None:
+			c.dropped += 1
+			return False
+		with frame.view() as view:
+			if view.shape != c.ring_in.shape:
+				print('ERROR: cam', cam, 'frame shape', view.shape, 'does not match', c.ring_in.shape)
+				c.dropped += 1
+				return False
+			np.copyto(c.ring_in.frames[slot], view)
+		c.ring_in.state[slot] = FILLED
+		c.submitted[frame.seq] = (slot, time.monotonic())
+		c.pending.append(frame.seq)
+		c.tasks.put((cam, frame.seq, slot))
+		return True
+
+
+	def process_frame(self, cam, frame, timeout=5.0):
+		# (info, copy of the output) for one frame, None if it could not be
+		# processed. For one caller per camera at a time (the engine keeps the
+		# frames of a camera in order)
+		key = (cam, frame.seq)
+		waiter = [threading.Event(), None]
+		with self.lock:
+			self.waiting[key] = waiter
+		if not self.submit(cam, frame) or not waiter[0].wait(timeout):
+			with self.lock:
+				self.waiting.pop(key, None)
+			return None
+		return waiter[1]
+
+
+	def collect(self):
+		# results can come back out of order from a pool, hold them until
+		# every earlier frame of the same camera has been written
+		checked = time.monotonic()
+		while True:
+			try:
+				item = self.results.get(timeout=0.5)
+			except queue.Empty:
+				item = False
+			if item is None:
+				break
+			if item:
+				cam, seq, slot, info = item
+				c = self.cameras[cam]
+				# a frame given up on can still come back from a restarted worker
+				if seq in c.submitted:
+					c.done[seq] = (slot, info)
+					self.release(cam, c)
+			if time.monotonic() - checked >= 0.5:
+				checked = time.monotonic()
+				self.reap()
+
+
+	def release(self, cam, c):
+		while c.pending and c.pending[0] in c.done:
+			seq = c.pending.popleft()
+			slot, info = c.done.pop(seq)
+			del c.submitted[seq]
+			if c.writer is not None:
+				c.writer.write(c.ring_out.frames[slot])
+			c.processed += 1
+			if self.on_result is not None:
+				self.on_result(cam, seq, info)
+			with self.lock:
+				waiter = self.waiting.pop((cam, seq), None)
+			if waiter is not None:
+				# the slot is reused as soon as it is free
+				waiter[1] = (info, c.ring_out.frames[slot].copy())
+				waiter[0].set()
+			c.ring_in.state[slot] = FREE
+
+
+	def reap(self):
+		# collector thread: restart the workers that died, the frames they had
+		# taken never come back, so once a frame submitted before the death has
+		# waited 'stall' seconds it is skipped and its slot freed
+		now = time.monotonic()
+		for i, proc in enumerate(self.procs):
+			if not self.running or proc.is_alive():
+				continue
+			print('ERROR: processing worker', proc.pid, 'died with exit code', proc.exitcode, '- restarting it')
+			proc = self.ctx.Process(target=worker, args=self.proc_args[i], daemon=True)
+			proc.start()
+			self.procs[i] = proc
+			self.died = now
+		if self.died is None:
+			return
+		for cam, c in self.cameras.items():
+			while c.pending and c.pending[0] not in c.done:
+				slot, submitted = c.submitted[c.pending[0]]
+				if submitted > self.died or now - submitted < self.stall:
+					break
+				seq = c.pending.popleft()
+				del c.submitted[seq]
+				c.lost += 1
+				print('ERROR: cam', cam, 'frame', seq, 'lost with a worker')
+				with self.lock:
+					waiter = self.waiting.pop((cam, seq), None)
+				if waiter is not None:
+					waiter[0].set()
+				c.ring_in.state[slot] = FREE
+			self.release(cam, c)
+
+
+	def stop(self):
+		self.running = False
+		for c in self.cameras.values():
+			if c.listener is not None:
+				c.sender.remove_listener(c.listener)
+		queues = set(c.tasks for c in self.cameras.values())
+		for tasks in queues:
+			for i in range(len(self.procs)):
+				tasks.put(None)
+		for proc in self.procs:
+			proc.join(timeout=2.0)
+			if proc.is_alive():
+				proc.terminate()
+		self.results.put(None)
+		self.collector.join()
+		for c in self.cameras.values():
+			c.ring_in.close()
+			c.ring_out.close()
+
+
+	def stats(self):
+		return {cam: {'processed': c.processed, 'dropped': c.dropped, 'lost': c.lost}
+			for cam, c in self.cameras.items()}
+
+
+def worker(rings, tasks, results):
+	attached = {}
+	for cam, (in_name, in_shape, out_name, out_shape, slots, process) in rings.items():
+		attached[cam] = (SharedFrameRing(in_shape, slots, in_name),
+				SharedFrameRing(out_shape, slots, out_name), process)
+	while True:
+		task = tasks.get()
+		if task is None:
+			break
+		cam, seq, slot = task
+		ring_in, ring_out, process = attached[cam]
+		try:
+			info = process(ring_in.frames[slot], ring_out.frames[slot])
+		except Exception as e:
+			print('ERROR: processing cam', cam, 'frame', seq, ':', e)
+			info = None
+		results.put((cam, seq, slot, info))
+	for ring_in, ring_out, process in attached.values():
+		ring_in.close()
+		ring_out.close()
+
+
+def annotate(src, dst):
+	np.copyto(dst, src)
+
+	# Simple Aruco detection
+	#markers = detect_markers(dst)
+	#for marker in markers:
+	#	marker.highlite_marker(dst)
+
+	# for qr_code in decode(dst):
+	#	myData = qr_code.data.decode('utf-8')
+	#	print(myData)
+	#	pts = np.array([qr_code.polygon], np.int32)
+	#	pts = pts.reshape((-1,1,2))
+	#	cv2.polylines(dst, [pts], True, (255, 0, 255), 5) #box around qr code
+		# uncomment below 2 for decoded QR string to appear above QR Code
+	#	pts2 = qr_code.rect
+	#	cv2.putText(dst, myData, (pts2[0], pts2[1]), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (255,0,255), 2)
+	return None
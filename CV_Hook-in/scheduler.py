@@ -0,0 +1,200 @@
+# File: scheduler.py
+
+# Contains:
+#   Class
+#	Scheduler class - keeps the outgoing streams at the camera frame rate
+#	whatever the vision processing costs. Every camera has its own output
+#	thread that writes each new frame to its VideoWriter as soon as it arrives.
+#	Processing runs on separate worker threads. A camera is processed once every
+#	skip+1 frames, always on its newest frame (the ones in between are not
+#	queued). The skip ratio of each camera follows the measured processing time
+#	so the cameras together stay within 'budget' ms of processing per frame
+#	interval, shared out by priority. Achieved output/processing fps, processing
+#	ms and skip ratios are exported to metrics.py.
+
+
+import math
+import time
+import threading
+import collections
+import metrics
+
+
+class _Camera:
+	def __init__(self, sender, writer, name, priority, process):
+		self.sender = sender
+		self.writer = writer
+		self.name = name
+		self.priority = priority
+		self.process = process
+		self.thread = None
+		self.listener = None
+		self.since = 0		# frames since the last one processed
+		self.busy = False
+		self.skip = 0
+		self.cost = None	# moving average of the processing ms
+		self.interval = 1.0 / 30
+		self.last_time = None
+		self.written = 0
+		self.processed = 0
+		self.out_fps = _Rate()
+		self.proc_fps = _Rate()
+
+
+class _Rate:
+	# frames per second over a sliding second
+	def __init__(self, window=1.0):
+		self.window = window
+		self.times = collections.deque()
+
+
+	def tick(self, now):
+		self.times.append(now)
+		while now - self.times[0] > self.window:
+			self.times.popleft()
+
+
+	def value(self):
+		# read from the metrics thread, work on a copy
+		times = list(self.times)
+		if len(times) < 2: return 0.0
+		span = times[-1] - times[0]
+		return (len(times) - 1) / span if span > 0 else 0.0
+
+
+class Scheduler:
+	def __init__(self, process=None, budget=20.0, workers=1, max_skip=30, on_result=None):
+		# process(sender, frame) -> info runs on a worker thread with the newest
+		# Frame of a camera, it reads it through frame.view() (mapped, see framepool.py)
+		# budget - ms of processing per frame interval for all the cameras together
+		# on_result(name, frame, info) is called on the worker thread
+		self.process = process
+		self.budget = budget
+		self.workers = workers
+		self.max_skip = max_skip
+		self.on_result = on_result
+		self.cameras = []
+		self.cond = threading.Condition()
+		self.threads = []
+		self.running = False
+
+
+	def add_camera(self, sender, writer, name, priority=1, process=None):
+		# priority - share of the budget relative to the other cameras, 0 to only
+		# stream it. process overrides the scheduler's process for this camera
+		if self.running:
+			print('ERROR: cameras must be added before the scheduler is started')
+			return None
+		cam = _Camera(sender, writer, name, priority, process or self.process)
+		self.cameras.append(cam)
+		metrics.REGISTRY.gauge('output_fps', 'Frames per second written to the outgoing stream',
+			cam.out_fps.value, camera=name)
+		metrics.REGISTRY.gauge('processing_fps', 'Frames per second processed', cam.proc_fps.value, camera=name)
+		metrics.REGISTRY.gauge('processing_ms', 'Moving average of the processing time of a frame',
+			lambda: cam.cost or 0.0, camera=name)
+		metrics.REGISTRY.gauge('processing_skip', 'Frames skipped between processed frames',
+			lambda: cam.skip, camera=name)
+		return cam
+
+
+	def start(self):
+		self.running = True
+		for cam in self.cameras:
+			cam.listener = lambda sender, cam=cam: self.on_frame(cam)
+			cam.sender.add_listener(cam.listener)
+			if cam.writer is not None:
+				cam.thread = threading.Thread(target=self.output, args=(cam,), daemon=True)
+				cam.thread.start()
+		for i in range(self.workers):
+			thread = threading.Thread(target=self.work, daemon=True)
+			thread.start()
+			self.threads.append(thread)
+
+
+	def stop(self):
+		self.running = False
+		for cam in self.cameras:
+			cam.sender.remove_listener(cam.listener)
+		with self.cond:
+			self.cond.notify_all()
+		for thread in self.threads:
+			thread.join()
+		for cam in self.cameras:
+			if cam.thread is not None:
+				cam.thread.join(timeout=2.0)
+
+
+	def output(self, cam):
+		# the outgoing stream waits on nothing but the camera
+		while self.running and cam.sender.running:
+			frame = cam.sender.wait_for_frame(timeout=0.5)
+			if frame is None: continue
+			with frame.view() as view:
+				cam.writer.write(view)
+			cam.written += 1
+			cam.out_fps.tick(time.monotonic())
+
+
+	def on_frame(self, cam):
+		# streaming thread: count the frame and wake a worker if it is due
+		frame = cam.sender.latest
+		if frame is None: return
+		now = time.monotonic()
+		with self.cond:
+			if cam.last_time is not None:
+				# frame interval, for the share of the budget
+				cam.interval += 0.1 * (now - cam.last_time - cam.interval)
+			cam.last_time = now
+			cam.since += 1
+			if cam.priority > 0 and not cam.busy and cam.since > cam.skip:
+				self.cond.notify()
+
+
+	def next_camera(self):
+		# highest priority of the cameras that are due, then the most overdue
+		due = [cam for cam in self.cameras if cam.priority > 0 and not cam.busy
+			and cam.since > cam.skip and cam.sender.latest is not None]
+		if not due: return None
+		return max(due, key=lambda cam: (cam.priority, cam.since - cam.skip))
+
+
+	def work(self):
+		while True:
+			with self.cond:
+				self.cond.wait_for(lambda: not self.running or self.next_camera() is not None)
+				if not self.running: return
+				cam = self.next_camera()
+				cam.busy = True
+				cam.since = 0
+			frame = cam.sender.latest
+			start = time.monotonic()
+			try:
+				info = cam.process(cam.sender, frame)
+			except Exception as e:
+				print('ERROR: processing', cam.name, 'frame', frame.seq, ':', e)
+				info = None
+			end = time.monotonic()
+			with self.cond:
+				cam.busy = False
+				cam.processed += 1
+				cam.proc_fps.tick(end)
+				self.adapt(cam, (end - start) * 1000)
+			if self.on_result is not None and info is not None:
+				self.on_result(cam.name, frame, info)
+
+
+	def adapt(self, cam, ms):
+		# skip just enough frames for the camera's processing to fit its share
+		# of the budget: cost / (skip + 1) <= share
+		cam.cost = ms if cam.cost is None else cam.cost + 0.2 * (ms - cam.cost)
+		total = sum(c.priority for c in self.cameras)
+		# the budget is per 30 fps interval, slower cameras get proportionally more
+		share = self.budget * cam.priority / total * cam.interval * 30
+		skip = math.ceil(cam.cost / share) - 1 if share > 0 else self.max_skip
+		cam.skip = max(0, min(self.max_skip, skip))
+
+
+	def stats(self):
+		return {cam.name: {'written': cam.written, 'processed': cam.processed, 'skip': cam.skip,
+			'processing_ms': round(cam.cost or 0.0, 2), 'processing_fps': round(cam.proc_fps.value(), 1),
+			'output_fps': round(cam.out_fps.value(), 1)} for cam in self.cameras}
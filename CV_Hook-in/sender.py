@@ -5,109 +5,317 @@
 # Contains:
 #   Class
 #	Sender class - inherits from class GstPipeline. The Sender class handles
-#	the stream from the cameras and sends them to appsink (OpenCV).
+#	the stream from the cameras and sends them to appsink (OpenCV). Frames are
+#	mapped from the Gst buffer (in place where the bindings allow, see framepool.py). New frames are
+#	numbered and can be waited on (wait_for_frame(), async for frame in sender).
+#	FrameGroup class - waits for new frames on any/all of several Senders.
+#	enable_stereo() splits a side-by-side stereo camera, see stereo.py.
+#	A startup.StartupTimer records the time to the first frame reaching OpenCV.
 #   Functions
-#	get_pipeline() - Gst launch commands in a string for different cameras on the TX2
+#	get_pipeline() - Gst launch commands in a string for different cameras on the TX2,
+#	videoconvert inside the pipeline delivers the pixel format the consumer asks for
 #	get_pipeline_out() - Gst launch command to send from OpenCV to udpsink using
 #	ip 192.168.2.0 and port 8080
 
 
+import os
 import sys
-import numpy as np
+import threading
+from contextlib import contextmanager
 import gi
 gi.require_version('Gst', '1.0')
 from gi.repository import Gst
 import pipeline as p
+import framepool as fp
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import builder
+import metrics
+import startup
+
+
+# pixel formats the appsink can hand to OpenCV
+FORMATS = ('RGB', 'BGR', 'BGRx', 'GRAY8', 'NV12')
 
 
 class Sender(p.GstPipeline):
-	def __init__(self, pipeline):
+	def __init__(self, pipeline, pool_size=4, fmt=None, name=None):
+		# name - for the STARTUP line printed when the first frame arrives
 		super().__init__()
+		self.timer = startup.StartupTimer(name, 'appsink') if name is not None else None
+		self.fmt = fmt
+		self.sample = None
+		self.latest = None
+		self.seq = 0
+		self.last_seq = 0
+		self.dropped = 0
+		self.listeners = []
+		self.frame_ready = threading.Condition()
+		self.pool = fp.FramePool(pool_size)
+		self.camera = None
+		self.stereo = None
 		super().launch_pipeline(pipeline)
-		super().play()
 		self.video_sink = None
 		self.connect_sink()
+		if self.timer is not None:
+			self.timer.mark('built')
+			self.timer.watch_source(self.pipeline)
+		super().play()
+		if self.timer is not None: self.timer.mark('set_state')
 
 
 	def connect_sink(self):
 		self.video_sink = self.pipeline.get_by_name('appsink')
 		self.video_sink.connect('new-sample', self.callback)
+		# override the format get_pipeline() was built with, caps are
+		# renegotiated with videoconvert when the pipeline starts
+		if self.fmt is not None:
+			if self.fmt not in FORMATS:
+				print('ERROR: unsupported format', self.fmt)
+			else:
+				outcaps = self.pipeline.get_by_name('outcaps')
+				outcaps.set_property('caps', Gst.Caps.from_string('video/x-raw, format=' + self.fmt))
 
 
 	def callback(self, sink):
+		# only the sample is kept, pixels are not touched on the streaming thread
 		sample = sink.emit('pull-sample')
-		new_frame = self.gst_to_opencv(sample)
-		self.frame = new_frame
+		with self.frame_ready:
+			self.seq += 1
+			self.sample = sample
+			self.latest = fp.Frame(sample, self.seq)
+			self.frame_ready.notify_all()
+		if self.seq == 1 and self.timer is not None:
+			self.timer.mark('appsink')
+		for listener in list(self.listeners):
+			listener(self)
 		return Gst.FlowReturn.OK
 
 
+	def enable_metrics(self, camera):
+		# counters for the frames reaching OpenCV, see metrics.py
+		self.camera = camera
+		metrics.watch_pad(self.video_sink.get_static_pad('sink'), camera, 'appsink')
+		metrics.watch_pipeline(self.pipeline, camera)
+
+
+	def enable_stereo(self, **kwargs):
+		# left/right views and a disparity map at a lower rate (stereo.StereoStage)
+		import stereo
+		self.stereo = stereo.StereoStage(self, **kwargs)
+		return self.stereo
+
+
+	def on_message(self, bus, message):
+		if message.type == Gst.MessageType.QOS and self.camera is not None:
+			metrics.on_qos(message, self.camera)
+		elif message.type == Gst.MessageType.STATE_CHANGED and self.timer is not None:
+			self.timer.on_message(message, self.pipeline)
+		return super().on_message(bus, message)
+
+
+	def _shutdown(self):
+		super()._shutdown()
+		self.running = False
+		# wake up anything waiting on a frame that will never come
+		with self.frame_ready:
+			self.frame_ready.notify_all()
+		for listener in list(self.listeners):
+			listener(self)
+
+
+	def release(self):
+		# stop the pipeline, unless an error or the end of the stream already did
+		if self.running:
+			self._shutdown()
+
+
+	def add_listener(self, listener):
+		# listener(sender) is called on the streaming thread for every new frame,
+		# it must return quickly
+		self.listeners.append(listener)
+
+
+	def remove_listener(self, listener):
+		if listener in self.listeners:
+			self.listeners.remove(listener)
+
+
+	def frame_after(self, seq):
+		# latest frame if it is newer than seq, otherwise None
+		with self.frame_ready:
+			if self.latest is not None and self.latest.seq > seq:
+				return self.latest
+		return None
+
+
+	def _consume(self, frame):
+		if self.last_seq > 0:
+			self.dropped += frame.seq - self.last_seq - 1
+		self.last_seq = frame.seq
+		return frame
+
+
+	def wait_for_frame(self, timeout=None):
+		# block until a frame newer than the last one returned arrives.
+		# Returns a Frame or None on timeout/shutdown, frames that were
+		# replaced before we got to them are counted in self.dropped
+		with self.frame_ready:
+			self.frame_ready.wait_for(
+				lambda: not self.running or (self.latest is not None
+				and self.latest.seq > self.last_seq), timeout)
+			frame = self.frame_after(self.last_seq)
+		if frame is None:
+			return None
+		return self._consume(frame)
+
+
+	async def frames(self):
+		# async iterator over new frames, the appsink callback wakes the
+		# event loop so nothing polls while waiting
+		import asyncio
+		loop = asyncio.get_running_loop()
+		event = asyncio.Event()
+		listener = lambda sender: loop.call_soon_threadsafe(event.set)
+		self.add_listener(listener)
+		try:
+			while self.running:
+				await event.wait()
+				event.clear()
+				frame = self.frame_after(self.last_seq)
+				if frame is not None:
+					yield self._consume(frame)
+		finally:
+			self.remove_listener(listener)
+
+
+	def __aiter__(self):
+		return self.frames()
+
+
 	def gst_to_opencv(self, sample):
-		buff = sample.get_buffer()
-		caps = sample.get_caps()
-		array = np.ndarray(
-			(
-				caps.get_structure(0).get_value('height'),
-				caps.get_structure(0).get_value('width'),
-				3
-			),
-			buffer=buff.extract_dup(0, buff.get_size()), dtype=np.uint8)
-		return array
+		# copy of the frame in the next slot of the pool ring
+		with fp.map_sample(sample) as view:
+			return self.pool.copy(view)
+
+
+	@contextmanager
+	def frame_view(self):
+		# read only mapped view of the latest frame (see framepool.zero_copy()), valid inside the with block.
+		# Our reference to the sample keeps the buffer alive even if the callback
+		# replaces self.sample in the meantime. None before the first frame.
+		with self.frame_ready:
+			sample = self.sample
+		if sample is None:
+			yield None
+			return
+		with fp.map_sample(sample) as view:
+			yield view
 
 
 	def get_frame(self):
-		return self.frame 	 #cap.read() output
+		# copy of the latest frame for consumers that need to keep it, None
+		# before the first frame
+		with self.frame_ready:
+			sample = self.sample
+		if sample is None:
+			return None
+		return self.gst_to_opencv(sample)
 
 
 	def frame_available(self):
-		return type(self.frame) != type(None)
-
-
-def get_pipeline(machine="", cam=''):
-
-	if machine == 'tx2':
-		if cam == 'cam2':	#HD USB Camera (usb-3530000.xhci-2.2)
-			device_n_caps = (
-					'v4l2src device=/dev/video1 ! '
-					'video/x-raw, framerate=30/1, width=640, height=480 ! '
-					)
-		elif cam == 'cam3':	#Stereo Vision 1 (usb-3530000.xhci-2.3)
-			device_n_caps = (
-					'v4l2src device=/dev/video3 ! '
-					'video/x-raw, format=YUY2, width=640, height=480 ! '
-					)
-		elif cam == 'cam4':	#HD USB Camera (usb-3530000.xhci-2.4)
-			device_n_caps = (
-					'v4l2src device=/dev/video4 ! '
-					'video/x-raw, width=640, height=480 ! '
-					)
-
-	elif machine == 'file':
-		if cam == "": cam = 'testvideo0'
-		device_n_caps = ('filesrc location=' + cam + '.raw ! videoparse format=4 '
-				 'width=640 height=480 framerate=30/1 ! ')
-
-
-	if device_n_caps is None:
-		device_n_caps = 'videotestsrc ! '
-
-	return (
-		device_n_caps + 'videoconvert ! '
-		'video/x-raw, format=(string){RGB} ! '
+		return self.sample is not None
+
+
+class FrameGroup:
+	def __init__(self, senders):
+		# waits on several Senders at once, each group keeps its own position
+		# in every stream so it does not disturb Sender.wait_for_frame users
+		self.senders = list(senders)
+		self.last_seq = {s: 0 for s in self.senders}
+		self.dropped = {s: 0 for s in self.senders}
+		self.cond = threading.Condition()
+		for s in self.senders:
+			s.add_listener(self.on_frame)
+
+
+	def on_frame(self, sender):
+		with self.cond:
+			self.cond.notify_all()
+
+
+	def close(self):
+		for s in self.senders:
+			s.remove_listener(self.on_frame)
+
+
+	def _new_frames(self):
+		frames = {}
+		for s in self.senders:
+			frame = s.frame_after(self.last_seq[s])
+			if frame is not None:
+				frames[s] = frame
+		return frames
+
+
+	def _consume(self, frames):
+		for s, frame in frames.items():
+			if self.last_seq[s] > 0:
+				self.dropped[s] += frame.seq - self.last_seq[s] - 1
+			self.last_seq[s] = frame.seq
+		return frames
+
+
+	def _stopped(self):
+		return not all(s.running for s in self.senders)
+
+
+	def wait_any(self, timeout=None):
+		# {sender: Frame} for every sender with a new frame, empty on timeout
+		with self.cond:
+			self.cond.wait_for(lambda: self._stopped() or self._new_frames(), timeout)
+			return self._consume(self._new_frames())
+
+
+	def wait_all(self, timeout=None):
+		# list of Frames (in sender order) once every sender has a new frame,
+		# None on timeout or if a sender shut down
+		with self.cond:
+			ready = self.cond.wait_for(lambda: self._stopped()
+				or len(self._new_frames()) == len(self.senders), timeout)
+			frames = self._new_frames()
+			if not ready or len(frames) != len(self.senders):
+				return None
+			self._consume(frames)
+			return [frames[s] for s in self.senders]
+
+
+def get_pipeline(machine="", cam='', fmt='RGB'):
+	if fmt not in FORMATS:
+		print('ERROR: unsupported format', fmt, '- using RGB')
+		fmt = 'RGB'
+
+	# camera registry in builder.py, unknown cameras fall back to videotestsrc
+	return builder.chain(
+		builder.camera_source(machine or None, cam),
+		'videoconvert',
+		'capsfilter name=outcaps caps="video/x-raw, format=(string)' + fmt + '"',
 		'appsink name=appsink emit-signals=true max-buffers=1 drop=true'
 	)
 
 
-def get_pipeline_out(ip='192.168.2.0', port='8080'):
-	return (
-		"appsrc ! "
-		"video/x-raw, format=BGR ! "
-		"queue ! "
-		"videoconvert ! "
-		"video/x-raw, format=BGRx ! "
-		"nvvidconv ! "
-		"omxh265enc ! "
-		"video/x-h265, stream-format=byte-stream ! "
-		"h265parse ! "
-		"rtph265pay pt=96 config-interval=1 ! "
-		"udpsink host=" + ip + " port=" + port
+def get_pipeline_out(ip='192.168.2.0', port='8080', fmt='BGR'):
+	# only convert when the encoder's input conversion can't take the frames as they are
+	enc = builder.find_encoder()
+	if enc['input'] is None or fmt == enc['input']: convert = ''
+	else: convert = 'videoconvert ! video/x-raw, format=' + enc['input']
+	return builder.chain(
+		'appsrc',
+		'video/x-raw, format=' + fmt,
+		'queue',
+		convert,
+		builder.encode(),
+		'video/x-h265, stream-format=byte-stream',
+		'h265parse',
+		'rtph265pay pt=96 config-interval=1',
+		'udpsink host=' + ip + ' port=' + str(port)
 	)
@@ -0,0 +1,205 @@
+# File: stereo.py
+
+# Contains:
+#   Class
+#	StereoStage class - for the side-by-side stereo camera (cam3, "Stereo Vision
+#	1"). The left and right images are column slices of the frame the Sender
+#	mapped from the Gst buffer, nothing is copied to split them. A disparity map
+#	(or a depth map when the calibration is given) is computed from downscaled
+#	grey halves on a small thread pool at 'rate' per second; frames arriving while
+#	every worker is busy are skipped, so the 30 fps path of the Sender is never
+#	held up. Results go to a VideoWriter (e.g. sender.get_pipeline_out(fmt='GRAY8'))
+#	and/or PNG files in a directory and/or a callback. With attach() the
+#	matching runs in a processing.ProcessingEngine worker process instead of on
+#	the pool thread, which then only waits for it.
+#   Functions
+#	halves() - left and right views of a side-by-side frame
+#	disparity() - StereoBM disparity of the downscaled grey halves of a frame
+#	engine_process() - disparity() as a ProcessingEngine function
+
+
+import os
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import metrics
+
+
+def halves(view):
+	# two views of the same memory, the right half starts width/2 pixels in
+	width = view.shape[1] // 2
+	return view[:, :width], view[:, width:2 * width]
+
+
+def disparity(view, matcher, scale):
+	# fixed point, 16 * disparity in pixels. cv2 takes the strided views as they
+	# are, the only copies are the small images
+	code = {3: cv2.COLOR_BGR2GRAY, 4: cv2.COLOR_BGRA2GRAY}.get(view.shape[2])
+	grey = []
+	for half in halves(view):
+		small = cv2.resize(half, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+		if code is None: grey.append(small[:, :, 0] if small.ndim == 3 else small)
+		else: grey.append(cv2.cvtColor(small, code))
+	return matcher.compute(grey[0], grey[1])
+
+
+_matcher = None		# StereoBM of an engine worker process
+
+
+def engine_process(src, dst, scale, disparities, block):
+	# runs in a ProcessingEngine worker, dst is (height, width, 2) uint8: the
+	# int16 disparity map byte by byte
+	global _matcher
+	if _matcher is None:
+		_matcher = cv2.StereoBM_create(numDisparities=disparities, blockSize=block)
+	np.copyto(dst.view(np.int16)[:, :, 0], disparity(src, _matcher, scale))
+
+
+class StereoStage:
+	def __init__(self, sender, rate=5.0, scale=0.5, workers=1, disparities=64, block=15,
+			writer=None, directory=None, on_result=None, focal=None, baseline=None):
+		# rate - disparity maps per second, 0 to only expose the halves
+		# scale - of each half before matching, StereoBM cost grows with the area
+		# disparities/block - StereoBM numDisparities (multiple of 16) and blockSize (odd)
+		# focal (pixels, full resolution) and baseline (metres) give a depth map in
+		# millimetres instead of the disparity scaled to 0-255
+		# on_result(seq, pts, image) is called from a worker thread
+		self.sender = sender
+		self.interval = 1.0 / rate if rate > 0 else None
+		self.scale = scale
+		self.disparities = disparities
+		self.block = block
+		self.writer = writer
+		self.directory = directory
+		self.on_result = on_result
+		self.focal = focal
+		self.baseline = baseline
+		self.workers = workers
+		self.pool = ThreadPoolExecutor(workers) if self.interval else None
+		self.engine = None
+		self.engine_cam = None
+		self.engine_lock = threading.Lock()	# process_frame() takes one frame of a camera at a time
+		self.local = threading.local()		# a StereoBM per worker, they are not thread safe
+		self.lock = threading.Lock()
+		self.busy = 0
+		self.next_time = 0.0
+		self.last_written = 0
+		self.computed = 0
+		self.skipped = 0
+		if directory is not None:
+			os.makedirs(directory, exist_ok=True)
+		if sender.camera is not None:
+			self.register(sender.camera)
+		if self.pool is not None:
+			sender.add_listener(self.on_frame)
+
+
+	def register(self, camera):
+		metrics.REGISTRY.gauge('stereo_maps', 'Disparity maps computed', lambda: self.computed, camera=camera)
+		metrics.REGISTRY.gauge('stereo_skipped', 'Frames due for a disparity map while the workers were busy',
+			lambda: self.skipped, camera=camera)
+
+
+	def attach(self, engine, shape=(480, 640, 3)):
+		# before engine.start(): the maps are computed by the engine's worker
+		# for this camera, the pool threads take turns waiting for it
+		width, height = self.size(shape)
+		self.engine = engine
+		self.engine_cam = engine.add_camera(self.sender, None, shape, (height, width, 2),
+			functools.partial(engine_process, scale=self.scale, disparities=self.disparities, block=self.block))
+
+
+	@contextmanager
+	def view(self):
+		# read only (left, right) of the latest mapped frame, valid inside the with
+		# block, None before the first frame
+		with self.sender.frame_view() as view:
+			yield None if view is None else halves(view)
+
+
+	def on_frame(self, sender):
+		# streaming thread: only decide whether this frame gets a map
+		frame = sender.latest
+		if frame is None or not sender.running:
+			return
+		now = time.monotonic()
+		if now < self.next_time:
+			return
+		with self.lock:
+			if self.busy >= self.workers:
+				self.skipped += 1
+				return
+			self.busy += 1
+		self.next_time = now + self.interval
+		# the Frame holds the sample, so its buffer stays valid in the worker
+		self.pool.submit(self.compute, frame)
+
+
+	def matcher(self):
+		if not hasattr(self.local, 'bm'):
+			self.local.bm = cv2.StereoBM_create(numDisparities=self.disparities, blockSize=self.block)
+		return self.local.bm
+
+
+	def compute(self, frame):
+		try:
+			if self.engine is None:
+				with frame.view() as view:
+					raw = disparity(view, self.matcher(), self.scale)
+			else:
+				with self.engine_lock:
+					result = self.engine.process_frame(self.engine_cam, frame)
+				if result is None:
+					print('ERROR: stereo frame', frame.seq, ': not processed by the engine')
+					return
+				raw = result[1].view(np.int16)[:, :, 0]
+			image = self.to_image(raw)
+			self.output(frame, image)
+		except Exception as e:
+			print('ERROR: stereo frame', frame.seq, ':', e)
+		finally:
+			with self.lock:
+				self.busy -= 1
+
+
+	def to_image(self, disparity):
+		if self.focal is None or self.baseline is None:
+			return cv2.convertScaleAbs(np.maximum(disparity, 0), alpha=255.0 / (16 * self.disparities))
+		# disparities are in downscaled pixels, the focal length at full resolution
+		valid = disparity > 0
+		depth = np.zeros(disparity.shape, dtype=np.uint16)
+		pixels = disparity[valid].astype(np.float32) / (16 * self.scale)
+		depth[valid] = np.minimum(self.focal * self.baseline * 1000.0 / pixels, 65535)
+		return depth
+
+
+	def output(self, frame, image):
+		with self.lock:
+			# with several workers a slow map can finish after a newer one
+			if frame.seq <= self.last_written:
+				return
+			self.last_written = frame.seq
+			self.computed += 1
+			if self.writer is not None:
+				self.writer.write(image if image.dtype == np.uint8 else cv2.convertScaleAbs(image, alpha=255.0 / 65535))
+			if self.directory is not None:
+				cv2.imwrite(os.path.join(self.directory, 'disparity_%06d.png' % frame.seq), image)
+		if self.on_result is not None:
+			self.on_result(frame.seq, frame.pts, image)
+
+
+	def size(self, shape):
+		# (width, height) of the maps for a frame shape, for the VideoWriter
+		height, width = shape[:2]
+		return int(round(width // 2 * self.scale)), int(round(height * self.scale))
+
+
+	def close(self):
+		self.sender.remove_listener(self.on_frame)
+		if self.pool is not None:
+			self.pool.shutdown(wait=True)
+			self.pool = None
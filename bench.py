@@ -0,0 +1,345 @@
+# File: bench.py
+
+# Contains:
+#   Loopback end-to-end benchmark. N sender processes encode frames from a test
+#   pattern (or a raw YUY2 file like testvideo0.raw) and send them over RTP to
+#   127.0.0.1, one receiver process decodes every stream. The senders run the
+#   rover's pipeline (sender.get_pipeline, with an appsrc for the camera) and
+#   the receiver the receivers' branches (branches.StreamBranch: jitter buffer,
+#   FEC recovery, depay, decode), so the benchmark covers the code it guards.
+#   Each frame carries the time it was pushed as a row of black/white blocks,
+#   which the receiver reads back after decoding to get glass-to-glass latency
+#   (jitter buffer included). Every process reports its
+#   own CPU and peak RSS. Results are written as JSON and checked against
+#   bench_thresholds.json (and optionally a previous result), the exit code is
+#   1 when a threshold or the baseline is missed so CI can fail the build.
+#   Functions
+#	embed_time()/read_time() - write/read the timestamp blocks
+#	run_sender()/run_receiver() - the child processes
+#	run() - starts the children and collects the results
+#	check() - compares results with thresholds and a baseline
+
+# Usage:
+#	python3 bench.py --streams 3 --duration 20 --software --output bench.json
+#	python3 bench.py --baseline previous.json
+
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+
+WIDTH = 640
+HEIGHT = 480
+BITS = 32	# ms since the start of the run
+BLOCK = 16	# block size in pixels, survives compression at low bitrates
+
+
+def embed_time(frame, ms):
+	# YUY2: luma is every other byte
+	stride = WIDTH * 2
+	for i in range(BITS):
+		value = 235 if (ms >> (BITS - 1 - i)) & 1 else 16
+		x = i * BLOCK * 2
+		for y in range(BLOCK):
+			row = y * stride
+			frame[row + x:row + x + BLOCK * 2:2] = bytes([value]) * BLOCK
+
+
+def read_time(data, stride, scale=1.0):
+	# GRAY8 frame, sample the middle of every block. scale - of the received
+	# frame, the sender's pipeline scales it down
+	ms = 0
+	row = int(BLOCK // 2 * scale) * stride
+	for i in range(BITS):
+		ms = (ms << 1) | (data[row + int((i * BLOCK + BLOCK // 2) * scale)] > 128)
+	return ms
+
+
+def test_frames(source):
+	# endless YUY2 frames from a raw file or a grey ramp with a moving bar
+	size = WIDTH * HEIGHT * 2
+	if source.startswith('file:'):
+		with open(source[5:], 'rb') as f:
+			frames = []
+			while True:
+				data = f.read(size)
+				if len(data) < size: break
+				frames.append(data)
+		n = 0
+		while True:
+			yield bytearray(frames[n % len(frames)])
+			n += 1
+	ramp = bytearray()
+	for x in range(WIDTH // 2):
+		y = 16 + (x * 219) // (WIDTH // 2)
+		ramp += bytes([y, 128, y, 128])
+	base = ramp * HEIGHT
+	n = 0
+	while True:
+		frame = bytearray(base)
+		bar = (n * 8) % WIDTH
+		for y in range(BLOCK * 2, HEIGHT):
+			row = y * WIDTH * 2
+			frame[row + bar * 2:row + bar * 2 + 32:2] = bytes([235]) * 16
+		yield frame
+		n += 1
+
+
+def usage(start_wall, start_cpu):
+	wall = time.monotonic() - start_wall
+	cpu = time.process_time() - start_cpu
+	return {'cpu_percent': round(100.0 * cpu / wall, 1),
+		'rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)}
+
+
+def init_gst(args):
+	import gi
+	gi.require_version('Gst', '1.0')
+	from gi.repository import Gst, GLib
+	import builder
+	Gst.init(None)
+	if args.software:
+		builder.select(encoder='x265enc', decoder='avdec_h265')
+	return Gst, GLib, builder
+
+
+def run_sender(args):
+	Gst, GLib, builder = init_gst(args)
+	import sender
+	start_wall, start_cpu = time.monotonic(), time.process_time()
+	pipeline = Gst.parse_launch(sender.get_pipeline(ip='127.0.0.1', port=args.port, source=builder.chain(
+		'appsrc name=src is-live=true format=time do-timestamp=true '
+		'caps="video/x-raw, format=YUY2, width=%d, height=%d, framerate=%d/1"' % (WIDTH, HEIGHT, args.fps),
+		'queue')))
+	enc = builder.find_encoder()
+	pipeline.get_by_name('encoder').set_property(enc['bitrate'], int(args.bitrate * enc['bitrate_scale']))
+	src = pipeline.get_by_name('src')
+	pipeline.set_state(Gst.State.PLAYING)
+	frames = test_frames(args.source)
+	sent = 0
+	period = 1.0 / args.fps
+	end = time.monotonic() + args.duration
+	next_frame = time.monotonic()
+	while time.monotonic() < end:
+		frame = next(frames)
+		embed_time(frame, int((time.time() - args.epoch) * 1000))
+		src.emit('push-buffer', Gst.Buffer.new_wrapped(bytes(frame)))
+		sent += 1
+		next_frame += period
+		delay = next_frame - time.monotonic()
+		if delay > 0: time.sleep(delay)
+	src.emit('end-of-stream')
+	time.sleep(0.5)
+	pipeline.set_state(Gst.State.NULL)
+	result = {'port': args.port, 'frames_sent': sent}
+	result.update(usage(start_wall, start_cpu))
+	print(json.dumps(result))
+
+
+class _Stream:
+	def __init__(self, port):
+		self.port = port
+		self.frames = 0
+		self.first = None
+		self.last = None
+		self.latencies = []
+		self.reporter = None
+		self.branch = None
+
+
+def run_receiver(args):
+	Gst, GLib, builder = init_gst(args)
+	import ratecontrol
+	import branches
+	start_wall, start_cpu = time.monotonic(), time.process_time()
+	ports = [int(p) for p in args.ports.split(',')]
+	streams = {p: _Stream(p) for p in ports}
+	pipeline = Gst.parse_launch(builder.recv_sources('127.0.0.1', [('bench%d' % p, p) for p in ports]))
+	# the hardware decoders output NVMM buffers, only their converter takes
+	# them out to system memory, videoconvert then makes the GRAY8 the probe reads
+	conv = builder.display_convert()
+	for p in ports:
+		sink = Gst.parse_bin_from_description(builder.chain(
+			'queue', conv if conv != 'videoconvert' else '',
+			'videoconvert', 'video/x-raw, format=GRAY8',
+			'appsink name=sink%d emit-signals=true sync=false' % p), True)
+		pipeline.add(sink)
+		streams[p].branch = branches.StreamBranch(pipeline, 'bench%d' % p, latency=args.latency)
+		streams[p].branch.attach(sink)
+
+	def on_sample(sink, stream):
+		sample = sink.emit('pull-sample')
+		now = int((time.time() - args.epoch) * 1000)
+		buff = sample.get_buffer()
+		width = sample.get_caps().get_structure(0).get_value('width')
+		scale = width / float(WIDTH)
+		stride = (width + 3) // 4 * 4
+		data = buff.extract_dup(0, (int(BLOCK // 2 * scale) + 1) * stride)
+		stream.latencies.append(now - read_time(data, stride, scale))
+		stream.frames += 1
+		if stream.first is None: stream.first = time.monotonic()
+		stream.last = time.monotonic()
+		return Gst.FlowReturn.OK
+
+	for p, stream in streams.items():
+		pipeline.get_by_name('sink%d' % p).connect('new-sample', on_sample, stream)
+		# counts RTP sequence numbers, the loss is read straight from it
+		stream.reporter = ratecontrol.LossReporter(pipeline.get_by_name('src_bench%d' % p), p)
+	loop = GLib.MainLoop()
+	GLib.timeout_add(int(args.duration * 1000), loop.quit)
+	pipeline.set_state(Gst.State.PLAYING)
+	loop.run()
+	pipeline.set_state(Gst.State.NULL)
+
+	result = {'streams': []}
+	for stream in streams.values():
+		r = stream.reporter
+		expected = 0 if r.max_seq is None else r.max_seq - r.first_seq + 1
+		lat = sorted(l for l in stream.latencies if 0 <= l < 60000)
+		span = (stream.last - stream.first) if stream.frames > 1 else 0
+		result['streams'].append({
+			'port': stream.port,
+			'frames': stream.frames,
+			'fps': round((stream.frames - 1) / span, 2) if span > 0 else 0.0,
+			'loss': round(1.0 - r.received / expected, 4) if expected > 0 else 1.0,
+			'latency_ms': {
+				'mean': round(sum(lat) / len(lat), 1) if lat else None,
+				'p50': lat[len(lat) // 2] if lat else None,
+				'p95': lat[int(len(lat) * 0.95)] if lat else None,
+				'max': lat[-1] if lat else None}})
+	result.update(usage(start_wall, start_cpu))
+	print(json.dumps(result))
+
+
+def child(args, role, **kwargs):
+	cmd = [sys.executable, os.path.abspath(__file__), '--role', role,
+		'--epoch', repr(args.epoch), '--fps', str(args.fps),
+		'--bitrate', str(args.bitrate), '--source', args.source, '--latency', str(args.latency)]
+	if args.software: cmd.append('--software')
+	for k, v in kwargs.items():
+		cmd += ['--' + k, str(v)]
+	return subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+
+
+def last_json(proc):
+	out, err = proc.communicate()
+	lines = [l for l in out.splitlines() if l.startswith('{')]
+	if proc.returncode != 0 or not lines:
+		print('ERROR: bench child exited with', proc.returncode)
+		return None
+	return json.loads(lines[-1])
+
+
+def run(args):
+	args.epoch = time.time()
+	ports = [args.base_port + i for i in range(args.streams)]
+	receiver = child(args, 'receiver', ports=','.join(map(str, ports)), duration=args.duration + 3)
+	time.sleep(1.0)
+	senders = [child(args, 'sender', port=p, duration=args.duration) for p in ports]
+	results = {'streams': args.streams, 'duration': args.duration, 'fps': args.fps,
+		'bitrate': args.bitrate, 'source': args.source, 'software': args.software, 'latency': args.latency,
+		'senders': [last_json(s) for s in senders],
+		'receiver': last_json(receiver)}
+	return results
+
+
+def check(results, thresholds, baseline=None, tolerance=0.1):
+	# list of failures, empty when everything is within limits
+	failures = []
+	recv = results['receiver']
+	if recv is None or None in results['senders']:
+		return ['a benchmark process failed']
+	for s in recv['streams']:
+		name = 'stream %d' % s['port']
+		if s['fps'] < thresholds.get('min_fps', 0):
+			failures.append('%s fps %.1f < %.1f' % (name, s['fps'], thresholds['min_fps']))
+		if s['loss'] > thresholds.get('max_loss', 1.0):
+			failures.append('%s loss %.3f > %.3f' % (name, s['loss'], thresholds['max_loss']))
+		p95 = s['latency_ms']['p95']
+		if p95 is None or p95 > thresholds.get('max_latency_p95_ms', float('inf')):
+			failures.append('%s p95 latency %s ms > %s ms' % (name, p95, thresholds.get('max_latency_p95_ms')))
+	for s in results['senders']:
+		if s['cpu_percent'] > thresholds.get('max_sender_cpu_percent', float('inf')):
+			failures.append('sender %d cpu %.1f%% > %.1f%%' % (s['port'], s['cpu_percent'],
+				thresholds['max_sender_cpu_percent']))
+		if s['rss_mb'] > thresholds.get('max_sender_rss_mb', float('inf')):
+			failures.append('sender %d rss %.1f MB > %.1f MB' % (s['port'], s['rss_mb'],
+				thresholds['max_sender_rss_mb']))
+	if recv['cpu_percent'] > thresholds.get('max_receiver_cpu_percent', float('inf')):
+		failures.append('receiver cpu %.1f%% > %.1f%%' % (recv['cpu_percent'],
+			thresholds['max_receiver_cpu_percent']))
+	if recv['rss_mb'] > thresholds.get('max_receiver_rss_mb', float('inf')):
+		failures.append('receiver rss %.1f MB > %.1f MB' % (recv['rss_mb'], thresholds['max_receiver_rss_mb']))
+
+	if baseline is not None and baseline.get('receiver'):
+		# more than 'tolerance' worse than the previous run is a regression
+		old = {s['port']: s for s in baseline['receiver']['streams']}
+		for s in recv['streams']:
+			o = old.get(s['port'])
+			if o is None: continue
+			if s['fps'] < o['fps'] * (1 - tolerance):
+				failures.append('stream %d fps regressed %.1f -> %.1f' % (s['port'], o['fps'], s['fps']))
+			if o['latency_ms']['p95'] and s['latency_ms']['p95'] and \
+					s['latency_ms']['p95'] > o['latency_ms']['p95'] * (1 + tolerance):
+				failures.append('stream %d p95 latency regressed %s -> %s ms' % (s['port'],
+					o['latency_ms']['p95'], s['latency_ms']['p95']))
+		old_cpu = sum(s['cpu_percent'] for s in baseline['senders']) + baseline['receiver']['cpu_percent']
+		new_cpu = sum(s['cpu_percent'] for s in results['senders']) + recv['cpu_percent']
+		if new_cpu > old_cpu * (1 + tolerance):
+			failures.append('total cpu regressed %.1f%% -> %.1f%%' % (old_cpu, new_cpu))
+	return failures
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Loopback streaming benchmark')
+	parser.add_argument('--streams', type=int, default=3)
+	parser.add_argument('--duration', type=float, default=20.0)
+	parser.add_argument('--fps', type=int, default=30)
+	parser.add_argument('--bitrate', type=int, default=2000000, help='bits/s per stream')
+	parser.add_argument('--base-port', type=int, default=18080)
+	parser.add_argument('--latency', type=int, default=200, help='receiver jitter buffer latency (ms), builder.LATENCY by default')
+	parser.add_argument('--source', default='test', help="'test' or file:<raw YUY2 640x480>")
+	parser.add_argument('--software', action='store_true', help='force x265enc/avdec_h265')
+	parser.add_argument('--output', default='bench.json')
+	parser.add_argument('--thresholds', default=os.path.join(os.path.dirname(
+		os.path.abspath(__file__)), 'bench_thresholds.json'))
+	parser.add_argument('--baseline', help='previous results to compare against')
+	parser.add_argument('--tolerance', type=float, default=0.1)
+	# used by the child processes
+	parser.add_argument('--role', choices=('sender', 'receiver'))
+	parser.add_argument('--port', type=int)
+	parser.add_argument('--ports')
+	parser.add_argument('--epoch', type=float)
+	args = parser.parse_args()
+
+	if args.role == 'sender':
+		run_sender(args)
+		return
+	if args.role == 'receiver':
+		run_receiver(args)
+		return
+
+	results = run(args)
+	with open(args.thresholds) as f:
+		thresholds = json.load(f)
+	baseline = None
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+	results['failures'] = check(results, thresholds, baseline, args.tolerance)
+	with open(args.output, 'w') as f:
+		json.dump(results, f, indent=2)
+	print(json.dumps(results, indent=2))
+	if results['failures']:
+		for failure in results['failures']:
+			print('FAIL:', failure)
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,261 @@
+# File: branches.py
+
+# Contains:
+#   Class
+#	StreamBranch class - one incoming camera stream in the receiver pipeline.
+#	The udpsrc and its tee are always in the pipeline, but the udpsrc is only
+#	running (socket open) while something is attached, so packets from cameras
+#	nobody watches are dropped by the kernel. The branch is built in two stages
+#	on demand: depay (jitter buffer, FEC recovery, rtph265depay ! h265parse, for
+#	recorders) and decode (for displays and snapshots). A stage is torn down
+#	once nothing has used it for idle_timeout seconds. close() removes the
+#	stream from a running pipeline. warm() keeps a camera decoding into a
+#	fakesink with nobody watching, so switching a display to it is instant.
+
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GLib
+import builder
+import metrics
+
+
+class StreamBranch:
+	def __init__(self, pipeline, cam, idle_timeout=5, monitor=False, latency=builder.LATENCY, fec=True):
+		# latency - jitter buffer latency (ms), fec - recover packets from ULPFEC
+		# the pipeline needs 'udpsrc name=src_<cam> ! tee name=<cam> allow-not-linked=true'
+		# or, for the single-port transport, just the tee on the demuxer (its
+		# udpsrc is shared and always running, the tee stays when closed)
+		self.pipeline = pipeline
+		self.cam = cam
+		self.idle_timeout = idle_timeout
+		self.monitor = monitor
+		self.latency = latency
+		self.fec = fec
+		self.fecdec = None
+		self.jitterbuffer = None
+		self.src = pipeline.get_by_name('src_' + cam)
+		self.tee = pipeline.get_by_name(cam)
+		self.depay = []
+		self.decode = []
+		self.enc_tee = None
+		self.dec_tee = None
+		self.consumers = {}
+		self.idle_id = None
+		self.warm_sink = None
+		self.stop_src()
+
+
+	def active(self):
+		return len(self.depay) > 0
+
+
+	def decoding(self):
+		return len(self.decode) > 0
+
+
+	def start_src(self):
+		if self.src is None: return
+		self.src.set_locked_state(False)
+		self.src.sync_state_with_parent()
+
+
+	def stop_src(self):
+		# closes the socket, the pipeline leaves a locked element alone
+		if self.src is None: return
+		self.src.set_locked_state(True)
+		self.src.set_state(Gst.State.NULL)
+
+
+	def add_stage(self, descs, upstream):
+		elements = [Gst.parse_launch(d) for d in descs]
+		for e in elements:
+			self.pipeline.add(e)
+		for a, b in zip(elements, elements[1:]):
+			if not a.link(b):
+				print('ERROR:', self.cam, a.get_name(), 'could not be linked to', b.get_name())
+		upstream.link(elements[0])
+		for e in reversed(elements):
+			e.sync_state_with_parent()
+		return elements
+
+
+	def build_depay(self):
+		# config-interval=-1 repeats VPS/SPS/PPS before every IDR so recordings
+		# can start on any keyframe
+		self.depay = self.add_stage(['queue'] + builder.rtp_receive(self.latency, self.fec) +
+			['rtph265depay', 'h265parse config-interval=-1',
+			'tee allow-not-linked=true'], self.tee)
+		self.enc_tee = self.depay[-1]
+		elements = {e.get_factory().get_name(): e for e in self.depay}
+		self.jitterbuffer = elements['rtpjitterbuffer']
+		self.fecdec = elements.get('rtpulpfecdec')
+		if self.fecdec is not None:
+			self.fecdec.set_property('storage', elements['rtpstorage'].get_property('internal-storage'))
+		if self.monitor:
+			metrics.watch_rtp(self, self.cam)
+		print(self.cam + ' depay branch created')
+
+
+	def build_decode(self):
+		self.decode = self.add_stage(['queue', builder.decode(),
+			'tee allow-not-linked=true'], self.enc_tee)
+		self.dec_tee = self.decode[-1]
+		if self.monitor:
+			metrics.watch_pad(self.decode[1].get_static_pad('src'), self.cam, 'decoder')
+			metrics.watch_queue(self.decode[0], self.cam)
+		print(self.cam + ' decode branch created')
+
+
+	def fec_stats(self):
+		# packets lost on the link, and how many of those FEC got back
+		stats = {'lost': 0, 'recovered': 0, 'unrecovered': 0}
+		if self.jitterbuffer is not None:
+			stats['lost'] = self.jitterbuffer.get_property('stats').get_value('num-lost')
+		if self.fecdec is not None:
+			stats['recovered'] = self.fecdec.get_property('recovered')
+			stats['unrecovered'] = self.fecdec.get_property('unrecovered')
+		return stats
+
+
+	def remove_stage(self, elements):
+		for e in elements:
+			e.set_state(Gst.State.NULL)
+			self.pipeline.remove(e)
+		return False
+
+
+	def teardown(self):
+		self.idle_id = None
+		if not any(decoded for tee, pad, decoded in self.consumers.values()) and self.decoding():
+			# the encoded side may still be flowing (recorders), unlink when idle
+			stage = self.decode
+			pad = stage[0].get_static_pad('sink').get_peer()
+			pad.add_probe(Gst.PadProbeType.IDLE, self.probe_unlink,
+				(self.enc_tee, lambda: GLib.idle_add(self.remove_stage, stage)))
+			self.decode = []
+			self.dec_tee = None
+			print(self.cam + ' decode branch removed')
+		if not self.consumers and self.active():
+			if self.src is None:
+				# a shared source keeps running, unlink when idle
+				stage = self.depay
+				pad = stage[0].get_static_pad('sink').get_peer()
+				pad.add_probe(Gst.PadProbeType.IDLE, self.probe_unlink,
+					(self.tee, lambda: GLib.idle_add(self.remove_stage, stage)))
+			else:
+				# with the source stopped nothing is flowing, go straight to NULL
+				self.stop_src()
+				self.tee.unlink(self.depay[0])
+				for pad in list(self.tee.srcpads):
+					self.tee.release_request_pad(pad)
+				self.remove_stage(self.depay)
+			self.depay = []
+			self.enc_tee = None
+			self.fecdec = None
+			self.jitterbuffer = None
+			print(self.cam + ' depay branch removed')
+		return False
+
+
+	def close(self):
+		# take the whole stream out of the pipeline, consumers are unlinked
+		# but left in place for their owners to remove or re-attach
+		if self.idle_id is not None:
+			GLib.source_remove(self.idle_id)
+			self.idle_id = None
+		self.stop_src()
+		if self.src is None and self.active():
+			# a shared source keeps running, get the stream off its tee first
+			for pad in list(self.tee.srcpads):
+				self.tee.release_request_pad(pad)
+		# stop the queues' threads before unlinking anything downstream of them
+		for e in self.depay + self.decode:
+			e.set_state(Gst.State.NULL)
+		for tee, pad, decoded in self.consumers.values():
+			peer = pad.get_peer()
+			if peer is not None:
+				pad.unlink(peer)
+			tee.release_request_pad(pad)
+		self.consumers = {}
+		if self.warm_sink is not None:
+			self.remove_stage([self.warm_sink])
+			self.warm_sink = None
+		self.remove_stage(self.decode + self.depay)
+		if self.src is not None:
+			self.remove_stage([self.tee, self.src])
+		self.depay = []
+		self.decode = []
+		self.enc_tee = None
+		self.dec_tee = None
+		self.fecdec = None
+		self.jitterbuffer = None
+		print(self.cam + ' removed')
+
+
+	def warm(self):
+		# the sink is synced with qos so under load the decoder is told it
+		# is late and skips what it can (avdec drops to reference frames),
+		# the displays take priority
+		if self.warm_sink is not None:
+			return
+		self.warm_sink = Gst.parse_launch('fakesink name=warm_' + self.cam +
+			' sync=true qos=true async=false')
+		self.pipeline.add(self.warm_sink)
+		self.warm_sink.sync_state_with_parent()
+		self.attach(self.warm_sink)
+		print(self.cam + ' kept warm')
+
+
+	def cool(self):
+		if self.warm_sink is None:
+			return
+		sink = self.warm_sink
+		self.warm_sink = None
+		self.detach(sink, lambda: GLib.idle_add(self.remove_stage, [sink]))
+		print(self.cam + ' no longer kept warm')
+
+
+	def attach(self, consumer, decoded=True):
+		# link consumer (its 'sink' pad) to the decoded frames or, for
+		# recorders, to the parsed H.265 access units
+		if not self.active():
+			self.build_depay()
+		if decoded and not self.decoding():
+			self.build_decode()
+		tee = self.dec_tee if decoded else self.enc_tee
+		pad = tee.get_request_pad('src_%u')
+		if pad.link(consumer.get_static_pad('sink')) != Gst.PadLinkReturn.OK:
+			print('ERROR:', consumer.get_name(), 'could not be linked to', self.cam)
+		self.consumers[consumer] = (tee, pad, decoded)
+		if self.src is not None and self.src.is_locked_state():
+			self.start_src()
+		return pad
+
+
+	def attach_later(self, consumer, decoded=True):
+		# attach from the main loop, for use in detach() callbacks
+		GLib.idle_add(lambda: self.attach(consumer, decoded) and False)
+
+
+	def detach(self, consumer, done=None):
+		# done() is called (possibly from a streaming thread) once unlinked
+		if consumer not in self.consumers:
+			return
+		tee, pad, decoded = self.consumers.pop(consumer)
+		# unlink once no buffer is going through the pad
+		pad.add_probe(Gst.PadProbeType.IDLE, self.probe_unlink, (tee, done))
+		if self.idle_id is not None:
+			GLib.source_remove(self.idle_id)
+		self.idle_id = GLib.timeout_add_seconds(self.idle_timeout, self.teardown)
+
+
+	def probe_unlink(self, pad, info, data):
+		tee, done = data
+		peer = pad.get_peer()
+		if peer is not None:
+			pad.unlink(peer)
+		tee.release_request_pad(pad)
+		if done is not None:
+			done()
+		return Gst.PadProbeReturn.REMOVE
@@ -0,0 +1,276 @@
+# File: builder.py
+
+# Contains:
+#   Variables
+#	CAMERAS - camera registry (device, USB path, caps, and the stream name and
+#	udp port it is sent as, see streams())
+#	ENCODERS, DECODERS - H.265 codec profiles, fastest first
+#	FEC_PT, RED_PT - payload types of the FEC and RED packets
+#	LATENCY - default jitter buffer latency (ms)
+#   Functions
+#	chain() - joins pipeline elements into a launch string
+#	streams() - (stream name, udp port) of every camera, for the sender and receivers
+#	camera_source() - source elements for a camera, a raw file or a test pattern
+#	video_devices()/find_device() - the /dev/videoN capture devices by USB path,
+#	cameras are found by their USB port even after coming back under a new number
+#	find_encoder()/find_decoder() - probe the Gst registry once for the fastest
+#	codec available (TX2 hardware codecs on the rover, software on x86)
+#	encode()/decode() - encoder/decoder chains of the chosen profiles
+#	display_convert() - conversion from the chosen decoder to a video sink
+#	recv_source()/recv_sources() - the udpsrc ! tee of a stream for the receivers
+#	(the rest of each stream is added on demand by branches.StreamBranch)
+#	recv_mux()/recv_tee() - the single udpsrc ! rtpssrcdemux of the single-port
+#	transport and the tee of each stream found on it
+#	ssrc()/ssrc_camera() - the fixed SSRC of a camera on the single-port transport
+#	fec_encode() - ULPFEC protection in RED packets after the payloader
+#	rtp_receive() - jitter buffer and FEC recovery in front of the depayloader
+#	select() - force a codec profile by element name (e.g. software codecs)
+#	reset() - forget the probe results (for tests or after loading plugins)
+
+
+import os
+import zlib
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+
+CAMERAS = {
+	'cam2': {	# HD USB Camera
+		'device': '/dev/video1',
+		'usb': 'usb-3530000.xhci-2.2',
+		'caps': 'video/x-raw, framerate=30/1, width=640, height=480',
+		'stream': 'cam1', 'port': 8080},
+	'cam3': {	# Stereo Vision 1
+		'device': '/dev/video3',
+		'usb': 'usb-3530000.xhci-2.3',
+		'caps': 'video/x-raw, format=YUY2, width=640, height=480',
+		'stream': 'cam2', 'port': 8081},
+	'cam4': {	# HD USB Camera
+		'device': '/dev/video4',
+		'usb': 'usb-3530000.xhci-2.4',
+		'caps': 'video/x-raw, width=640, height=480',
+		'stream': 'cam3', 'port': 8082},
+}
+
+THREADS = os.cpu_count() or 1
+
+# 'convert' gets raw frames into the memory the encoder takes ('input' is the
+# raw format that conversion accepts, None for anything), 'keyint' and
+# 'bitrate' are the property names for the keyframe interval and bitrate, and
+# 'bitrate_scale' converts bits/s into the units the element expects
+ENCODERS = [
+	{'element': 'omxh265enc', 'convert': 'nvvidconv', 'input': 'BGRx', 'props': '',
+	 'keyint': 'iframeinterval', 'bitrate': 'bitrate', 'bitrate_scale': 1},
+	{'element': 'nvv4l2h265enc', 'convert': 'nvvidconv ! video/x-raw(memory:NVMM)',
+	 'input': 'BGRx', 'props': 'insert-sps-pps=true', 'keyint': 'iframeinterval', 'bitrate': 'bitrate',
+	 'bitrate_scale': 1},
+	{'element': 'x265enc', 'convert': 'videoconvert ! video/x-raw, format=I420', 'input': None,
+	 'props': 'tune=zerolatency speed-preset=ultrafast option-string="pools=%d"' % THREADS,
+	 'keyint': 'key-int-max', 'bitrate': 'bitrate', 'bitrate_scale': 0.001},
+]
+
+# 'convert' gets decoded frames into system memory for display/appsink
+DECODERS = [
+	{'element': 'omxh265dec', 'convert': 'nvvidconv', 'props': ''},
+	{'element': 'nvv4l2decoder', 'convert': 'nvvidconv', 'props': ''},
+	{'element': 'avdec_h265', 'convert': 'videoconvert', 'props': 'max-threads=%d' % THREADS},
+]
+
+RTP_CAPS = 'application/x-rtp, media=video, clock-rate=90000, encoding-name=H265'
+
+FEC_PT = 122
+RED_PT = 123
+FEC_ELEMENTS = ('rtpulpfecenc', 'rtpredenc', 'rtpulpfecdec', 'rtpreddec', 'rtpstorage')
+LATENCY = 200
+
+_found = {}
+
+
+def chain(*elements):
+	return ' ! '.join(e for e in elements if e)
+
+
+def streams():
+	# in port order, the receivers' panes follow it
+	return sorted(((c['stream'], c['port']) for c in CAMERAS.values()), key=lambda s: s[1])
+
+
+def usb_path(sysfs):
+	# .../3530000.xhci/usb1/1-2/1-2.2/1-2.2:1.0 -> usb-3530000.xhci-2.2, the
+	# bus info v4l2-ctl --list-devices shows
+	parts = os.path.realpath(sysfs).split('/')
+	hub = next((i for i, p in enumerate(parts) if p.startswith('usb') and p[3:].isdigit()), None)
+	interface = next((p for p in reversed(parts) if ':' in p and '-' in p), None)
+	if hub is None or hub == 0 or interface is None:
+		return None
+	return 'usb-' + parts[hub - 1] + '-' + interface.split(':')[0].split('-', 1)[1]
+
+
+def video_devices(root='/sys/class/video4linux'):
+	# usb path -> /dev/videoN of its capture node (index 0)
+	devices = {}
+	try:
+		names = sorted(os.listdir(root))
+	except OSError:
+		return devices
+	for name in names:
+		try:
+			with open(os.path.join(root, name, 'index')) as f:
+				if f.read().strip() != '0': continue
+		except OSError:
+			pass
+		path = usb_path(os.path.join(root, name, 'device'))
+		if path is not None and path not in devices:
+			devices[path] = '/dev/' + name
+	return devices
+
+
+def find_device(cam, devices=None):
+	# None if the camera is unplugged
+	c = CAMERAS[cam]
+	if devices is None: devices = video_devices()
+	if c.get('usb') in devices:
+		return devices[c['usb']]
+	if not devices and os.path.exists(c['device']):
+		# no sysfs (not Linux or no USB cameras), trust the registry
+		return c['device']
+	return None
+
+
+def camera_source(machine=None, cam=None):
+	if machine == 'tx2' and cam in CAMERAS:
+		c = CAMERAS[cam]
+		device = find_device(cam) or c['device']
+		return chain('v4l2src device=' + device, c['caps'])
+	if machine == 'file':
+		if not cam: cam = 'testvideo0'
+		return chain('filesrc location=' + cam + '.raw',
+			'videoparse format=4 width=640 height=480 framerate=30/1')
+	if machine is not None:
+		print('ERROR: unknown camera', machine, cam, '- using videotestsrc')
+	return 'videotestsrc is-live=true'
+
+
+def _probe(kind, profiles):
+	# Gst must be initialised before the registry can be searched
+	if kind not in _found:
+		_found[kind] = None
+		for profile in profiles:
+			if Gst.ElementFactory.find(profile['element']) is not None:
+				_found[kind] = profile
+				print('Using', kind, profile['element'])
+				break
+		if _found[kind] is None:
+			print('ERROR: no H.265', kind, 'available')
+	return _found[kind]
+
+
+def find_encoder():
+	return _probe('encoder', ENCODERS)
+
+
+def find_decoder():
+	return _probe('decoder', DECODERS)
+
+
+def reset():
+	_found.clear()
+
+
+def select(encoder=None, decoder=None):
+	for kind, element, profiles in (('encoder', encoder, ENCODERS), ('decoder', decoder, DECODERS)):
+		if element is None: continue
+		for profile in profiles:
+			if profile['element'] == element:
+				_found[kind] = profile
+				break
+		else:
+			print('ERROR: no', kind, 'profile for', element)
+
+
+def encode(iframeinterval=None, bitrate=None, name='encoder'):
+	# bitrate in bits/s, None keeps the encoder's default
+	enc = find_encoder()
+	props = [enc['element'], 'name=' + name]
+	if enc['props']: props.append(enc['props'])
+	if iframeinterval is not None:
+		props.append('%s=%d' % (enc['keyint'], iframeinterval))
+	if bitrate is not None:
+		props.append('%s=%d' % (enc['bitrate'], bitrate * enc['bitrate_scale']))
+	return chain(enc['convert'], ' '.join(props))
+
+
+def fec_available():
+	# gst-plugins-good 1.14 or later
+	if 'fec' not in _found:
+		_found['fec'] = all(Gst.ElementFactory.find(e) is not None for e in FEC_ELEMENTS)
+		if not _found['fec']:
+			print('ERROR: no ULPFEC/RED elements, streams are not protected')
+	return _found['fec']
+
+
+def fec_encode(percentage=20, name='fec'):
+	# percentage - FEC packets per media packet, 0 for none
+	if not percentage or not fec_available():
+		return ''
+	return chain('rtpulpfecenc name=' + name + ' pt=%d percentage=%d multipacket=true' % (FEC_PT, percentage),
+		'rtpredenc pt=%d distance=0 allow-no-red-blocks=true' % RED_PT)
+
+
+def rtp_receive(latency=LATENCY, fec=True):
+	# element descriptions, the rtpulpfecdec needs the rtpstorage's
+	# 'internal-storage' set as its 'storage' (see branches.StreamBranch);
+	# do-lost tells the FEC decoder which packets to recover
+	elements = [RTP_CAPS]
+	if fec and fec_available():
+		elements.append('rtpstorage size-time=%d' % ((latency + 100) * Gst.MSECOND))
+	elements.append('rtpjitterbuffer latency=%d do-lost=true' % latency)
+	if fec and fec_available():
+		elements += ['rtpreddec pt=%d' % RED_PT, 'rtpulpfecdec pt=%d' % FEC_PT]
+	return elements
+
+
+def decode(name=None):
+	dec = find_decoder()
+	props = [dec['element']]
+	if name is not None: props.append('name=' + name)
+	if dec['props']: props.append(dec['props'])
+	return ' '.join(props)
+
+
+def display_convert():
+	# conversion between the decoder and a video sink
+	return find_decoder()['convert']
+
+
+def recv_tee(cam):
+	return "tee name=" + cam + " allow-not-linked=true"
+
+
+def recv_source(ip, cam, port):
+	# element descriptions, for adding a stream to a running pipeline
+	return ["udpsrc name=src_" + cam + " address=" + ip + " port=" + str(port), recv_tee(cam)]
+
+
+def recv_mux(ip, port):
+	# every camera on one port, rtpssrcdemux needs full RTP caps
+	return ["udpsrc name=src_mux address=" + ip + " port=" + str(port) + " caps=\"" + RTP_CAPS + "\"",
+		"rtpssrcdemux name=demux"]
+
+
+def ssrc(cam):
+	# same on both ends without any negotiation
+	return zlib.crc32(cam.encode()) & 0xffffffff
+
+
+def ssrc_camera(value, names=()):
+	for cam in list(names) + list(CAMERAS):
+		if ssrc(cam) == value:
+			return cam
+	return 'ssrc%08x' % value
+
+
+def recv_sources(ip, streams):
+	# streams - list of (cam, port)
+	return ' '.join(' ! '.join(recv_source(ip, cam, port)) for cam, port in streams)
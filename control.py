@@ -0,0 +1,353 @@
+# File: control.py
+
+# Contains:
+#   Class
+#	ControlServer class - stream control in the sender process, on a TCP port.
+#	Cameras only run while a receiver is subscribed to them, so a receiver pays
+#	for the streams it shows or records and no more. Subscriptions belong to
+#	the connection: when a receiver goes away its cameras are stopped. It can
+#	also ask for a keyframe and cap the resolution of a camera (the rate
+#	controller picks sizes up to that cap).
+#	ControlClient class - the receiver side. request() waits for the reply,
+#	send() doesn't (replies are read from the GLib main loop).
+#	MockReceiver class - subscribes over the control port and counts the RTP
+#	packets reaching its UDP ports, to test a sender over loopback.
+#   Functions
+#	main() - runs the MockReceiver checks against a sender
+
+# Protocol: one JSON object per line each way, every request gets one reply.
+#	{"cmd": "list"}					-> {"ok": true, "cameras": {name: state}}
+#	{"cmd": "subscribe", "camera": "cam1"}		-> {"ok": true, "camera": "cam1", "state": ...}
+#	{"cmd": "unsubscribe", "camera": "cam1"}
+#	{"cmd": "keyframe", "camera": "cam1"}
+#	{"cmd": "resolution", "camera": "cam1", "width": 640, "height": 480}
+#	{"cmd": "status"}				-> {"ok": true, "status": supervisor status}
+#	Errors are {"ok": false, "error": "..."}
+
+# Usage (mock receiver against sender.py --control 9300 --ip 127.0.0.1):
+#	python3 control.py --port 9300 --stream cam1:8080 --stream cam2:8081
+
+
+import sys
+import json
+import time
+import socket
+import select
+import argparse
+from gi.repository import GLib
+import builder
+
+
+class ControlServer:
+	def __init__(self, sup, port=9300, host='0.0.0.0'):
+		# sup - supervisor.Supervisor with the cameras, they are started and
+		# stopped by the subscriptions
+		self.sup = sup
+		self.subscribers = {name: set() for name in sup.entries}
+		self.sizes = {}
+		self.clients = {}	# socket -> [buffer, subscribed cameras]
+		sup.on_launch = self.on_launch
+		self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.server.bind((host, port))
+		self.server.listen(4)
+		self.server.setblocking(False)
+		GLib.io_add_watch(self.server.fileno(), GLib.IO_IN, self.on_connect)
+		print('CONTROL listening on %s:%d' % (host, port))
+
+
+	def on_connect(self, fd, condition):
+		try:
+			conn, addr = self.server.accept()
+		except OSError:
+			return True
+		conn.setblocking(False)
+		self.clients[conn] = [b'', set()]
+		print('CONTROL %s:%d connected' % addr)
+		GLib.io_add_watch(conn.fileno(), GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self.on_data, conn)
+		return True
+
+
+	def on_data(self, fd, condition, conn):
+		try:
+			data = conn.recv(4096)
+		except BlockingIOError:
+			return True
+		except OSError:
+			data = b''
+		if not data:
+			self.disconnect(conn)
+			return False
+		client = self.clients[conn]
+		client[0] += data
+		while b'\n' in client[0]:
+			line, client[0] = client[0].split(b'\n', 1)
+			if not line.strip(): continue
+			try:
+				reply = self.handle(conn, json.loads(line.decode()))
+			except ValueError as e:
+				reply = {'ok': False, 'error': 'bad request: ' + str(e)}
+			except Exception as e:
+				# an exception out of this watch would drop it without disconnect(),
+				# and the client's cameras would stream forever
+				print('ERROR: control request', line[:200], ':', e)
+				reply = {'ok': False, 'error': 'request failed: ' + str(e)}
+			try:
+				conn.sendall((json.dumps(reply) + '\n').encode())
+			except OSError:
+				self.disconnect(conn)
+				return False
+		return True
+
+
+	def disconnect(self, conn):
+		buffer, cameras = self.clients.pop(conn)
+		for name in list(cameras):
+			self.unsubscribe(conn, name)
+		conn.close()
+		print('CONTROL client gone, %d camera(s) released' % len(cameras))
+
+
+	def handle(self, conn, request):
+		if not isinstance(request, dict):
+			return {'ok': False, 'error': 'bad request: not a JSON object'}
+		cmd = request.get('cmd')
+		if cmd == 'list':
+			return {'ok': True, 'cameras': {name: e.state for name, e in self.sup.entries.items()}}
+		if cmd == 'status':
+			return {'ok': True, 'status': self.sup.status()}
+		name = request.get('camera')
+		if not isinstance(name, str) or name not in self.sup.entries:
+			return {'ok': False, 'error': 'unknown camera %s' % name}
+		entry = self.sup.entries[name]
+		if cmd == 'subscribe':
+			self.subscribe(conn, name)
+		elif cmd == 'unsubscribe':
+			self.unsubscribe(conn, name)
+		elif cmd == 'keyframe':
+			if entry.sender is None:
+				return {'ok': False, 'error': '%s is %s' % (name, entry.state)}
+			entry.sender.force_keyframe()
+		elif cmd == 'resolution':
+			try:
+				size = (int(request['width']), int(request['height']))
+			except (KeyError, TypeError, ValueError):
+				return {'ok': False, 'error': 'resolution needs width and height'}
+			self.sizes[name] = size
+			if entry.sender is not None:
+				entry.sender.set_resolution(*size)
+		else:
+			return {'ok': False, 'error': 'unknown command %s' % cmd}
+		return {'ok': True, 'camera': name, 'state': entry.state, 'subscribers': len(self.subscribers[name])}
+
+
+	def subscribe(self, conn, name):
+		self.clients[conn][1].add(name)
+		self.subscribers[name].add(conn)
+		if self.sup.entries[name].state == 'stopped':
+			print('CONTROL %s subscribed, starting' % name)
+			self.sup.launch(self.sup.entries[name])
+
+
+	def unsubscribe(self, conn, name):
+		if conn in self.clients:
+			self.clients[conn][1].discard(name)
+		self.subscribers[name].discard(conn)
+		if not self.subscribers[name] and self.sup.entries[name].state != 'stopped':
+			print('CONTROL %s has no subscribers, stopping' % name)
+			self.sup.stop(name)
+
+
+	def on_launch(self, entry):
+		# a (re)started Sender gets the resolution cap back
+		size = self.sizes.get(entry.name)
+		if size is not None and entry.sender is not None:
+			entry.sender.set_resolution(*size)
+
+
+class ControlClient:
+	def __init__(self, host, port=9300, timeout=2.0):
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+		self.sock = None
+		self.buffer = b''
+		self.watch = None
+		self.on_reply = None	# on_reply(reply) for the replies to send()
+
+
+	def connect(self):
+		if self.sock is not None:
+			return True
+		try:
+			self.sock = socket.create_connection((self.host, self.port), self.timeout)
+		except OSError as e:
+			print('ERROR: control connection to %s:%d failed: %s' % (self.host, self.port, e))
+			self.sock = None
+			return False
+		self.buffer = b''
+		return True
+
+
+	def close(self):
+		if self.watch is not None:
+			GLib.source_remove(self.watch)
+			self.watch = None
+		if self.sock is not None:
+			self.sock.close()
+			self.sock = None
+
+
+	def request(self, cmd, **args):
+		# blocking, the reply dict (or an error reply if the sender can't be reached)
+		if self.watch is not None:
+			return {'ok': False, 'error': 'client is in send() mode'}
+		if not self.connect():
+			return {'ok': False, 'error': 'not connected'}
+		args['cmd'] = cmd
+		try:
+			self.sock.sendall((json.dumps(args) + '\n').encode())
+			while b'\n' not in self.buffer:
+				data = self.sock.recv(4096)
+				if not data: raise ConnectionError('connection closed')
+				self.buffer += data
+		except OSError as e:
+			self.close()
+			return {'ok': False, 'error': str(e)}
+		line, self.buffer = self.buffer.split(b'\n', 1)
+		return json.loads(line.decode())
+
+
+	def send(self, cmd, **args):
+		# from the GLib main loop, doesn't wait for the reply. False if the
+		# sender can't be reached (the subscriptions were lost with the connection)
+		if not self.connect():
+			return False
+		if self.watch is None:
+			self.sock.setblocking(False)
+			self.watch = GLib.io_add_watch(self.sock.fileno(), GLib.IO_IN | GLib.IO_HUP, self.on_data)
+		args['cmd'] = cmd
+		try:
+			self.sock.sendall((json.dumps(args) + '\n').encode())
+		except OSError as e:
+			print('ERROR: control request failed:', e)
+			self.close()
+			return False
+		return True
+
+
+	def on_data(self, fd, condition):
+		try:
+			data = self.sock.recv(4096)
+		except BlockingIOError:
+			return True
+		except OSError:
+			data = b''
+		if not data:
+			print('ERROR: control connection closed by the sender')
+			self.watch = None
+			self.close()
+			return False
+		self.buffer += data
+		while b'\n' in self.buffer:
+			line, self.buffer = self.buffer.split(b'\n', 1)
+			reply = json.loads(line.decode())
+			if not reply.get('ok'):
+				print('ERROR: control:', reply.get('error'))
+			if self.on_reply is not None:
+				self.on_reply(reply)
+		return True
+
+
+class MockReceiver:
+	def __init__(self, host, port, streams, bind='0.0.0.0'):
+		# streams - [(camera, udp port)] the sender sends to
+		self.client = ControlClient(host, port)
+		self.socks = {}
+		for cam, udp in streams:
+			sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			sock.bind((bind, udp))
+			sock.setblocking(False)
+			self.socks[cam] = sock
+
+
+	def count(self, seconds):
+		# packets per camera in the next 'seconds'
+		counts = {cam: 0 for cam in self.socks}
+		cams = {sock: cam for cam, sock in self.socks.items()}
+		end = time.monotonic() + seconds
+		while True:
+			left = end - time.monotonic()
+			if left <= 0: break
+			ready, _, _ = select.select(list(cams), [], [], left)
+			for sock in ready:
+				try:
+					while True:
+						sock.recv(65536)
+						counts[cams[sock]] += 1
+				except BlockingIOError:
+					pass
+		return counts
+
+
+	def drain(self, seconds=0.5):
+		# packets already on their way when a camera was stopped
+		self.count(seconds)
+
+
+	def check(self, settle=2.0, window=2.0):
+		# every camera: nothing before subscribing, packets while subscribed,
+		# a keyframe and a resolution change accepted, nothing after unsubscribing
+		ok = True
+		for cam in self.socks:
+			steps = []
+			before = self.count(window)[cam]
+			steps.append(('idle', before == 0, before))
+			reply = self.client.request('subscribe', camera=cam)
+			steps.append(('subscribe', reply.get('ok', False), reply))
+			self.count(settle)
+			during = self.count(window)[cam]
+			steps.append(('streaming', during > 0, during))
+			reply = self.client.request('keyframe', camera=cam)
+			steps.append(('keyframe', reply.get('ok', False), reply))
+			reply = self.client.request('resolution', camera=cam, width=320, height=240)
+			steps.append(('resolution', reply.get('ok', False), reply))
+			reply = self.client.request('unsubscribe', camera=cam)
+			steps.append(('unsubscribe', reply.get('ok', False), reply))
+			self.drain()
+			after = self.count(window)[cam]
+			steps.append(('stopped', after == 0, after))
+			for step, passed, detail in steps:
+				print('%s %s %s: %s' % ('PASS' if passed else 'FAIL', cam, step, detail))
+				ok = ok and passed
+		return ok
+
+
+	def close(self):
+		self.client.close()
+		for sock in self.socks.values():
+			sock.close()
+
+
+def parse_stream(arg):
+	cam, port = arg.split(':')
+	return cam, int(port)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Mock receiver for the stream control port')
+	parser.add_argument('--host', default='127.0.0.1', help='sender running with --control')
+	parser.add_argument('--port', type=int, default=9300)
+	parser.add_argument('--stream', type=parse_stream, action='append', help='cam:udp port, repeat for every stream')
+	parser.add_argument('--window', type=float, default=2.0, help='seconds to count packets for')
+	args = parser.parse_args()
+	streams = args.stream or builder.streams()
+	mock = MockReceiver(args.host, args.port, streams)
+	ok = mock.check(window=args.window)
+	mock.close()
+	sys.exit(0 if ok else 1)
+
+
+if __name__=='__main__':
+	main()
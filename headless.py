@@ -0,0 +1,263 @@
+# File: headless.py
+
+# Contains:
+#   Class
+#	HeadlessReceiver class - recording server for the always-on ground station
+#	logger. Same streams.StreamManager as receiver.Receiver but no
+#	GTK or X: nothing is decoded, every stream is depayed, parsed and muxed
+#	straight to a file. Recording is started/stopped with SIGUSR1/SIGUSR2 or
+#	with 'start', 'stop' and 'status' lines on a localhost TCP control port.
+#	StreamRecorder class - queue ! h265parse ! splitmuxsink bin linked to the
+#	parsed side of a StreamBranch, writing indexed segments (see segments.py).
+#   Functions
+#	main() - command line entry point
+
+# Usage:
+#	python3 headless.py --ip 192.168.2.0 --dir recordings --control 9200
+#	echo stop | nc 127.0.0.1 9200
+
+
+import os
+import signal
+import socket
+import argparse
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import GObject, Gst, GLib
+import builder
+import streams
+import segments
+import metrics
+
+
+# camera name and udp port of every incoming stream
+STREAMS = builder.streams()
+
+
+class StreamRecorder:
+	def __init__(self, pipeline, branch, location):
+		# location - path of the recording without extension
+		self.pipeline = pipeline
+		self.branch = branch
+		self.location = location
+		self.bin = Gst.parse_bin_from_description(
+			"queue name=vidqueue ! "
+			"h265parse ! " +
+			segments.description(),
+			True)
+		self.writer = segments.SegmentWriter(self.bin.get_by_name('segments'), location)
+		# the first segment starts on a keyframe like the others
+		self.bin.get_by_name('vidqueue').get_static_pad('sink').add_probe(
+			Gst.PadProbeType.BUFFER, self.on_buffer)
+		pipeline.add(self.bin)
+		self.bin.sync_state_with_parent()
+		branch.attach(self.bin, decoded=False)
+		print('Recording ' + branch.cam + ' to ' + location)
+
+
+	def on_buffer(self, pad, info):
+		# the parser repeats the parameter sets before every IDR, so nothing
+		# before the first one is needed
+		if info.get_buffer().has_flags(Gst.BufferFlags.DELTA_UNIT):
+			return Gst.PadProbeReturn.DROP
+		return Gst.PadProbeReturn.REMOVE
+
+
+	def stop(self):
+		# EOS once unlinked so the muxer can finish the file
+		self.branch.detach(self.bin, self.send_eos)
+
+
+	def send_eos(self):
+		self.writer.stop(lambda: GLib.idle_add(self.remove))
+		self.bin.get_by_name('vidqueue').get_static_pad('sink').send_event(Gst.Event.new_eos())
+		return False
+
+
+	def remove(self):
+		self.bin.set_state(Gst.State.NULL)
+		self.pipeline.remove(self.bin)
+		print('Recording saved to ' + self.location)
+		return False
+
+
+class HeadlessReceiver:
+	def __init__(self, pipeline, ip='192.168.2.0', directory='.', cameras=STREAMS, mux_port=None,
+			latency=builder.LATENCY, fec=True):
+		self.directory = directory
+		self.num_recordings = 0
+		self.recorders = {}
+		self.loop = GLib.MainLoop()
+		self.pipeline = None
+		self.launch_pipeline(pipeline)
+		# files are muxed from the parsed stream, no pre-roll rings
+		self.streams = streams.StreamManager(self.pipeline, ip, preroll_seconds=0, latency=latency, fec=fec)
+		self.streams.add_listener(self.on_stream)
+		if mux_port is not None:
+			self.streams.enable_mux(mux_port, [cam for cam, port in cameras])
+		else:
+			for cam, port in cameras:
+				self.streams.add(cam, port)
+		GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, self.on_signal, 'start')
+		GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR2, self.on_signal, 'stop')
+		GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGINT, self.on_signal, 'quit')
+		GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGTERM, self.on_signal, 'quit')
+
+
+	def play(self):
+		self.running = True
+		stream = self.pipeline.set_state(Gst.State.PLAYING)
+		if stream ==  Gst.StateChangeReturn.FAILURE:
+			print('ERROR: Unable to set the pipeline to the playing state')
+		else: print('Set to playing')
+
+
+	def launch_pipeline(self, pipeline):
+		self.pipeline = Gst.parse_launch(pipeline) if pipeline else Gst.Pipeline.new('headless')
+		bus = self.pipeline.get_bus()
+		bus.add_signal_watch()
+		bus.connect('message', self.on_message)
+
+
+	def _shutdown(self):
+		self.pipeline.bus.remove_signal_watch()
+		self.pipeline.set_state(Gst.State.NULL)
+		self.loop.quit()
+
+
+	def on_message(self, bus, message):
+		t = message.type
+		if t == Gst.MessageType.QOS:
+			metrics.on_qos(message, 'headless')
+		elif t == Gst.MessageType.ERROR:
+			err, dbg = message.parse_error()
+			print('ERROR:', message.src.get_name(), ':', err.message)
+			print('debugging info:', dbg)
+			self._shutdown()
+		return True
+
+
+	def start_recording(self):
+		if self.recorders:
+			return
+		self.num_recordings += 1
+		for cam in self.streams.cameras():
+			self.record(cam)
+
+
+	def record(self, cam):
+		location = os.path.join(self.directory, 'video'+str(self.num_recordings - 1)+'_'+cam)
+		self.recorders[cam] = StreamRecorder(self.pipeline, self.streams.branch(cam), location)
+		# rather than wait up to a keyframe interval for the first IDR
+		self.streams.request_keyframe(cam)
+
+
+	def on_stream(self, event, cam):
+		# streams added while recording are recorded too
+		if event == 'added' and self.recorders and cam not in self.recorders:
+			self.record(cam)
+		elif event == 'removed' and cam in self.recorders:
+			# the manager unlinks it, finish the file after that
+			GLib.idle_add(self.recorders.pop(cam).send_eos)
+
+
+	def stop_recording(self):
+		for rec in self.recorders.values():
+			rec.stop()
+		self.recorders = {}
+
+
+	def status(self):
+		fec = ' '.join('%s:lost=%d,recovered=%d,unrecovered=%d' % (cam, s['lost'], s['recovered'], s['unrecovered'])
+			for cam, s in self.streams.fec_stats().items())
+		if not self.recorders: return 'idle ' + fec
+		return 'recording ' + ' '.join(rec.location for rec in self.recorders.values()) + ' ' + fec
+
+
+	def command(self, cmd):
+		if cmd == 'start': self.start_recording()
+		elif cmd == 'stop': self.stop_recording()
+		elif cmd == 'quit':
+			# give the muxers a moment to finish their files
+			self.stop_recording()
+			GLib.timeout_add_seconds(1, self._shutdown)
+		elif cmd != 'status':
+			return 'ERROR: unknown command ' + cmd
+		return self.status()
+
+
+	def on_signal(self, cmd):
+		print('signal:', cmd)
+		self.command(cmd)
+		return True
+
+
+	def listen(self, port):
+		self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.server.bind(('127.0.0.1', port))
+		self.server.listen(4)
+		GLib.io_add_watch(self.server.fileno(), GLib.IO_IN, self.on_connect)
+
+
+	def on_connect(self, fd, condition):
+		conn, addr = self.server.accept()
+		conn.setblocking(False)
+		GLib.io_add_watch(conn.fileno(), GLib.IO_IN | GLib.IO_HUP, self.on_command, conn)
+		return True
+
+
+	def on_command(self, fd, condition, conn):
+		try:
+			data = conn.recv(1024)
+		except OSError:
+			data = b''
+		if not data:
+			conn.close()
+			return False
+		for line in data.decode(errors='replace').splitlines():
+			if not line.strip(): continue
+			try:
+				conn.sendall((self.command(line.strip()) + '\n').encode())
+			except OSError as e:
+				# non-blocking socket, a client that doesn't read its replies is dropped
+				print('ERROR: control reply failed:', e)
+				conn.close()
+				return False
+		return True
+
+
+	def run(self):
+		self.play()
+		self.loop.run()
+
+
+def get_headless_pipeline(ip='192.168.2.0', cameras=STREAMS):
+	return builder.recv_sources(ip, cameras)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Headless recording server')
+	parser.add_argument('--ip', default='192.168.2.0')
+	parser.add_argument('--dir', default='.')
+	parser.add_argument('--control', type=int, default=9200, help='localhost TCP control port')
+	parser.add_argument('--idle', action='store_true', help="don't start recording right away")
+	parser.add_argument('--metrics', type=int, default=9103)
+	parser.add_argument('--mux', type=int, metavar='PORT', help='single-port transport (sender.MUX_PORT)')
+	parser.add_argument('--latency', type=int, default=builder.LATENCY, help='jitter buffer latency (ms)')
+	parser.add_argument('--no-fec', dest='fec', action='store_false', help="don't recover packets from FEC")
+	args = parser.parse_args()
+
+	GObject.threads_init()
+	Gst.init(None)
+	metrics.serve(args.metrics)
+	pipe = get_headless_pipeline(args.ip, () if args.mux else STREAMS)
+	r = HeadlessReceiver(pipe, args.ip, args.dir, mux_port=args.mux, latency=args.latency, fec=args.fec)
+	r.listen(args.control)
+	if not args.idle:
+		r.start_recording()
+	r.run()
+
+
+if __name__=='__main__':
+	main()
@@ -0,0 +1,235 @@
+# File: metrics.py
+
+# Contains:
+#   Class
+#	Counter, Gauge, Histogram classes - metric series with fixed labels. The
+#	streaming threads only do an attribute increment or a bisect per buffer.
+#	Registry class - holds the series and renders them in the Prometheus text
+#	format. Gauges can be callbacks that are only read when scraped (queue
+#	levels, pipeline latency), so they cost nothing on the streaming threads.
+#   Functions
+#	watch_pad() - pad probe counting buffers/bytes and inter-arrival jitter
+#	watch_queue() - queue level gauges
+#	watch_pipeline() - pipeline latency gauge
+#	watch_rtp() - lost/FEC-recovered/unrecovered packet gauges of a StreamBranch
+#	on_qos() - count QoS drops from a bus message (call from on_message)
+#	serve() - serve the registry on http://127.0.0.1:<port>/metrics
+
+
+import time
+import bisect
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+
+# seconds, for inter-arrival intervals
+BUCKETS = (0.005, 0.01, 0.02, 0.033, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+
+def _labels(labels):
+	if not labels: return ''
+	return '{' + ','.join('%s="%s"' % (k, v) for k, v in sorted(labels.items())) + '}'
+
+
+class Counter:
+	kind = 'counter'
+
+	def __init__(self, labels):
+		self.labels = labels
+		self.value = 0
+
+	def lines(self, name):
+		return ['%s%s %s' % (name, _labels(self.labels), self.value)]
+
+
+class Gauge:
+	kind = 'gauge'
+
+	def __init__(self, labels, fn=None):
+		self.labels = labels
+		self.value = 0
+		self.fn = fn
+
+	def lines(self, name):
+		value = self.value
+		if self.fn is not None:
+			try:
+				value = self.fn()
+			except Exception:
+				return []
+		return ['%s%s %s' % (name, _labels(self.labels), value)]
+
+
+class Histogram:
+	kind = 'histogram'
+
+	def __init__(self, labels, buckets=BUCKETS):
+		self.labels = labels
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def lines(self, name):
+		out = []
+		total = 0
+		for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+			total += count
+			labels = dict(self.labels, le=bound)
+			out.append('%s_bucket%s %d' % (name, _labels(labels), total))
+		out.append('%s_sum%s %s' % (name, _labels(self.labels), self.sum))
+		out.append('%s_count%s %d' % (name, _labels(self.labels), self.count))
+		return out
+
+
+class Registry:
+	def __init__(self):
+		self.metrics = {}	# name -> (help, {labels: series})
+		self.lock = threading.Lock()
+
+
+	def _get(self, cls, name, help, labels, **kwargs):
+		key = tuple(sorted(labels.items()))
+		with self.lock:
+			if name not in self.metrics:
+				self.metrics[name] = (help, {})
+			series = self.metrics[name][1]
+			if key not in series:
+				series[key] = cls(labels, **kwargs)
+			return series[key]
+
+
+	def counter(self, name, help, **labels):
+		return self._get(Counter, name, help, labels)
+
+
+	def gauge(self, name, help, fn=None, **labels):
+		gauge = self._get(Gauge, name, help, labels)
+		if fn is not None: gauge.fn = fn
+		return gauge
+
+
+	def histogram(self, name, help, **labels):
+		return self._get(Histogram, name, help, labels)
+
+
+	def render(self):
+		out = []
+		with self.lock:
+			metrics = [(name, help, list(series.values()))
+				for name, (help, series) in sorted(self.metrics.items())]
+		for name, help, series in metrics:
+			if not series: continue
+			out.append('# HELP %s %s' % (name, help))
+			out.append('# TYPE %s %s' % (name, series[0].kind))
+			for s in series:
+				out.extend(s.lines(name))
+		return '\n'.join(out) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def watch_pad(pad, camera, where, registry=REGISTRY):
+	# where - short name of the pad ('udpsink', 'decoder', 'appsink', ...)
+	buffers = registry.counter('gst_buffers_total', 'Buffers through the pad', camera=camera, pad=where)
+	size = registry.counter('gst_bytes_total', 'Bytes through the pad', camera=camera, pad=where)
+	interval = registry.histogram('gst_interarrival_seconds',
+		'Time between buffers on the pad', camera=camera, pad=where)
+	jitter = registry.gauge('gst_jitter_seconds',
+		'Smoothed inter-arrival jitter (RFC 3550)', camera=camera, pad=where)
+	state = [None, None]	# last arrival, last interval
+
+	def probe(pad, info):
+		now = time.monotonic()
+		if info.type & Gst.PadProbeType.BUFFER_LIST:
+			lst = info.get_buffer_list()
+			buffers.value += lst.length()
+			size.value += lst.calculate_size()
+		else:
+			buffers.value += 1
+			size.value += info.get_buffer().get_size()
+		if state[0] is not None:
+			d = now - state[0]
+			interval.observe(d)
+			if state[1] is not None:
+				jitter.value += (abs(d - state[1]) - jitter.value) / 16
+			state[1] = d
+		state[0] = now
+		return Gst.PadProbeReturn.OK
+
+	return pad.add_probe(Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST, probe)
+
+
+def watch_queue(queue, camera, registry=REGISTRY):
+	name = queue.get_name()
+	registry.gauge('gst_queue_level_buffers', 'Buffers waiting in the queue',
+		lambda: queue.get_property('current-level-buffers'), camera=camera, queue=name)
+	registry.gauge('gst_queue_level_bytes', 'Bytes waiting in the queue',
+		lambda: queue.get_property('current-level-bytes'), camera=camera, queue=name)
+
+
+def watch_pipeline(pipeline, name, registry=REGISTRY):
+	def latency():
+		query = Gst.Query.new_latency()
+		if not pipeline.query(query):
+			raise ValueError('latency query failed')
+		live, min_latency, max_latency = query.parse_latency()
+		return min_latency / Gst.SECOND
+	registry.gauge('gst_pipeline_latency_seconds', 'Minimum latency reported by the pipeline',
+		latency, pipeline=name)
+
+
+def watch_rtp(branch, camera, registry=REGISTRY):
+	# counts restart when the branch's depay stage is rebuilt
+	for key, help in (('lost', 'RTP packets the jitter buffer gave up on'),
+			('recovered', 'Lost RTP packets recovered from FEC'),
+			('unrecovered', 'Lost RTP packets FEC could not recover')):
+		registry.gauge('gst_rtp_' + key + '_packets', help,
+			lambda key=key: branch.fec_stats()[key], camera=camera)
+
+
+def on_qos(message, camera, registry=REGISTRY):
+	if message.type != Gst.MessageType.QOS:
+		return
+	fmt, processed, dropped = message.parse_qos_stats()
+	element = message.src.get_name()
+	registry.counter('gst_qos_messages_total', 'QoS messages posted',
+		camera=camera, element=element).value += 1
+	# the message carries running totals for the element
+	registry.gauge('gst_qos_dropped', 'Buffers dropped for QoS (total reported by the element)',
+		camera=camera, element=element).value = dropped
+
+
+class _Handler(BaseHTTPRequestHandler):
+	registry = REGISTRY
+
+	def do_GET(self):
+		if self.path != '/metrics':
+			self.send_error(404)
+			return
+		body = self.registry.render().encode()
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+
+def serve(port=9100, registry=REGISTRY):
+	handler = type('Handler', (_Handler,), {'registry': registry})
+	server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	print('Metrics on http://127.0.0.1:%d/metrics' % port)
+	return server
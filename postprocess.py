@@ -0,0 +1,262 @@
+# File: postprocess.py
+
+# Contains:
+#   Batch post-processing of recordings (video<N>_<cam>.mkv and the segments of
+#   segments.py) on a process pool, one file per worker at a time. Every file
+#   is decoded once, streaming (appsink with a few buffers of backpressure), so
+#   memory stays flat whatever its size, and gives:
+#	- a keyframe index (PTS of every IDR, from the parser)
+#	- motion scores, the mean frame difference over windows of --window seconds
+#	- a thumbnail strip PNG of --thumbs frames spread over the file
+#	- optionally a downscaled proxy .mkv (--proxy HEIGHT)
+#   Results go to <out>/<name>_<hash>.json (and _proxy.mkv, _strip.png), the
+#   start of the content hash keeps recordings with the same name from
+#   different missions apart. Files are identified by a hash of their
+#   contents and skipped when the cache in <out>/cache.json already has them
+#   with the same options (a renamed file is not processed again).
+#   Functions
+#	find_recordings() - the .mkv files under the given paths
+#	content_hash() - sha256 of a file, read in chunks
+#	process() - worker, decodes one file
+#	run() - hashes, skips, and farms the rest out to the pool
+
+# Usage:
+#	python3 postprocess.py recordings/ --out post --thumbs 12 --proxy 240
+#	python3 postprocess.py video0_cam1_00003.mkv --force
+
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing as mp
+import numpy as np
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import Gst, GLib, GdkPixbuf
+import builder
+
+
+THUMB_WIDTH = 160
+THUMB_HEIGHT = 90
+CHUNK = 1024 * 1024
+THREADS = 1	# decoder threads per worker, set by init_worker()
+
+
+def find_recordings(paths):
+	files = []
+	for path in paths:
+		if os.path.isdir(path):
+			for root, dirs, names in os.walk(path):
+				files += [os.path.join(root, n) for n in sorted(names) if n.endswith('.mkv')
+					and not n.endswith('_proxy.mkv')]
+		elif path.endswith('.mkv'):
+			files.append(path)
+	return files
+
+
+def content_hash(path):
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(CHUNK), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+def init_worker(threads):
+	global THREADS
+	THREADS = threads
+	Gst.init(None)
+
+
+def get_pipeline(path, proxy):
+	conv = builder.display_convert()
+	desc = builder.chain(
+		'filesrc location="' + path + '"', 'matroskademux', 'h265parse name=parse',
+		builder.decode(name='dec'), conv if conv != 'videoconvert' else '',
+		'tee name=t')
+	desc += (' t. ! ' + builder.chain('queue', 'videoconvert', 'videoscale',
+		'video/x-raw, format=RGB, width=%d, height=%d, pixel-aspect-ratio=1/1' % (THUMB_WIDTH, THUMB_HEIGHT),
+		'appsink name=frames sync=false max-buffers=4'))
+	if proxy:
+		desc += (' t. ! ' + builder.chain('queue', 'videoscale', 'video/x-raw, height=%d' % proxy,
+			builder.encode(name='proxyenc'), 'h265parse', 'matroskamux',
+			'filesink name=proxy async=false'))
+	return desc
+
+
+def process(job):
+	# worker process, one recording
+	path, out, name, opts = job
+	start = time.monotonic()
+	pipeline = Gst.parse_launch(get_pipeline(path, opts['proxy']))
+	dec = pipeline.get_by_name('dec')
+	if dec.find_property('max-threads') is not None:
+		# the pool already uses every core
+		dec.set_property('max-threads', THREADS)
+	if opts['proxy']:
+		pipeline.get_by_name('proxy').set_property('location', os.path.join(out, name + '_proxy.mkv'))
+
+	keyframes = []
+	def on_parsed(pad, info):
+		buff = info.get_buffer()
+		if not buff.has_flags(Gst.BufferFlags.DELTA_UNIT) and buff.pts != Gst.CLOCK_TIME_NONE:
+			keyframes.append(round(buff.pts / Gst.SECOND, 3))
+		return Gst.PadProbeReturn.OK
+	pipeline.get_by_name('parse').get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, on_parsed)
+
+	sink = pipeline.get_by_name('frames')
+	pipeline.set_state(Gst.State.PAUSED)
+	pipeline.get_state(Gst.CLOCK_TIME_NONE)
+	ok, duration = pipeline.query_duration(Gst.Format.TIME)
+	duration = duration / Gst.SECOND if ok and duration > 0 else None
+	pipeline.set_state(Gst.State.PLAYING)
+
+	step = duration / opts['thumbs'] if duration and opts['thumbs'] else 10.0
+	next_thumb = 0.0
+	thumbs = []
+	motion = []
+	window = None	# [start, sum, count]
+	prev = None
+	frames = 0
+	error = None
+	bus = pipeline.get_bus()
+	while True:
+		sample = sink.emit('try-pull-sample', Gst.SECOND)
+		if sample is None:
+			msg = bus.pop_filtered(Gst.MessageType.ERROR)
+			if msg is not None:
+				error = msg.parse_error()[0].message
+				break
+			if sink.get_property('eos'):
+				break
+			continue
+		buff = sample.get_buffer()
+		t = buff.pts / Gst.SECOND if buff.pts != Gst.CLOCK_TIME_NONE else frames / 30.0
+		ok, info = buff.map(Gst.MapFlags.READ)
+		if not ok: continue
+		try:
+			# the mapped memory is only valid until unmap
+			frame = np.frombuffer(info.data, np.uint8).reshape(THUMB_HEIGHT, THUMB_WIDTH, 3).astype(np.int16)
+		finally:
+			buff.unmap(info)
+		frames += 1
+		if prev is not None:
+			diff = float(np.abs(frame - prev).mean()) / 255
+			if window is None or t - window[0] >= opts['window']:
+				if window is not None:
+					motion.append({'start': round(window[0], 3), 'score': round(window[1] / window[2], 5)})
+				window = [t, 0.0, 0]
+			window[1] += diff
+			window[2] += 1
+		prev = frame
+		if opts['thumbs'] and len(thumbs) < opts['thumbs'] and t >= next_thumb:
+			thumbs.append(frame.astype(np.uint8))
+			next_thumb += step
+	if window is not None and window[2]:
+		motion.append({'start': round(window[0], 3), 'score': round(window[1] / window[2], 5)})
+	pipeline.set_state(Gst.State.NULL)
+
+	result = {'file': path, 'frames': frames, 'duration': duration, 'keyframes': keyframes,
+		'motion': motion, 'motion_mean': round(sum(m['score'] for m in motion) / len(motion), 5) if motion else 0.0,
+		'seconds': round(time.monotonic() - start, 2)}
+	if error is not None:
+		result['error'] = error
+	if thumbs:
+		strip = np.ascontiguousarray(np.concatenate(thumbs, axis=1))
+		location = os.path.join(out, name + '_strip.png')
+		pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(strip.tobytes()),
+			GdkPixbuf.Colorspace.RGB, False, 8, strip.shape[1], strip.shape[0], strip.shape[1] * 3)
+		pixbuf.savev(location, 'png', [], [])
+		result['thumbs'] = location
+	if opts['proxy']:
+		result['proxy'] = os.path.join(out, name + '_proxy.mkv')
+	with open(os.path.join(out, name + '.json'), 'w') as f:
+		json.dump(result, f, indent=1)
+	return result
+
+
+def load_cache(path):
+	try:
+		with open(path) as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {'files': {}, 'done': {}}
+
+
+def save_cache(cache, path):
+	tmp = path + '.tmp'
+	with open(tmp, 'w') as f:
+		json.dump(cache, f)
+	os.replace(tmp, path)
+
+
+def file_hash(cache, path):
+	# only files whose size or mtime changed are hashed again
+	st = os.stat(path)
+	known = cache['files'].get(os.path.abspath(path))
+	if known and known['size'] == st.st_size and known['mtime'] == st.st_mtime:
+		return known['hash']
+	digest = content_hash(path)
+	cache['files'][os.path.abspath(path)] = {'size': st.st_size, 'mtime': st.st_mtime, 'hash': digest}
+	return digest
+
+
+def run(paths, out, workers=None, force=False, **opts):
+	os.makedirs(out, exist_ok=True)
+	cache_path = os.path.join(out, 'cache.json')
+	cache = load_cache(cache_path)
+	signature = json.dumps(opts, sort_keys=True)
+	jobs = []
+	keys = {}
+	for path in find_recordings(paths):
+		digest = file_hash(cache, path)
+		key = digest + ':' + signature
+		if not force and key in cache['done']:
+			print('skip', path, '(done as ' + cache['done'][key] + ')')
+			continue
+		# every recording is video<N>_<cam>..., the hash tells them apart
+		name = os.path.splitext(os.path.basename(path))[0] + '_' + digest[:12]
+		keys[path] = key
+		jobs.append((path, out, name, opts))
+	save_cache(cache, cache_path)
+	if not jobs:
+		return []
+
+	workers = workers or os.cpu_count() or 1
+	threads = max(1, (os.cpu_count() or 1) // workers)
+	results = []
+	# spawn, the parent may have Gst/GLib threads running
+	with mp.get_context('spawn').Pool(min(workers, len(jobs)), init_worker, (threads,)) as pool:
+		for result in pool.imap_unordered(process, jobs):
+			results.append(result)
+			if 'error' in result:
+				print('ERROR:', result['file'], ':', result['error'])
+				continue
+			cache['done'][keys[result['file']]] = result['file']
+			save_cache(cache, cache_path)
+			print('%s: %d frames, %d keyframes, motion %.4f in %.1fs' % (result['file'], result['frames'],
+				len(result['keyframes']), result['motion_mean'], result['seconds']))
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Post-process recordings')
+	parser.add_argument('paths', nargs='+', help='.mkv files or directories')
+	parser.add_argument('--out', default='post')
+	parser.add_argument('--workers', type=int, help='processes (default: all cores)')
+	parser.add_argument('--thumbs', type=int, default=10, help='frames in the thumbnail strip, 0 for none')
+	parser.add_argument('--window', type=float, default=1.0, help='seconds per motion score')
+	parser.add_argument('--proxy', type=int, default=0, metavar='HEIGHT', help='write a downscaled proxy')
+	parser.add_argument('--force', action='store_true', help='ignore the cache')
+	args = parser.parse_args()
+	results = run(args.paths, args.out, args.workers, args.force,
+		thumbs=args.thumbs, window=args.window, proxy=args.proxy)
+	sys.exit(1 if any('error' in r for r in results) else 0)
+
+
+if __name__=='__main__':
+	main()
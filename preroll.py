@@ -0,0 +1,159 @@
+# File: preroll.py
+
+# Contains:
+#   Class
+#	PrerollRing class - always-on in-memory ring of the last N seconds of H.265
+#	access units of one stream (taken from the parsed side of its StreamBranch),
+#	bounded by time and by bytes, with an index of the keyframes in it. Starting
+#	a recording flushes the ring into the new file from a keyframe, so the file
+#	is decodable from its first frame and includes the lead-up to the button
+#	press, then keeps feeding it live access units.
+#	Recorder class - appsrc ! h265parse ! splitmuxsink bin fed by a ring, writing
+#	indexed segments (see segments.py).
+
+
+import time
+import threading
+import collections
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GLib
+import segments
+
+
+class PrerollRing:
+	def __init__(self, pipeline, branch, seconds=10, max_bytes=32 * 1024 * 1024):
+		self.pipeline = pipeline
+		self.seconds = seconds
+		self.max_bytes = max_bytes
+		self.entries = collections.deque()	# (pts, buffer, wall-clock), oldest first
+		self.keys = collections.deque()		# pts of the keyframes in entries
+		self.bytes = 0
+		self.caps = None
+		self.recorders = []
+		self.lock = threading.Lock()
+		self.sink = Gst.parse_launch('appsink emit-signals=true sync=false async=false')
+		self.sink.connect('new-sample', self.on_sample)
+		pipeline.add(self.sink)
+		self.sink.sync_state_with_parent()
+		branch.attach(self.sink, decoded=False)
+
+
+	def close(self):
+		# the branch must have been detached or closed already
+		with self.lock:
+			recorders = self.recorders
+			self.recorders = []
+			self.entries.clear()
+			self.keys.clear()
+			self.bytes = 0
+		for rec in recorders:
+			rec.stop()
+		self.sink.set_state(Gst.State.NULL)
+		self.pipeline.remove(self.sink)
+
+
+	def on_sample(self, sink):
+		sample = sink.emit('pull-sample')
+		buff = sample.get_buffer()
+		if buff.pts == Gst.CLOCK_TIME_NONE:
+			return Gst.FlowReturn.OK
+		now = time.time()
+		with self.lock:
+			self.caps = sample.get_caps()
+			self.entries.append((buff.pts, buff, now))
+			if not buff.has_flags(Gst.BufferFlags.DELTA_UNIT):
+				self.keys.append(buff.pts)
+			self.bytes += buff.get_size()
+			self.trim()
+			recorders = list(self.recorders)
+		for rec in recorders:
+			rec.push(buff, self.caps, now)
+		return Gst.FlowReturn.OK
+
+
+	def trim(self):
+		newest = self.entries[-1][0]
+		while self.entries and (self.bytes > self.max_bytes
+				or newest - self.entries[0][0] > self.seconds * Gst.SECOND):
+			pts, buff, wallclock = self.entries.popleft()
+			self.bytes -= buff.get_size()
+			if self.keys and self.keys[0] <= pts:
+				self.keys.popleft()
+
+
+	def start_recording(self, base, lead=0):
+		# start from the newest keyframe at least 'lead' seconds old (or the
+		# oldest one in the ring), lead=0 is the most recent IDR
+		with self.lock:
+			rec = Recorder(self.pipeline, base)
+			if self.keys:
+				limit = self.entries[-1][0] - lead * Gst.SECOND
+				start = self.keys[0]
+				for pts in self.keys:
+					if pts > limit: break
+					start = pts
+				for pts, buff, wallclock in self.entries:
+					if pts >= start:
+						rec.push(buff, self.caps, wallclock)
+			self.recorders.append(rec)
+		return rec
+
+
+	def stop_recording(self, rec):
+		with self.lock:
+			if rec in self.recorders:
+				self.recorders.remove(rec)
+		rec.stop()
+
+
+class Recorder:
+	def __init__(self, pipeline, location):
+		# location - path of the recording without extension
+		self.pipeline = pipeline
+		self.location = location
+		self.base = None
+		self.base_wallclock = None	# when the first frame of the file was received
+		self.bin = Gst.parse_bin_from_description(
+			"appsrc name=src format=time is-live=true max-bytes=0 ! "
+			"queue ! "
+			"h265parse ! " +
+			segments.description(),
+			False)
+		self.src = self.bin.get_by_name('src')
+		# the file's pts start at zero on the first (possibly pre-rolled) frame
+		self.writer = segments.SegmentWriter(self.bin.get_by_name('segments'), location,
+			lambda pts: self.base_wallclock + pts / Gst.SECOND)
+		pipeline.add(self.bin)
+		self.bin.sync_state_with_parent()
+
+
+	def push(self, buff, caps, wallclock):
+		# the file starts on a keyframe with timestamps starting at zero
+		# wallclock - when the buffer was received
+		if self.base is None:
+			if buff.has_flags(Gst.BufferFlags.DELTA_UNIT):
+				return
+			self.base = buff.pts
+			self.base_wallclock = wallclock
+			self.src.set_property('caps', caps)
+		if buff.pts < self.base:
+			return
+		out = buff.copy()
+		out.pts = buff.pts - self.base
+		if buff.dts != Gst.CLOCK_TIME_NONE:
+			out.dts = max(0, buff.dts - self.base)
+		self.src.emit('push-buffer', out)
+
+
+	def stop(self):
+		# the last segment is finalised, remove the bin from the main loop
+		self.writer.stop(lambda: GLib.idle_add(self.remove))
+		self.src.emit('end-of-stream')
+
+
+	def remove(self):
+		self.bin.set_state(Gst.State.NULL)
+		self.pipeline.remove(self.bin)
+		print('Recording saved to ' + self.location)
+		return False
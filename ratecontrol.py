@@ -0,0 +1,293 @@
+# File: ratecontrol.py
+
+# Contains:
+#   Class
+#	RateController class - attached to a sender.Sender. Every interval it pings
+#	the receiver's LossReporter over a small UDP feedback channel, and from the
+#	packet loss and round trip time in the reply adjusts the encoder bitrate,
+#	and when the bitrate gets low the frame rate and resolution too, without
+#	restarting the pipeline. The FEC percentage follows the loss. Every
+#	adjustment is printed so it can be tuned. Keyframe requests from the
+#	receiver come back on the same channel.
+#	LossReporter class - receiver side of the feedback channel. Counts RTP
+#	packets (by sequence number) on a udpsrc pad and answers each ping with the
+#	loss since the previous ping. request_keyframe() asks the sender for an IDR
+#	(sent to wherever its pings come from).
+#	MuxLossReporter class - the same for a port shared by several streams,
+#	counted per SSRC.
+#	SeqCount class - expected/received RTP packet counts of one stream
+#   Variables
+#	FEEDBACK_OFFSET - the feedback channel of a stream is on its RTP port + offset
+#	LADDER - (bitrate, width, height, fps) steps used as the bitrate drops
+
+
+import json
+import socket
+import time
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GLib
+import builder
+
+
+FEEDBACK_OFFSET = 1000
+
+# lowest bitrate (bits/s) each step is used at, checked top to bottom
+LADDER = [
+	(1500000, 480, 360, 30),
+	(800000, 480, 360, 15),
+	(400000, 320, 240, 15),
+	(0, 320, 240, 10),
+]
+
+
+class RateController:
+	def __init__(self, sender, ip, port, bitrate=2000000, min_bitrate=250000,
+			max_bitrate=4000000, interval=1.0, ssrc=None, fec_min=10, fec_max=50):
+		# ssrc - set when streams share the port (see MuxLossReporter)
+		# fec_min/fec_max - FEC percentage range, followed with the loss
+		self.sender = sender
+		self.ssrc = ssrc
+		self.addr = (ip, int(port) + FEEDBACK_OFFSET)
+		self.bitrate = bitrate
+		self.min_bitrate = min_bitrate
+		self.max_bitrate = max_bitrate
+		self.step = None
+		self.min_rtt = None
+		self.missed = 0
+		self.replied = True
+		self.last_key = 0.0
+		self.encoder = sender.pipeline.get_by_name('encoder')
+		self.scalecaps = sender.pipeline.get_by_name('scalecaps')
+		self.ratecaps = sender.pipeline.get_by_name('ratecaps')
+		self.fec = sender.pipeline.get_by_name('fec')
+		self.fec_min = fec_min
+		self.fec_max = fec_max
+		self.max_size = None	# (width, height) cap asked for by the receiver
+		self.size = None
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.setblocking(False)
+		self.watch = GLib.io_add_watch(self.sock.fileno(), GLib.IO_IN, self.on_reply)
+		self.timer = GLib.timeout_add(int(interval * 1000), self.ping)
+		self.apply('start', 0.0, None)
+
+
+	def close(self):
+		GLib.source_remove(self.watch)
+		GLib.source_remove(self.timer)
+		self.sock.close()
+
+
+	def ping(self):
+		if not self.sender.running:
+			return True
+		# no reply to the last ping, the link is probably dropping everything
+		if not self.replied:
+			self.missed += 1
+			if self.missed >= 3:
+				self.adjust(1.0, None)
+		self.replied = False
+		ping = {'t': time.monotonic()}
+		if self.ssrc is not None: ping['ssrc'] = self.ssrc
+		msg = json.dumps(ping).encode()
+		try:
+			self.sock.sendto(msg, self.addr)
+		except OSError as e:
+			print('ERROR: rate control ping failed:', e)
+		return True
+
+
+	def on_reply(self, fd, condition):
+		try:
+			data, addr = self.sock.recvfrom(2048)
+			report = json.loads(data.decode())
+		except (OSError, ValueError):
+			return True
+		if report.get('key'):
+			self.on_keyframe_request()
+			return True
+		self.replied = True
+		self.missed = 0
+		rtt = time.monotonic() - report['t']
+		self.adjust(report['loss'], rtt)
+		return True
+
+
+	def on_keyframe_request(self):
+		# a receiver switched to this camera, several panes switching at
+		# once only need one IDR
+		now = time.monotonic()
+		if now - self.last_key < 0.2:
+			return
+		self.last_key = now
+		self.sender.force_keyframe()
+
+
+	def set_max_size(self, width, height):
+		# sizes from the ladder are capped to this from now on
+		self.max_size = (width, height)
+		self.step = None
+		self.apply('resize', 0.0, None)
+
+
+	def adjust(self, loss, rtt):
+		if self.fec is not None:
+			# about 5x the loss rate, enough for single losses at 5%
+			self.fec.set_property('percentage', int(min(self.fec_max, max(self.fec_min, loss * 500))))
+		if rtt is not None:
+			if self.min_rtt is None or rtt < self.min_rtt: self.min_rtt = rtt
+		congested = rtt is not None and rtt > 0.1 and rtt > 2 * self.min_rtt
+		if loss > 0.10:
+			bitrate = self.bitrate * 0.7
+		elif loss > 0.02 or congested:
+			bitrate = self.bitrate * 0.9
+		else:
+			bitrate = self.bitrate * 1.08
+		bitrate = int(min(self.max_bitrate, max(self.min_bitrate, bitrate)))
+		if bitrate != self.bitrate:
+			self.bitrate = bitrate
+			self.apply('adjust', loss, rtt)
+
+
+	def apply(self, reason, loss, rtt):
+		enc = builder.find_encoder()
+		if self.encoder is not None:
+			self.encoder.set_property(enc['bitrate'], int(self.bitrate * enc['bitrate_scale']))
+		step = next(s for s in LADDER if self.bitrate >= s[0])
+		if step != self.step:
+			self.step = step
+			bitrate, width, height, fps = step
+			if self.max_size is not None:
+				width, height = min(width, self.max_size[0]), min(height, self.max_size[1])
+			self.size = (width, height)
+			if self.scalecaps is not None:
+				self.scalecaps.set_property('caps', Gst.Caps.from_string(
+					'video/x-raw, width=%d, height=%d' % (width, height)))
+			if self.ratecaps is not None:
+				self.ratecaps.set_property('caps', Gst.Caps.from_string(
+					'video/x-raw, framerate=%d/1' % fps))
+		print('RATE %s %s:%d loss=%.3f rtt=%s bitrate=%d size=%dx%d fps=%d fec=%s' % (
+			reason, self.addr[0], self.addr[1] - FEEDBACK_OFFSET, loss,
+			'-' if rtt is None else '%.0fms' % (rtt * 1000),
+			self.bitrate, self.size[0], self.size[1], self.step[3],
+			'-' if self.fec is None else '%d%%' % self.fec.get_property('percentage')))
+
+
+class SeqCount:
+	# RTP packets expected/received from one sender (one SSRC)
+	def __init__(self):
+		self.received = 0
+		self.max_seq = None
+		self.first_seq = None
+		self.last_expected = 0
+		self.last_received = 0
+
+
+	def count(self, seq):
+		# extended past the 16 bit wrap so expected = highest - first + 1
+		# (RFC 3550 A.3)
+		if self.max_seq is None:
+			self.first_seq = self.max_seq = seq
+		else:
+			delta = (seq - self.max_seq) & 0xffff
+			if delta < 0x8000:
+				self.max_seq += delta
+		self.received += 1
+
+
+	def interval(self):
+		# loss since the previous call
+		expected = 0 if self.max_seq is None else self.max_seq - self.first_seq + 1
+		interval_expected = expected - self.last_expected
+		interval_received = self.received - self.last_received
+		self.last_expected = expected
+		self.last_received = self.received
+		if interval_expected > 0:
+			loss = max(0.0, 1.0 - interval_received / interval_expected)
+		else: loss = 0.0
+		return {'loss': loss, 'expected': interval_expected, 'received': interval_received}
+
+
+class LossReporter(SeqCount):
+	def __init__(self, src, port):
+		# src - the udpsrc receiving the stream, port - its RTP port
+		SeqCount.__init__(self)
+		self.addrs = {}		# ssrc (None without one) -> where its pings come from
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind(('', int(port) + FEEDBACK_OFFSET))
+		self.sock.setblocking(False)
+		self.watch = GLib.io_add_watch(self.sock.fileno(), GLib.IO_IN, self.on_ping)
+		self.pad = src.get_static_pad('src')
+		self.probe = self.pad.add_probe(Gst.PadProbeType.BUFFER, self.probe_rtp)
+
+
+	def close(self):
+		GLib.source_remove(self.watch)
+		self.pad.remove_probe(self.probe)
+		self.sock.close()
+
+
+	def probe_rtp(self, pad, info):
+		# bytes 2-3 of the RTP header are the sequence number
+		self.count(int.from_bytes(info.get_buffer().extract_dup(2, 2), 'big'))
+		return Gst.PadProbeReturn.OK
+
+
+	def stats(self, ping):
+		return self.interval()
+
+
+	def request_keyframe(self, ssrc=None):
+		addr = self.addrs.get(ssrc)
+		if addr is None:
+			# no ping yet, the sender's first frames are keyframes anyway
+			return False
+		try:
+			self.sock.sendto(json.dumps({'key': True}).encode(), addr)
+		except OSError as e:
+			print('ERROR: keyframe request failed:', e)
+			return False
+		return True
+
+
+	def on_ping(self, fd, condition):
+		try:
+			data, addr = self.sock.recvfrom(2048)
+			ping = json.loads(data.decode())
+		except (OSError, ValueError):
+			return True
+		self.addrs[ping.get('ssrc')] = addr
+		reply = self.stats(ping)
+		reply['t'] = ping['t']
+		try:
+			self.sock.sendto(json.dumps(reply).encode(), addr)
+		except OSError as e:
+			print('ERROR: loss report failed:', e)
+		return True
+
+
+class MuxLossReporter(LossReporter):
+	# one udpsrc carrying several streams told apart by SSRC, the senders'
+	# pings name their SSRC
+	def __init__(self, src, port):
+		self.streams = {}
+		LossReporter.__init__(self, src, port)
+
+
+	def probe_rtp(self, pad, info):
+		# bytes 8-11 of the RTP header are the SSRC
+		header = info.get_buffer().extract_dup(0, 12)
+		ssrc = int.from_bytes(header[8:12], 'big')
+		if ssrc not in self.streams:
+			self.streams[ssrc] = SeqCount()
+		self.streams[ssrc].count(int.from_bytes(header[2:4], 'big'))
+		self.received += 1
+		return Gst.PadProbeReturn.OK
+
+
+	def stats(self, ping):
+		stream = self.streams.get(ping.get('ssrc'))
+		if stream is None:
+			return {'loss': 0.0, 'expected': 0, 'received': 0}
+		return stream.interval()
@@ -11,153 +11,281 @@
 # Contains:
 #   Class
 #	Receiver class - inherits from Gtk.Window, creates a Gtk Window to play the
-#	incoming streams played over udp from ip 192.168.2.0 on port 8080-8082. The window
-#	includes two buttons, one for capturing images and one for recording video.
-#	The window also includes 3 radio buttons to switch between the 3 streams.
-#	Switching between streams and recording video is done by dynamic linking/unlinking
-#	as necessary. The images are captured using the Gdk by taking the image from
-#	display converting it to RGB (pixbuf only compatible with RGB) and saving to file.
+#	incoming streams played over udp from ip 192.168.2.0 (STREAMS by default). The
+#	window has a number of display panes, each with a radio button per stream to
+#	switch between them (or 'Off') and two buttons, one for capturing images and
+#	one for recording video. Streams are added and removed at runtime through a
+#	streams.StreamManager, the panes follow. Switching between streams is done by
+#	dynamic linking/unlinking as necessary and recordings are fed from an
+#	in-memory pre-roll ring (see preroll.py), or with --preroll 0 straight from
+#	the stream like headless.py (the streams are then only received while
+#	shown or recorded). The images are captured from the
+#	decoded stream at full resolution and saved to file on a worker thread (see
+#	snapshot.py).
+#	Pane class - one display (queue ! convert ! ximagesink bin) with its buttons.
+#	Switching asks the new camera's sender for a keyframe unless its decoder is
+#	already running (--warm keeps recently shown cameras decoding), and the time
+#	to the first frame on the display is printed and kept in metrics.
+#	With --control the sender is told which cameras are shown or recorded and
+#	only sends those (control.ControlServer).
 #   Functions
-#	get_recv_pipeline() - Gst launch pipeline as a string which receives a stream
-#	from a udpsrc and plays it on ximagesink display. There are two tees in the
-#	pipeline for hooking in the bins for saving images and videos, and three sources
-#	with an input-selector.
+#	get_recv_pipeline() - Gst launch pipeline as a string with the udpsrcs of the
+#	streams. The displays are added by the panes, the depay/decode branch of each
+#	camera (with tees for hooking in the bins for saving images and videos) is
+#	only created while the camera is displayed or recorded, see branches.py.
 
 
 import sys
+import time
+import argparse
 import gi
 gi.require_version('Gst', '1.0')
 gi.require_version('Gtk', '3.0')
 gi.require_version('GdkX11', '3.0')
 gi.require_version('GstVideo', '1.0')
-from gi.repository import GObject, Gst, Gtk, GdkX11, GstVideo, Gdk
+from gi.repository import GObject, Gst, Gtk, GdkX11, GstVideo, GLib
+import builder
+import streams
+import snapshot
+import control
+import headless
+import metrics
+
+
+# camera name and udp port of every incoming stream
+STREAMS = builder.streams()
+
+
+class Pane:
+	def __init__(self, receiver, index):
+		self.receiver = receiver
+		self.name = 'display_' + str(index)
+		self.cam = None		# camera selected
+		self.attached = None	# camera the display is linked to
+		self.pending = False	# waiting for the display to be unlinked
+		self.switch_start = None
+		self.switches = 0
+		self.rec = None
+		self.rec_cam = None
+		self.buttons = {}
+
+		# box for the stream
+		self.vbox = Gtk.VBox()
+
+		# area for video player
+		self.area = Gtk.DrawingArea()
+		self.area.set_size_request(480,360)
+		self.vbox.pack_start(self.area, False, False, 0)
+
+		# box to hold radio buttons for switching between streams
+		self.buttonbox = Gtk.Box()
+		self.vbox.pack_start(self.buttonbox, False, False, 0)
+		self.off_button = Gtk.RadioButton.new_with_label_from_widget(None, 'Off')
+		self.off_button.connect('toggled', self.on_switch, None)
+		self.buttonbox.add(self.off_button)
+
+		# Add space for capture buttons
+		hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
+		self.vbox.pack_start(hbox, False, False, 0)
+		hbox.set_border_width(10)
+
+		# Add Recording and Capture buttons
+		self.record_button = Gtk.Button(label="Start Recording")
+		self.record_button.connect("clicked", self.on_record)
+		hbox.pack_start(self.record_button, False, False, 0)
+		self.snapshot_button = Gtk.Button(label="Take Snapshot")
+		self.snapshot_button.connect("clicked", self.on_snapshot)
+		hbox.pack_end(self.snapshot_button, False, False, 0)
+
+		# display, linked to a camera's decoded tee while the pane shows it
+		pipeline = receiver.pipeline
+		self.bin = Gst.parse_bin_from_description(
+			"queue name=q_"+str(index)+" ! "+builder.display_convert()+" ! "
+			"ximagesink name="+self.name+" async=false",
+			True)
+		pipeline.add(self.bin)
+		self.bin.sync_state_with_parent()
+		metrics.watch_queue(self.bin.get_by_name('q_'+str(index)), self.name)
+
+
+	def add_camera(self, cam):
+		label = 'Camera ' + cam[3:] if cam.startswith('cam') else cam
+		button = Gtk.RadioButton.new_with_label_from_widget(self.off_button, label)
+		button.connect('toggled', self.on_switch, cam)
+		self.buttonbox.add(button)
+		button.show()
+		self.buttons[cam] = button
+
+
+	def remove_camera(self, cam):
+		# the manager has unlinked the display already
+		if self.attached == cam:
+			self.attached = None
+			self.pending = False
+		if self.cam == cam:
+			self.cam = None
+			self.off_button.set_active(True)
+		if self.rec_cam == cam:
+			# closing the stream's ring finishes the file, without one the
+			# manager has unlinked the recorder
+			if isinstance(self.rec, headless.StreamRecorder):
+				GLib.idle_add(self.rec.send_eos)
+			self.rec = None
+			self.rec_cam = None
+			self.record_button.set_label('Start Recording')
+		self.buttonbox.remove(self.buttons.pop(cam))
+
+
+	def on_switch(self, button, cam):
+		# 'toggled' also fires for the button being switched off
+		if not button.get_active():
+			return
+		print(str(cam)+' button pressed on '+self.name)
+		self.show(cam)
+		self.receiver.update_buttons()
+
+
+	def show(self, cam):
+		manager = self.receiver.streams
+		self.cam = cam
+		self.switch_start = time.monotonic()
+		if self.pending or self.attached == cam:
+			# attach() picks up the latest selection
+			return
+		# unlink pipe from previous cam, link to the new one once that is done
+		if self.attached is not None:
+			self.pending = True
+			manager.branch(self.attached).detach(self.bin, lambda: GLib.idle_add(self.attach))
+		else:
+			self.attach()
+
+
+	def attach(self):
+		manager = self.receiver.streams
+		self.pending = False
+		self.attached = None
+		if self.cam is not None and self.cam in manager.streams:
+			branch = manager.branch(self.cam)
+			warm = branch.decoding()
+			branch.attach(self.bin)
+			self.attached = self.cam
+			if not warm:
+				# a new decoder can't show anything before an IDR
+				manager.request_keyframe(self.cam)
+			manager.used(self.cam)
+			self.switches += 1
+			self.bin.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, self.on_first_frame,
+				(self.switches, self.cam, 'warm' if warm else 'cold'))
+		return False
+
+
+	def on_first_frame(self, pad, info, data):
+		# streaming thread, the first decoded frame after a switch
+		switch, cam, mode = data
+		if switch == self.switches and self.switch_start is not None:
+			elapsed = time.monotonic() - self.switch_start
+			metrics.REGISTRY.histogram('receiver_switch_seconds',
+				'Time from a camera switch to its first frame on the display',
+				display=self.name, mode=mode).observe(elapsed)
+			print('SWITCH %s to %s in %.0f ms (%s)' % (self.name, cam, elapsed * 1000, mode))
+		return Gst.PadProbeReturn.REMOVE
+
+
+	def on_record(self, widget):
+		if self.rec is None:
+			if self.cam is None:
+				print(self.name + ': no camera to record')
+				return
+			self.start_recording(self.cam)
+			self.record_button.set_label('Stop Recording')
+		else:
+			self.stop_recording()
+			self.record_button.set_label('Start Recording')
+		self.receiver.update_subscriptions()
+
+
+	def start_recording(self, cam):
+		# the file starts with the pre-roll held in the camera's ring, without
+		# one on the next keyframe of the stream
+		receiver = self.receiver
+		location = 'video'+str(receiver.num_recordings)+'_'+cam
+		self.rec_cam = cam
+		ring = receiver.streams.ring(cam)
+		if ring is not None:
+			self.rec = ring.start_recording(location, lead=receiver.preroll)
+		else:
+			self.rec = headless.StreamRecorder(receiver.pipeline, receiver.streams.branch(cam), location)
+			receiver.streams.request_keyframe(cam)
+		print('Starting Recording on ' + cam + '...')
+		receiver.num_recordings += 1
+
+
+	def stop_recording(self):
+		if isinstance(self.rec, headless.StreamRecorder):
+			self.rec.stop()
+		else:
+			self.receiver.streams.ring(self.rec_cam).stop_recording(self.rec)
+		self.rec = None
+		self.rec_cam = None
+		print('Stopped recording')
+
+
+	def on_snapshot(self, widget):
+		if self.cam is not None:
+			self.receiver.save_image(self.cam, self.name)
 
 
 class Receiver(Gtk.Window):
-	def __init__(self, pipeline):
+	def __init__(self, pipeline, ip='192.168.2.0', cameras=STREAMS, panes=2, columns=2, preroll_seconds=10,
+			mux_port=None, latency=builder.LATENCY, fec=True, warm=0, control_addr=None):
+		# mux_port - every camera on one port, told apart by SSRC (cameras
+		# are then only used to name the SSRCs)
+		# control_addr - (host, port) of the sender's control server
 		# ===== Gtk GUI Setup ===== #
 		Gtk.Window.__init__(self, title='Livestream')
 		self.connect("destroy", Gtk.main_quit)
 		self.set_resizable(False)
-		self.set_default_size(960, 360)
 
-		# box to hold everything
-		container = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+		# grid to hold the panes
+		container = Gtk.Grid()
 		self.add(container)
 
-		# box for each stream
-		vbox_l = Gtk.VBox()
-		vbox_r = Gtk.VBox()
-
-		# area for video player
-		self.area_l = Gtk.DrawingArea()
-		self.area_r = Gtk.DrawingArea()
-		self.area_l.set_size_request(480,360)
-		self.area_r.set_size_request(480,360)
-		#self.area_l.connect('draw', self.on_draw)
-		vbox_l.pack_start(self.area_l, False, False, 0)
-		vbox_r.pack_start(self.area_r, False, False, 0)
-		container.pack_start(vbox_l, True, True, 0)
-		container.pack_start(vbox_r, True, True, 0)
-
-		# box to hold radio buttons for switching between streams
-		self.buttonbox_l = Gtk.Box()
-		self.buttonbox_r = Gtk.Box()
-		vbox_l.pack_start(self.buttonbox_l, False, False, 0)
-		vbox_r.pack_start(self.buttonbox_r, False, False, 0)
-
-		# radio button for camera 1 - left
-		self.cam1_button_l = Gtk.RadioButton.new_with_label_from_widget(None, 'Camera 1')
-		self.cam1_button_l.set_active(True)
-		self.cam1_button_l.connect('toggled', self.on_switch_l, 'cam1')
-		self.buttonbox_l.add(self.cam1_button_l)
-
-		# radio button for camera 2 - left
-		self.cam2_button_l = Gtk.RadioButton.new_with_label_from_widget(self.cam1_button_l, 'Camera 2')
-		self.cam2_button_l.connect('toggled', self.on_switch_l, 'cam2')
-		self.buttonbox_l.add(self.cam2_button_l)
-		self.cam2_button_l.set_sensitive(False)
-
-		# radio button for camera 3 - left
-		self.cam3_button_l = Gtk.RadioButton.new_from_widget(self.cam1_button_l)
-		self.cam3_button_l.set_label('Camera 3')
-		self.cam3_button_l.connect('toggled', self.on_switch_l, 'cam3')
-		self.buttonbox_l.add(self.cam3_button_l)
-
-		# radio button for camera 1 - right
-		self.cam1_button_r = Gtk.RadioButton.new_with_label_from_widget(None, 'Camera 1')
-		self.cam1_button_r.connect('toggled', self.on_switch_r, 'cam1')
-		self.buttonbox_r.add(self.cam1_button_r)
-		self.cam1_button_r.set_sensitive(False)
-
-		# radio button for camera 2 - right
-		self.cam2_button_r = Gtk.RadioButton.new_with_label_from_widget(self.cam1_button_r, 'Camera 2')
-		self.cam2_button_r.set_active(True)
-		self.cam2_button_r.connect('toggled', self.on_switch_r, 'cam2')
-		self.buttonbox_r.add(self.cam2_button_r)
-
-		# radio button for camera 3 - right
-		self.cam3_button_r = Gtk.RadioButton.new_with_label_from_widget(self.cam1_button_r, 'Camera 3')
-		self.cam3_button_r.connect('toggled', self.on_switch_r, 'cam3')
-		self.buttonbox_r.add(self.cam3_button_r)
-
-		# Add space for capture buttons - left
-		hbox_l = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
-		vbox_l.pack_start(hbox_l, False, False, 0)
-		hbox_l.set_border_width(10)
-
-		# Add Recording and Capture buttons - left
-		self.button_l_r = Gtk.Button(label="Start Recording")
-		self.button_l_r.connect("clicked", self.record_button_l)
-		hbox_l.pack_start(self.button_l_r, False, False, 0)
-		self.button_l_c = Gtk.Button(label="Take Snapshot")
-		self.button_l_c.connect("clicked", self.take_snapshot_l)
-		hbox_l.pack_end(self.button_l_c, False, False, 0)
-
-		# Add space for capture buttons - right
-		hbox_r = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
-		vbox_r.pack_start(hbox_r, False, False, 0)
-		hbox_r.set_border_width(10)
-
-		# Add Recording and Capture buttons - right
-		self.button_r_r = Gtk.Button(label="Start Recording")
-		self.button_r_r.connect("clicked", self.record_button_r)
-		hbox_r.pack_start(self.button_r_r, False, False, 0)
-		self.button_r_c = Gtk.Button(label="Take Snapshot")
-		self.button_r_c.connect("clicked", self.take_snapshot_r)
-		hbox_r.pack_end(self.button_r_c, False, False, 0)
-
 		# ===== Create GStreamer Receiver Pipeline ===== #
-		self.count_l = 0
-		self.count_r = 0
 		self.num_snapshots = 0
 		self.num_recordings = 0
-		self.img_bin_l = None
-		self.img_bin_r = None
-		self.rec_bin_l = None
-		self.rec_bin_r = None
-		self.left_unlinked = False
-		self.right_unlinked = False
-		self.del_rec_bin_l = False
-		self.del_rec_bin_r = False
 		self.pipeline = None
 		self.launch_pipeline(pipeline)
-		self.left = 'cam1'
-		self.right = 'cam2'
-		self.ql = self.pipeline.get_by_name('ql')
-		self.qr = self.pipeline.get_by_name('qr')
-		self.t_l1 = self.pipeline.get_by_name('t_l1')
-		self.t_r1 = self.pipeline.get_by_name('t_r1')
-		self.t_l2 = self.pipeline.get_by_name('t_l2')
-		self.t_r2 = self.pipeline.get_by_name('t_r2')
-		self.display_l = self.pipeline.get_by_name('display_l')
-		self.display_r = self.pipeline.get_by_name('display_r')
+		metrics.watch_pipeline(self.pipeline, 'receiver')
+
+		self.panes = [Pane(self, i) for i in range(panes)]
+		self.displays = {pane.name: pane for pane in self.panes}
+		for i, pane in enumerate(self.panes):
+			container.attach(pane.vbox, i % columns, i // columns, 1, 1)
+
+		# the last seconds of every stream are kept in memory so recordings
+		# start on a keyframe and include the lead-up to the button press
+		self.preroll = preroll_seconds
+		self.streams = streams.StreamManager(self.pipeline, ip, preroll_seconds, latency=latency, fec=fec,
+			warm=warm)
+		self.streams.add_listener(self.on_stream)
+		self.snapshots = snapshot.SnapshotEngine(self.pipeline)
+		self.control = None
+		self.subscribed = set()
+		if control_addr is not None:
+			self.control = control.ControlClient(*control_addr)
+			# reconnects and subscribes again if the sender restarted
+			GLib.timeout_add_seconds(2, self.update_subscriptions)
 
 		# ===== Run ===== #
 		self.show_all()
-		self.xid_l = self.area_l.get_property('window').get_xid()
-		self.xid_r = self.area_r.get_property('window').get_xid()
+		for pane in self.panes:
+			pane.xid = pane.area.get_property('window').get_xid()
 		self.play()
+		if mux_port is not None:
+			self.streams.enable_mux(mux_port, [cam for cam, port in cameras])
+		else:
+			for cam, port in cameras:
+				self.add_stream(cam, port)
 
 
 	def play(self):
@@ -169,7 +297,7 @@ class Receiver(Gtk.Window):
 
 
 	def launch_pipeline(self, pipeline):
-		self.pipeline = Gst.parse_launch(pipeline)
+		self.pipeline = Gst.parse_launch(pipeline) if pipeline else Gst.Pipeline.new('receiver')
 		bus = self.pipeline.get_bus()
 		bus.add_signal_watch()
 		bus.enable_sync_message_emission()
@@ -185,6 +313,8 @@ class Receiver(Gtk.Window):
 
 	def on_message(self, bus, message):
 		t = message.type
+		if t == Gst.MessageType.QOS:
+			metrics.on_qos(message, 'receiver')
 		if 'vidqueue' in message.src.get_name():
 			struct_name = message.get_structure().get_name()
 			print(message.src.get_name(), struct_name)
@@ -194,7 +324,7 @@ class Receiver(Gtk.Window):
 			print('debugging info:', dbg)
 			self._shutdown()
 		elif t == Gst.MessageType.EOS:
-			print('EOS: ', message.src.get_name(), ':', err.message)
+			print('EOS: ', message.src.get_name())
 			print('End-Of-Stream reached')
 			self._shutdown()
 		else:
@@ -206,275 +336,116 @@ class Receiver(Gtk.Window):
 		struct_name = msg.get_structure().get_name()
 		if struct_name == 'prepare-window-handle':
 			msg.src.set_property('force-aspect-ratio', True)
-			if msg.src.get_name() == 'display_l':
-				msg.src.set_window_handle(self.xid_l)
-			else: msg.src.set_window_handle(self.xid_r)
+			pane = self.displays.get(msg.src.get_name())
+			if pane is not None:
+				msg.src.set_window_handle(pane.xid)
 
 
-	#def on_draw(self):
+	def add_stream(self, cam, port):
+		# safe while PLAYING, the panes get a button for it
+		return self.streams.add(cam, port)
 
 
-	def save_image(self, cam, side):
-		if side == 'left': window = self.area_l.get_window()
-		else: window = self.area_r.get_window()
-		pixbuf = Gdk.pixbuf_get_from_window(window, 0, 0, 480, 360)
-		pixbuf.savev('image'+str(self.num_snapshots)+'_'+cam+'.png', 'png', [], [])
-		print(cam+' ('+side+') captured using GUI')
-
-
-	def on_switch_l(self, button, cam):
-		print(cam+' button pressed')
-		prev_cam_tee = self.pipeline.get_by_name(self.left)
-
-		# unlink pipe from previous cam
-		self.ql.get_static_pad('src').add_probe(Gst.PadProbeType.BLOCK, self.probe_block_switch_l)
-		prev_cam_tee.unlink(self.ql)
-		self.left_unlinked = True
-		if self.left == 'cam1': self.cam1_button_r.set_sensitive(True)
-		elif self.left == 'cam2': self.cam2_button_r.set_sensitive(True)
-		elif self.left == 'cam3': self.cam3_button_r.set_sensitive(True)
-
-		# link pipe to new cam
-		new_cam_tee = self.pipeline.get_by_name(cam)
-		new_cam_tee.link(self.ql)
-		self.left_unlinked = False
-		self.left = cam
-		if cam == 'cam1': self.cam1_button_r.set_sensitive(False)
-		elif cam == 'cam2': self.cam2_button_r.set_sensitive(False)
-		elif cam == 'cam3': self.cam3_button_r.set_sensitive(False)
-
-
-	def on_switch_r(self, button, cam):
-		print(cam+' button pressed')
-		prev_cam_tee = self.pipeline.get_by_name(self.right)
-
-		# unlink pipe from previous cam
-		self.qr.get_static_pad('src').add_probe(Gst.PadProbeType.BLOCK, self.probe_block_switch_r)
-		prev_cam_tee.unlink(self.qr)
-		self.right_unlinked = True
-		if self.right == 'cam1': self.cam1_button_l.set_sensitive(True)
-		elif self.right == 'cam2': self.cam2_button_l.set_sensitive(True)
-		elif self.right == 'cam3': self.cam3_button_l.set_sensitive(True)
-
-		# link pipe to new cam
-		new_cam_tee = self.pipeline.get_by_name(cam)
-		new_cam_tee.link(self.qr)
-		self.right_unlinked = False
-		self.right = cam
-		if cam == 'cam1': self.cam1_button_l.set_sensitive(False)
-		elif cam == 'cam2': self.cam2_button_l.set_sensitive(False)
-		elif cam == 'cam3': self.cam3_button_l.set_sensitive(False)
-
-
-	def probe_block_switch_l(self, pad, info):
-		if self.left_unlinked:
-			return Gst.PadProbeReturn.REMOVE
-		else:
-			return Gst.PadProbeReturn.DROP
+	def remove_stream(self, cam):
+		self.streams.remove(cam)
 
 
-	def probe_block_switch_r(self, pad, info):
-		if self.right_unlinked:
-			return Gst.PadProbeReturn.REMOVE
+	def on_stream(self, event, cam):
+		if event == 'added':
+			for pane in self.panes:
+				pane.add_camera(cam)
+			# show it in the first pane that is off
+			for pane in self.panes:
+				if pane.cam is None:
+					pane.buttons[cam].set_active(True)
+					break
 		else:
-			return Gst.PadProbeReturn.DROP
-
-
-	def del_bin(self, side):
-		if side == 'left':
-			if self.del_rec_bin_l:
-				print('deleting left vidbin')
-				self.rec_bin_l.set_state(Gst.State.NULL)
-				del self.rec_bin_l
-				self.rec_bin_l = None
-		else:
-			if self.del_rec_bin_r:
-				print('deleting right vidbin')
-				self.rec_bin_r.set_state(Gst.State.NULL)
-				del self.rec_bin_r
-				self.rec_bin_r = None
-
-
-	def record_button_l(self, widget):
-		if self.button_l_r.get_label() == 'Start Recording':
-			self.button_l_r.set_label('Stop Recording')
-			self.start_recording_l('vidqueue_l', self.left)
-		else:
-			self.stop_recording_l()
-			self.button_l_r.set_label('Start Recording')
-
-
-	def record_button_r(self, widget):
-		if self.button_r_r.get_label() == 'Start Recording':
-			self.button_r_r.set_label('Stop Recording')
-			self.start_recording_r('vidqueue_r', self.right)
-		else:
-			self.stop_recording_r()
-			self.button_r_r.set_label('Start Recording')
-
-
-	def start_recording_l(self, queue_name, cam):
-		self.del_bin('left')
-		location = 'video'+str(self.num_recordings)+'_'+cam+'.mkv'
-		self.rec_bin_l = Gst.parse_bin_from_description(
-			"queue name="+queue_name+" flush-on-eos=true ! "
-			"h265parse ! "
-			"matroskamux ! "
-			"filesink location="+location+" async=false ",
-			True)
-		if not self.pipeline.add(self.rec_bin_l):
-			print('left record pipe could not be added')
-		if not self.t_l1.link(self.rec_bin_l):
-			print('left record pipe could not be linked with tee')
-		self.rec_bin_l.set_state(Gst.State.PLAYING)
-		vidqueue = self.pipeline.get_by_name(queue_name)
-		vidqueue.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, self.vid_probe_buff)
-		print('Starting Recording on ' + cam + '...')
-		self.num_recordings += 1
-
-
-	def vid_probe_buff(self, pad, buffer):
-		return Gst.PadProbeReturn.PASS
-
-
-	def start_recording_r(self, queue_name, cam):
-		self.del_bin('right')
-		location = 'video'+str(self.num_recordings)+'_'+cam+'.mkv'
-		recbin = ("queue name="+queue_name+" flush-on-eos=true ! "
-			"h265parse ! "
-			"matroskamux ! "
-			"filesink location="+location+" async=false ")
-		self.rec_bin_r = Gst.parse_bin_from_description(recbin, True)
-		if not self.pipeline.add(self.rec_bin_r):
-			print('right record pipe could not be added')
-		if not self.t_r1.link(self.rec_bin_r):
-			print('right record pipe could not be linked')
-		self.rec_bin_r.set_state(Gst.State.PLAYING)
-		print('Starting Recording on ' + cam + '...')
-		self.num_recordings += 1
-
+			for pane in self.panes:
+				pane.remove_camera(cam)
+		self.update_buttons()
+
+
+	def update_buttons(self):
+		# a camera can only be shown in one pane at a time
+		for pane in self.panes:
+			for cam, button in pane.buttons.items():
+				button.set_sensitive(not any(other.cam == cam for other in self.panes if other is not pane))
+		self.update_subscriptions()
+
+
+	def update_subscriptions(self):
+		# the sender only sends the cameras on screen or being recorded
+		if self.control is None:
+			return False
+		wanted = set(p.cam for p in self.panes if p.cam is not None)
+		wanted |= set(p.rec_cam for p in self.panes if p.rec_cam is not None)
+		if self.control.sock is None:
+			# subscriptions go with the connection
+			self.subscribed = set()
+		for cam in sorted(wanted - self.subscribed):
+			if not self.control.send('subscribe', camera=cam):
+				return True
+			self.subscribed.add(cam)
+		for cam in sorted(self.subscribed - wanted):
+			if not self.control.send('unsubscribe', camera=cam):
+				return True
+			self.subscribed.discard(cam)
+		return True
 
-	def stop_recording_l(self):
-		vidqueue = self.rec_bin_l.get_by_name('vidqueue_l')
-		vidqueue.get_static_pad('src').add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM, self.probe_block_rec_l)
-		print('Stopped recording')
 
+	def save_image(self, cam, side):
+		# next decoded frame of the camera, encoded and saved off the main thread
+		location = 'image'+str(self.num_snapshots)+'_'+cam+'.png'
+		self.snapshots.take(self.streams.branch(cam), location,
+			lambda location, ok: self.on_image_saved(location, ok, cam, side))
+		self.num_snapshots += 1
 
-	def stop_recording_r(self):
-		vidqueue = self.rec_bin_r.get_by_name('vidqueue_r')
-		vidqueue.get_static_pad('src').add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM, self.probe_block)
-		if not self.t_r1.unlink(self.rec_bin_r):
-			print('right recording pipe could not be unlinked')
-		vidqueue.get_static_pad('sink').send_event(Gst.Event.new_eos())
-		self.del_rec_bin_r = True
-		print('Stopped recording')
 
+	def on_image_saved(self, location, ok, cam, side):
+		if ok: print(cam+' ('+side+') captured to '+location)
+		else: print(cam+' ('+side+') capture failed')
+		return False
 
-	def probe_block_rec_l(self, pad, buffer):
-		print('left rec blocked')
-		if not self.t_l1.unlink(self.rec_bin_l):
-			print('left recording pipe could not be unlinked')
-		vidqueue = self.rec_bin_l.get_by_name('vidqueue_l')
-		vidqueue.get_static_pad('sink').send_event(Gst.Event.new_eos())
-		self.del_rec_bin_l = True
-		return Gst.PadProbeReturn.DROP
-
-
-	def probe_block(self, pad, buffer):
-		print('blocked')
-		return Gst.PadProbeReturn.DROP
-
-
-	def take_snapshot_l(self, widget):
-		self.save_image(self.left, 'left')
-		#location = 'image' + str(self.num_snapshots) + '_' + self.left + '.jpeg'
-		#self.img_bin_l = Gst.parse_bin_from_description(
-		#	"queue name=imgqueue_l ! "
-		#	"nvvidconv ! "
- 		#	"jpegenc ! "
-		#	"filesink location="+location+" async=false",
-		#	True)
-		#if not self.pipeline.add(self.img_bin_l):
-		#	print('left img_bin not added to pipeline')
-		#if not self.t_l2.link(self.img_bin_l):
-		#	print('tee was notlinked with left img_bin')
-		#self.count_l = 0
-		#imgqueue = self.pipeline.get_by_name('imgqueue_l')
-		#self.img_bin_l.set_state(Gst.State.PLAYING)
-		#imgqueue.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, self.img_probe_block_l)
-		self.num_snapshots += 1
 
-
-	def take_snapshot_r(self, widget):
-		self.save_image(self.right, 'right')
-		#location = 'image' + str(self.num_snapshots) + '_' + self.right + '.jpeg'
-		#self.img_bin_r = Gst.parse_bin_from_description(
-		#	"queue name=imgqueue_r ! "
-		#	"nvvidconv ! "
-		#	"jpegenc ! "
-		#	"filesink location="+location+" async=false",
-		#	True)
-		#if not self.pipeline.add(self.img_bin_r):
-		#	print('right img_bin not added to pipeline')
-		#if not self.t_r2.link(self.img_bin_r):
-		#	print('right tee was not linked with img_bin')
-		#self.count_r = 0
-		#imgqueue = self.pipeline.get_by_name('imgqueue_r')
-		#self.img_bin_r.set_state(Gst.State.PLAYING)
-		#imgqueue.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, self.img_probe_block_r)
-		self.num_snapshots += 1
+def parse_stream(arg):
+	cam, port = arg.split(':')
+	return cam, int(port)
 
 
-	#def img_probe_block_l(self, pad, buffer):
-	#	if self.count_l == 0:
-	#		self.count_l += 1
-	#		return Gst.PadProbeReturn.PASS
-	#	else:
-	#		imgqueue = self.pipeline.get_by_name('imgqueue_l')
-	#		imgqueue.get_static_pad('src').add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM, self.probe_block)
-	#		self.t_l2.unlink(self.img_bin_l)
-	#		imgqueue.get_static_pad('sink').send_event(Gst.Event.new_eos())
-	#		print('Captured: Left')
-	#		#return Gst.PadProbeReturn.DROP
-	#		return Gst.PadProbeReturn.REMOVE
-
-
-	#def img_probe_block_r(self, pad, buffer):
-	#	if self.count_r == 0:
-	#		self.count_r += 1
-	#		return Gst.PadProbeReturn.PASS
-	#	else:
-	#		imgqueue = self.pipeline.get_by_name('imgqueue_r')
-	#		imgqueue.get_static_pad('src').add_probe(Gst.PadProbeType.BLOCK_DOWNSTREAM, self.probe_block)
-	#		self.t_r2.unlink(self.img_bin_r)
-	#		imgqueue.get_static_pad('sink').send_event(Gst.Event.new_eos())
-	#		print('Captured: Right')
-	#		return Gst.PadProbeReturn.REMOVE
+def parse_control(arg):
+	host, port = arg.rsplit(':', 1)
+	return host, int(port)
 
 
 def main():
+	parser = argparse.ArgumentParser(description='Receiver GUI')
+	parser.add_argument('--ip', default='192.168.2.0')
+	parser.add_argument('--stream', type=parse_stream, action='append',
+		help='cam:port, repeat for every stream (default: '+' '.join(c+':'+str(p) for c, p in STREAMS)+')')
+	parser.add_argument('--panes', type=int, default=2)
+	parser.add_argument('--mux', type=int, metavar='PORT', help='single-port transport (sender.MUX_PORT)')
+	parser.add_argument('--latency', type=int, default=builder.LATENCY, help='jitter buffer latency (ms)')
+	parser.add_argument('--no-fec', dest='fec', action='store_false', help="don't recover packets from FEC")
+	parser.add_argument('--warm', type=int, default=0, help='recently shown cameras to keep decoding')
+	parser.add_argument('--preroll', type=int, default=10, metavar='SECONDS',
+		help='seconds of every stream kept for recordings, 0 for none (streams are then only received while used)')
+	parser.add_argument('--control', type=parse_control, metavar='HOST:PORT',
+		help='sender control port, only the cameras shown or recorded are sent')
+	args = parser.parse_args()
+
 	GObject.threads_init()
 	Gst.init(None)
-	pipe = get_recv_pipeline()
-	r = Receiver(pipe)
+	metrics.serve(9101)
+	pipe = get_recv_pipeline(args.ip)
+	r = Receiver(pipe, args.ip, args.stream or STREAMS, args.panes, preroll_seconds=args.preroll, mux_port=args.mux,
+		latency=args.latency, fec=args.fec, warm=args.warm, control_addr=args.control)
 	Gtk.main()
 
 
-def get_recv_pipeline(ip='192.168.2.0'):
-	return ("udpsrc address="+ip+" port=8080 ! tee name=cam1 ! "
-		"queue name=ql ! application/x-rtp ! rtph265depay ! "
-		"tee name=t_l1 ! queue ! h265parse ! omxh265dec ! "
-		"tee name=t_l2 ! queue ! nvvidconv ! ximagesink name=display_l "
-		"cam1. ! queue silent=true ! fakesink async=false "
-
-		"udpsrc address="+ip+" port=8081 ! tee name=cam2 ! "
-		"queue name=qr ! application/x-rtp ! rtph265depay ! "
-		"tee name=t_r1 ! queue ! h265parse ! omxh265dec ! "
-		"tee name=t_r2 ! queue ! nvvidconv ! ximagesink name=display_r "
-		"cam2. ! queue silent=true ! fakesink async=false "
-
-		"udpsrc address="+ip+" port=8082 ! tee name=cam3 ! "
-		"queue silent=true ! fakesink async=false ")
+def get_recv_pipeline(ip='192.168.2.0', cameras=()):
+	# only the sockets are static (and may be left out), the displays are
+	# added by the panes and the depay/decode branches by branches.StreamBranch
+	return builder.recv_sources(ip, cameras)
 
 
 if __name__=='__main__':
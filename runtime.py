@@ -0,0 +1,307 @@
+# File: runtime.py
+
+# Contains:
+#   Class
+#	Runtime class - runs pipelines, frames, timers and a control port from one
+#	asyncio event loop. Every pipeline bus is read through its poll fd (no GLib
+#	signal watch), so bus messages are awaitable without a GLib main loop. Code
+#	still built on GLib sources (the Sender/Receiver classes, supervisor.py,
+#	ratecontrol.py, ...) keeps working: a single GLib main loop runs on a helper
+#	thread and call_glib() runs a function on it and awaits the result;
+#	submit() goes the other way, from a GLib or worker thread into the loop.
+#	Pipeline class - a Gst pipeline owned by the Runtime: non-blocking state
+#	changes (play(), pause(), stop(), set_state()), awaitable bus messages and
+#	async iterators over messages and appsink samples.
+#   Functions
+#	run() - run a coroutine with a Runtime
+
+# Usage:
+#	async def main(rt):
+#		cam = rt.add_pipeline('cam1', sender.get_pipeline('file', 'testvideo1', port=8080))
+#		await cam.play()
+#		rt.serve_control(9300, {'status': lambda args: 'up'})
+#		await cam.wait_eos()
+#	runtime.run(main)
+
+
+import asyncio
+import threading
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GLib
+
+
+class Pipeline:
+	def __init__(self, runtime, name, pipeline):
+		# pipeline - a Gst.Pipeline or a launch description
+		self.runtime = runtime
+		self.name = name
+		if isinstance(pipeline, str):
+			pipeline = Gst.parse_launch(pipeline)
+		self.pipeline = pipeline
+		self.error = None
+		# on_message(message) - every bus message, on the event loop thread
+		self.on_message = None
+		self.waiters = []	# (filter, future)
+		self.queues = []	# (filter, asyncio.Queue)
+		self.bus = pipeline.get_bus()
+		self.fd = self.bus.get_pollfd().fd
+		runtime.loop.add_reader(self.fd, self.on_bus)
+
+
+	def get_by_name(self, name):
+		return self.pipeline.get_by_name(name)
+
+
+	def on_bus(self):
+		# event loop thread, the fd is readable while messages are queued
+		while True:
+			message = self.bus.pop()
+			if message is None:
+				return
+			self.dispatch(message)
+
+
+	def dispatch(self, message):
+		if message.type == Gst.MessageType.ERROR:
+			err, dbg = message.parse_error()
+			if self.on_message is None:
+				print('ERROR:', self.name, message.src.get_name(), ':', err.message)
+			self.error = err.message
+		if self.on_message is not None:
+			self.on_message(message)
+		for waiter in list(self.waiters):
+			match, future = waiter
+			if future.done():
+				self.waiters.remove(waiter)
+			elif match(message):
+				self.waiters.remove(waiter)
+				future.set_result(message)
+			elif message.type == Gst.MessageType.ERROR:
+				# nothing this pipeline waits for comes after an error
+				self.waiters.remove(waiter)
+				future.set_exception(RuntimeError(self.name + ': ' + self.error))
+		for match, queue in self.queues:
+			if match(message):
+				queue.put_nowait(message)
+
+
+	def wait_for(self, match):
+		# future for the next message match(message) accepts, call before the
+		# action that causes it so it can't be missed
+		future = self.runtime.loop.create_future()
+		self.waiters.append((match, future))
+		return future
+
+
+	async def wait(self, types, timeout=None):
+		# next message of the given Gst.MessageType(s)
+		return await asyncio.wait_for(self.wait_for(lambda m: m.type & types), timeout)
+
+
+	async def wait_eos(self):
+		return await self.wait(Gst.MessageType.EOS)
+
+
+	async def messages(self, types=Gst.MessageType.ANY):
+		# async iterator over bus messages
+		queue = asyncio.Queue()
+		entry = (lambda m: m.type & types, queue)
+		self.queues.append(entry)
+		try:
+			while True:
+				yield await queue.get()
+		finally:
+			self.queues.remove(entry)
+
+
+	async def set_state(self, state, timeout=10.0):
+		# the state change itself can block (opening a v4l2 device, ...), it runs
+		# on the loop's executor, an ASYNC change completes with the pipeline's
+		# STATE_CHANGED message
+		pipeline = self.pipeline
+		changed = self.wait_for(lambda m: m.type == Gst.MessageType.STATE_CHANGED
+			and m.src == pipeline and m.parse_state_changed()[1] == state)
+		ret = await self.runtime.loop.run_in_executor(None, pipeline.set_state, state)
+		if ret == Gst.StateChangeReturn.FAILURE:
+			changed.cancel()
+			raise RuntimeError('%s: unable to set the pipeline to %s' % (self.name, state.value_nick))
+		if ret == Gst.StateChangeReturn.ASYNC:
+			await asyncio.wait_for(changed, timeout)
+		else:
+			changed.cancel()
+		return ret
+
+
+	async def play(self):
+		return await self.set_state(Gst.State.PLAYING)
+
+
+	async def pause(self):
+		return await self.set_state(Gst.State.PAUSED)
+
+
+	async def stop(self):
+		ret = await self.set_state(Gst.State.NULL)
+		self.close()
+		return ret
+
+
+	def close(self):
+		self.runtime.loop.remove_reader(self.fd)
+		# a restarted pipeline may already be registered under the same name
+		if self.runtime.pipelines.get(self.name) is self:
+			del self.runtime.pipelines[self.name]
+
+
+	async def samples(self, name='appsink', size=1):
+		# async iterator over the samples of an appsink. new-sample fires on the
+		# streaming thread, the sample is handed to the loop and the oldest one is
+		# dropped when the consumer falls 'size' behind
+		loop = self.runtime.loop
+		queue = asyncio.Queue(size)
+		sink = self.pipeline.get_by_name(name)
+		sink.set_property('emit-signals', True)
+
+		def put(sample):
+			if queue.full():
+				queue.get_nowait()
+			queue.put_nowait(sample)
+
+		def on_sample(sink):
+			loop.call_soon_threadsafe(put, sink.emit('pull-sample'))
+			return Gst.FlowReturn.OK
+
+		handler = sink.connect('new-sample', on_sample)
+		try:
+			while True:
+				yield await queue.get()
+		finally:
+			sink.disconnect(handler)
+
+
+class Runtime:
+	def __init__(self, loop=None, glib=True):
+		# glib - run a GLib main loop on a helper thread for GLib based code
+		Gst.init(None)
+		self.loop = loop or asyncio.get_event_loop()
+		self.pipelines = {}
+		self.servers = []
+		self.glib = GLib.MainLoop() if glib else None
+		self.glib_thread = None
+		if self.glib is not None:
+			self.glib_thread = threading.Thread(target=self.glib.run, daemon=True)
+			self.glib_thread.start()
+
+
+	def add_pipeline(self, name, pipeline):
+		if name in self.pipelines:
+			print('ERROR: pipeline', name, 'already exists')
+			return self.pipelines[name]
+		p = Pipeline(self, name, pipeline)
+		self.pipelines[name] = p
+		return p
+
+
+	def call_glib(self, fn, *args):
+		# run fn(*args) on the GLib main loop thread, awaitable for its result
+		if self.glib is None:
+			raise RuntimeError('runtime started without a GLib main loop')
+		future = self.loop.create_future()
+
+		def call():
+			try:
+				result = fn(*args)
+			except Exception as e:
+				self.loop.call_soon_threadsafe(future.set_exception, e)
+			else:
+				self.loop.call_soon_threadsafe(future.set_result, result)
+			return False
+
+		GLib.idle_add(call)
+		return future
+
+
+	def submit(self, coro):
+		# from any other thread: schedule a coroutine on the event loop, the
+		# concurrent.futures.Future can be waited on with result()
+		return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+	def every(self, seconds, fn, *args):
+		# timer task calling fn(*args) (a function or a coroutine function) every
+		# 'seconds' until it returns False or the task is cancelled
+		async def tick():
+			while True:
+				await asyncio.sleep(seconds)
+				result = fn(*args)
+				if asyncio.iscoroutine(result):
+					result = await result
+				if result is False:
+					return
+		return self.loop.create_task(tick())
+
+
+	def serve_control(self, port, commands, host='127.0.0.1'):
+		# line based TCP control like headless.py: a line is 'command args...',
+		# commands[command](args) returns (or, as a coroutine, resolves to) the
+		# reply line
+		async def on_client(reader, writer):
+			try:
+				while True:
+					line = await reader.readline()
+					if not line:
+						break
+					words = line.decode(errors='replace').split()
+					if not words: continue
+					handler = commands.get(words[0])
+					if handler is None:
+						reply = 'ERROR: unknown command ' + words[0]
+					else:
+						try:
+							reply = handler(words[1:])
+							if asyncio.iscoroutine(reply):
+								reply = await reply
+						except Exception as e:
+							reply = 'ERROR: ' + str(e)
+					writer.write((str(reply) + '\n').encode())
+					await writer.drain()
+			except ConnectionError:
+				pass
+			finally:
+				writer.close()
+
+		async def start():
+			server = await asyncio.start_server(on_client, host, port)
+			self.servers.append(server)
+			return server
+		return self.loop.create_task(start())
+
+
+	async def play_all(self):
+		# every pipeline changes state at the same time
+		return await asyncio.gather(*(p.play() for p in self.pipelines.values()))
+
+
+	async def close(self):
+		for server in self.servers:
+			server.close()
+			await server.wait_closed()
+		await asyncio.gather(*(p.stop() for p in list(self.pipelines.values())),
+			return_exceptions=True)
+		if self.glib is not None:
+			self.glib.quit()
+
+
+def run(main, glib=True):
+	# main(runtime) is the coroutine function to run, pipelines are stopped after it
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	rt = Runtime(loop, glib)
+	try:
+		return loop.run_until_complete(main(rt))
+	except KeyboardInterrupt:
+		pass
+	finally:
+		loop.run_until_complete(rt.close())
+		loop.close()
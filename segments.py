@@ -0,0 +1,144 @@
+# File: segments.py
+
+# Contains:
+#   Class
+#	SegmentWriter class - recordings as a series of Matroska segments of
+#	bounded duration/size (splitmuxsink cuts on keyframes, so each segment is
+#	playable on its own and a crash loses at most the open one), with an index
+#	file <base>.index next to them: one JSON line per segment with its file,
+#	the PTS of its first frame and the wall-clock time of that frame (from its
+#	PTS, so segments flushed from a pre-roll ring get the time they were
+#	captured, not the time they were written).
+#   Functions
+#	description() - the splitmuxsink for a recorder bin
+#	read_index() - the entries of an index file
+#	find() - the segment (and offset into it) holding a wall-clock time
+
+# Segments are <base>_00000.mkv, <base>_00001.mkv, ...
+
+
+import os
+import json
+import time
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+
+SEGMENT_SECONDS = 60
+SEGMENT_BYTES = 256 * 1024 * 1024
+
+
+def description(name='segments', seconds=SEGMENT_SECONDS, max_bytes=SEGMENT_BYTES):
+	return 'splitmuxsink name=%s max-size-time=%d max-size-bytes=%d' % (
+		name, seconds * Gst.SECOND, max_bytes)
+
+
+class SegmentWriter:
+	def __init__(self, sink, base, wallclock=None):
+		# sink - the splitmuxsink, base - path of the recording without extension
+		# wallclock(pts) - wall-clock seconds of a buffer. By default the pts
+		# are taken as live: the first buffer is now and the rest follow it
+		self.base = base
+		self.wallclock = wallclock
+		self.anchor = None	# (pts, wall-clock) of the first buffer
+		self.last_pts = None	# end of the last buffer, for the end record
+		self.stopping = False
+		self.done = None
+		it = sink.iterate_sink_pads()
+		while True:
+			ok, pad = it.next()
+			if ok != Gst.IteratorResult.OK: break
+			pad.add_probe(Gst.PadProbeType.BUFFER, self.probe_buffer)
+		self.index = open(base + '.index', 'w')
+		sink.set_property('muxer', Gst.ElementFactory.make('matroskamux', None))
+		# our own filesink, to see the EOS of the last segment
+		filesink = Gst.ElementFactory.make('filesink', None)
+		filesink.set_property('async', False)
+		filesink.get_static_pad('sink').add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self.probe_eos)
+		sink.set_property('sink', filesink)
+		sink.connect('format-location-full', self.on_segment)
+
+
+	def probe_buffer(self, pad, info):
+		buff = info.get_buffer()
+		if buff.pts != Gst.CLOCK_TIME_NONE:
+			if self.anchor is None:
+				self.anchor = (buff.pts, time.time())
+			duration = buff.duration if buff.duration != Gst.CLOCK_TIME_NONE else 0
+			self.last_pts = buff.pts + duration
+		return Gst.PadProbeReturn.OK
+
+
+	def to_wallclock(self, pts):
+		if pts is None:
+			return time.time()
+		if self.wallclock is not None:
+			return self.wallclock(pts)
+		if self.anchor is None:
+			return time.time()
+		return self.anchor[1] + (pts - self.anchor[0]) / Gst.SECOND
+
+
+	def on_segment(self, sink, fragment, sample):
+		# streaming thread, a new segment starts with this sample (a keyframe)
+		location = '%s_%05d.mkv' % (self.base, fragment)
+		pts = None
+		if sample is not None:
+			buff = sample.get_buffer()
+			if buff is not None and buff.pts != Gst.CLOCK_TIME_NONE:
+				pts = buff.pts
+		self.write({'segment': os.path.basename(location), 'fragment': fragment,
+			'pts': pts, 'wallclock': self.to_wallclock(pts)})
+		return location
+
+
+	def write(self, entry):
+		if self.index.closed: return
+		self.index.write(json.dumps(entry) + '\n')
+		# flushed every line, the index is only useful if it survives a crash
+		self.index.flush()
+
+
+	def stop(self, done=None):
+		# call before sending EOS, done() is called from the streaming thread
+		# once the last segment is finalised
+		self.stopping = True
+		self.done = done
+
+
+	def probe_eos(self, pad, info):
+		# every segment ends with an EOS, the last one after stop()
+		if info.get_event().type == Gst.EventType.EOS and self.stopping:
+			self.write({'end': True, 'wallclock': self.to_wallclock(self.last_pts)})
+			self.index.close()
+			if self.done is not None:
+				self.done()
+			return Gst.PadProbeReturn.REMOVE
+		return Gst.PadProbeReturn.OK
+
+
+def read_index(path):
+	entries = []
+	with open(path) as f:
+		for line in f:
+			line = line.strip()
+			if not line: continue
+			try:
+				entries.append(json.loads(line))
+			except ValueError:
+				# a line cut short by a crash
+				break
+	return entries
+
+
+def find(entries, wallclock):
+	# (segment file, seconds into it) or None if the time wasn't recorded
+	segments = [e for e in entries if 'segment' in e]
+	ends = [e['wallclock'] for e in segments[1:]]
+	end = next((e['wallclock'] for e in entries if e.get('end')), None)
+	ends.append(end if end is not None else float('inf'))
+	for entry, until in zip(segments, ends):
+		if entry['wallclock'] <= wallclock < until:
+			return entry['segment'], wallclock - entry['wallclock']
+	return None
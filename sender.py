@@ -8,29 +8,89 @@
 
 # Contains:
 #   Class
-#	Sender class - The Sender class sends the camera feed over UDP.
+#	Sender class - The Sender class sends the camera feed over UDP. The bitrate,
+#	frame rate and size can follow the link quality (see ratecontrol.py), and
+#	a receiver can ask for a keyframe when it switches to the camera.
 #   Functions
 #	get_pipeline() - Gst launch commands in a string for different cameras on the TX2
-#	run() - to run the pipelines
+#	(camera registry and codec selection in builder.py)
+#	build() - the Sender of a camera, on its own port or on MUX_PORT
+#	start() - build and play it, the bus read by a GLib signal watch
+#	start_async() - the same on a runtime.Runtime: the bus is read from the
+#	event loop (runtime.Pipeline) and the state change is awaited
+#	shared_socket() - the one UDP socket of the single-port transport
+#	run() - to run the pipelines under a supervisor.Supervisor
+#	run_async() - the same from a runtime.Runtime (start_async()), with a TCP
+#	control port
+#	The cameras start at the same time (supervisor.Supervisor.start_all) and
+#	each prints a STARTUP line with its time-to-first-packet breakdown
+#	(startup.py).
+#	With --control PORT the cameras only run while a receiver subscribes to
+#	them (control.ControlServer)
+#   Variables
+#	MUX_PORT - send every camera to this one port with its own SSRC (the receiver
+#	demultiplexes them, see streams.StreamManager.enable_mux), None for a port
+#	per camera
+#	TEST_VIDEOS - file sent as each stream while the cameras aren't connected
 
 
 import sys
+import argparse
+import threading
 import gi
 gi.require_version('Gst', '1.0')
-from gi.repository import Gst, GObject, GLib
-from time import sleep
+gi.require_version('GstVideo', '1.0')
+from gi.repository import Gst, GObject, GLib, Gio, GstVideo
+import builder
+import ratecontrol
+import metrics
+import supervisor
+import startup
+
+
+MUX_PORT = None
+
+# test videos sent as each stream until the cameras are connected
+TEST_VIDEOS = {'cam1': 'testvideo1', 'cam2': 'testvideo0', 'cam3': 'testvideo2'}
+
+_socket = None
+_socket_lock = threading.Lock()	# the Senders start on their own threads
+
+
+def shared_socket():
+	global _socket
+	with _socket_lock:
+		if _socket is None:
+			_socket = Gio.Socket.new(Gio.SocketFamily.IPV4, Gio.SocketType.DATAGRAM, Gio.SocketProtocol.UDP)
+			_socket.bind(Gio.InetSocketAddress.new_from_string('0.0.0.0', 0), True)
+	return _socket
 
 
 class Sender():
-	def __init__(self, pipeline):
+	def __init__(self, pipeline, timer=None, watch=True):
+		# timer - startup.StartupTimer, stages up to the first packet sent
+		# watch=False leaves the bus to a runtime.Pipeline (see start_async())
 		self.running = False
 		self.pipeline = None
+		self.rate = None
+		self.camera = None
+		self.timer = timer
+		self.watch = watch
+		self.runtime = None	# runtime.Pipeline reading the bus when not watched
+		# on_stopped(sender, reason) - called after an error or EOS shut it down
+		self.on_stopped = None
 		self.launch_pipeline(pipeline)
+		if timer is not None:
+			timer.mark('built')
+			timer.watch_source(self.pipeline)
+			timer.watch_pad(self.pipeline.get_by_name('encoder').get_static_pad('src'), 'encoded')
+			timer.watch_pad(self.pipeline.get_by_name('udpsink').get_static_pad('sink'), 'sent')
 		#self.play()
 
 	def play(self):
 		self.running = True
 		stream = self.pipeline.set_state(Gst.State.PLAYING)
+		if self.timer is not None: self.timer.mark('set_state')
 		if stream ==  Gst.StateChangeReturn.FAILURE:
 			print('ERROR: Unable to set the pipeline to the playing state')
 		else: print('Set to playing')
@@ -44,90 +104,234 @@ class Sender():
 
 	def launch_pipeline(self, pipeline):
 		self.pipeline = Gst.parse_launch(pipeline)
+		if not self.watch:
+			return
 		bus = self.pipeline.get_bus()
 		bus.add_signal_watch()
 		bus.connect('message', self.on_message)
-		global ref
-		ref+=1
+
+	def bus_message(self, message):
+		# a message read by the runtime.Pipeline, handled on the GLib main loop
+		# like the ones of the signal watch
+		self.on_message(None, message)
+		return False
+
+	def share_socket(self):
+		# send from the socket every Sender shares, before play()
+		udpsink = self.pipeline.get_by_name('udpsink')
+		udpsink.set_property('socket', shared_socket())
+		udpsink.set_property('close-socket', False)
+
+	def force_keyframe(self):
+		# next frame out of the encoder is an IDR, for a receiver switching
+		# to this camera
+		event = GstVideo.video_event_new_upstream_force_key_unit(Gst.CLOCK_TIME_NONE, True, 0)
+		self.pipeline.get_by_name('encoder').get_static_pad('src').send_event(event)
+
+	def set_resolution(self, width, height):
+		# largest size to send, the rate controller stays below it
+		if self.rate is not None:
+			self.rate.set_max_size(width, height)
+			return
+		scalecaps = self.pipeline.get_by_name('scalecaps')
+		scalecaps.set_property('caps', Gst.Caps.from_string(
+			'video/x-raw, width=%d, height=%d' % (width, height)))
+
+	def enable_rate_control(self, ip, port, **kwargs):
+		# adapt bitrate/fps/size to the loss and rtt reported by the receiver
+		self.rate = ratecontrol.RateController(self, ip, port, **kwargs)
+
+	def enable_metrics(self, camera):
+		# counters for what leaves the encoder and the socket, see metrics.py
+		self.camera = camera
+		metrics.watch_pad(self.pipeline.get_by_name('encoder').get_static_pad('src'), camera, 'encoder')
+		metrics.watch_pad(self.pipeline.get_by_name('udpsink').get_static_pad('sink'), camera, 'udpsink')
+		metrics.watch_pipeline(self.pipeline, camera)
 
 	def on_message(self, bus, message):
 		t = message.type
-		if t == Gst.MessageType.ERROR:
+		if t == Gst.MessageType.QOS and self.camera is not None:
+			metrics.on_qos(message, self.camera)
+		elif t == Gst.MessageType.STATE_CHANGED and self.timer is not None:
+			self.timer.on_message(message, self.pipeline)
+		elif t == Gst.MessageType.ERROR:
 			err, dbg = message.parse_error()
 			print('ERROR:', message.src.get_name(), ':', err.message)
 			print('debugging info:', dbg)
 			self._shutdown()
+			if self.on_stopped is not None: self.on_stopped(self, err.message)
 		elif t == Gst.MessageType.EOS:
 			print('End-Of-Stream reached')
 			self._shutdown()
+			if self.on_stopped is not None: self.on_stopped(self, 'EOS')
 		else:
 		       pass #print('ERROR: Unexpected message received')
 		return True
 
 	def _shutdown(self):
 		print('Shutting down pipeline')
-		self.pipeline.bus.remove_signal_watch()
+		self.running = False
+		if self.watch:
+			self.pipeline.bus.remove_signal_watch()
+		elif self.runtime is not None:
+			self.runtime.runtime.loop.call_soon_threadsafe(self.runtime.close)
+			self.runtime = None
 		self.pipeline.set_state(Gst.State.NULL)
-		global ref
-		ref-=1
-
-
-def get_pipeline(machine=None, cam=None, ip='192.168.2.0', port='8080'):
-	if machine == 'tx2':
-		if cam == 'cam2':
-			device_n_caps = ('v4l2src device=/dev/video1 ! '
-					'video/x-raw, framerate=30/1, width=640, height=480 ! '
-					)
-		elif cam == 'cam3':	#Stereo Vision 1 (usb-3530000.xhci-2.3)
-			device_n_caps = ('v4l2src device=/dev/video3 ! '
-					'video/x-raw, format=YUY2, width=640, height=480 ! '
-					)
-		elif cam == 'cam4':	#HD USB Camera (usb-3530000.xhci-2.4)
-			device_n_caps = ('v4l2src device=/dev/video4 ! '
-					'video/x-raw, width=640, height=480 ! ')
-
-	elif machine == 'file':
-		if cam == "": cam = 'testvideo0'
-		device_n_caps = ('filesrc location=' + cam + '.raw ! videoparse format=4 '
-				 'width=640 height=480 framerate=30/1 ! ')
-
-	if device_n_caps is None:
-		device_n_caps = 'videotestsrc ! '
-
-	return (device_n_caps +
-		'videoscale ! video/x-raw, width=480, height=360 ! '
-		'timeoverlay ! '
-		'nvvidconv ! '
-		'omxh265enc iframeinterval=10 ! '
-		'rtph265pay ! '
-		'udpsink host=' + ip + ' port=' + port)
-
-
-def run():
-	GObject.threads_init()
-	Gst.init(None)
+		if self.rate is not None:
+			self.rate.close()
+			self.rate = None
+
 
-	pipe = get_pipeline('file', 'testvideo1', port='8080')
-	#pipe = get_pipeline('tx2', 'cam2', port='8080')
-	cam = Sender(pipe)
+def get_pipeline(machine=None, cam=None, ip='192.168.2.0', port='8080', ssrc=None, fec=20, source=None):
+	# cameras and codecs come from builder.py, the encoder is the fastest one
+	# this machine has (omx/nvv4l2 on the TX2, x265enc elsewhere)
+	# ssrc - fixed SSRC for streams sharing a port (builder.ssrc())
+	# fec - percentage of ULPFEC packets, 0 for none. Lost packets are mostly
+	# recovered by the receiver so keyframes can be further apart
+	# source - elements in place of the camera (bench.py's appsrc)
+	return builder.chain(
+		source or builder.camera_source(machine, cam),
+		# named so ratecontrol.py can change the size and frame rate while playing
+		'videoscale', 'capsfilter name=scalecaps caps="video/x-raw, width=480, height=360"',
+		'videorate', 'capsfilter name=ratecaps caps="video/x-raw, framerate=30/1"',
+		'timeoverlay',
+		builder.encode(iframeinterval=30 if fec else 10),
+		# parameter sets with every IDR, so a receiver can start on any of them
+		'rtph265pay config-interval=-1' + ('' if ssrc is None else ' ssrc=%d' % ssrc),
+		builder.fec_encode(fec),
+		'udpsink name=udpsink host=' + ip + ' port=' + str(port))
+
+
+def build(machine, source, name, port, ip='192.168.2.0', watch=True):
+	# port per camera, or MUX_PORT for all of them. (Sender, port, ssrc)
+	timer = startup.StartupTimer(name, 'sent')
+	if MUX_PORT is None:
+		return Sender(get_pipeline(machine, source, ip, port), timer, watch), port, None
+	ssrc = builder.ssrc(name)
+	cam = Sender(get_pipeline(machine, source, ip, MUX_PORT, ssrc), timer, watch)
+	cam.share_socket()
+	return cam, MUX_PORT, ssrc
+
+
+def start(machine, source, name, port, ip='192.168.2.0'):
+	cam, port, ssrc = build(machine, source, name, port, ip)
 	cam.play()
+	cam.enable_rate_control(ip, port, ssrc=ssrc)
+	cam.enable_metrics(name)
+	return cam
+
 
-	pipe2 = get_pipeline('file', 'testvideo0', port='8081')
-	#pipe2 = get_pipeline('tx2', 'cam3', port='8081')
-	cam2 = Sender(pipe2)
-	cam2.play()
-	#sleep(0.5)
-	#cam2.pause()
+async def start_async(rt, machine, source, name, port, ip='192.168.2.0'):
+	# on the runtime's event loop: bus messages are read from the bus fd and
+	# handed to the Sender on the GLib loop, where the supervisor lives
+	cam, port, ssrc = build(machine, source, name, port, ip, watch=False)
+	cam.runtime = rt.add_pipeline(name, cam.pipeline)
+	cam.runtime.on_message = lambda message: GLib.idle_add(cam.bus_message, message)
+	cam.running = True
+	try:
+		await cam.runtime.play()
+	except Exception:
+		cam._shutdown()
+		raise
+	cam.timer.mark('set_state')
+	print('Set to playing')
+	cam.enable_rate_control(ip, port, ssrc=ssrc)
+	cam.enable_metrics(name)
+	return cam
 
-	pipe3 = get_pipeline('file', 'testvideo2', port='8082')
-	#pipe3 = get_pipeline('tx2', 'cam4', port='8082')
-	cam3 = Sender(pipe3)
-	cam3.play()
+
+def run(ip='192.168.2.0', control_port=None):
+	# control_port - TCP port for control.ControlServer, the cameras then wait for
+	# a receiver to subscribe instead of all starting now
+	GObject.threads_init()
+	Gst.init(None)
+	metrics.serve(9100)
+
+	sup = supervise(ip)
+	if control_port is None:
+		sup.start_all()
+	else:
+		import control
+		server = control.ControlServer(sup, control_port)
 
 	GLib.MainLoop().run()
-	#while ref>0: sleep(0.5)
+
+
+def supervise(ip='192.168.2.0', start=start):
+	# restarted on errors and when a camera is plugged back in
+	# streams and ports from builder.CAMERAS
+	# start(machine, source, name, port, ip) -> playing Sender, on a worker thread
+	sup = supervisor.Supervisor()
+	for cam, c in builder.CAMERAS.items():
+		name, port = c['stream'], str(c['port'])
+		sup.add(name, lambda name=name, port=port: start('file', TEST_VIDEOS[name], name, port, ip))
+		#sup.add(name, lambda cam=cam, name=name, port=port: start('tx2', cam, name, port, ip), cam=cam)
+	return sup
+
+
+def run_async(ip='192.168.2.0', control=9300, control_port=None):
+	# the supervisor lives on the runtime's GLib thread. The Senders' buses,
+	# their state changes and the control port are on the event loop:
+	# 'status', 'stop <cam>', 'start <cam>', 'quit'.
+	# control_port - as for run(), the receivers' control.ControlServer
+	import json
+	import asyncio
+	import runtime
+
+	async def main(rt):
+		metrics.serve(9100)
+
+		def start_on_runtime(*args):
+			# the supervisor's start thread waits for start_async() on the loop
+			return rt.submit(start_async(rt, *args)).result()
+
+		sup = await rt.call_glib(supervise, ip, start_on_runtime)
+		if control_port is None:
+			await rt.call_glib(sup.start_all)
+		else:
+			import control as c
+			await rt.call_glib(c.ControlServer, sup, control_port)
+		quit = asyncio.Event()
+
+		async def stop(args):
+			await rt.call_glib(sup.stop, args[0])
+			return 'stopped ' + args[0]
+
+		async def restart(args):
+			entry = sup.entries[args[0]]
+			if entry.state != 'stopped':
+				return 'ERROR: ' + args[0] + ' is ' + entry.state
+			await rt.call_glib(sup.launch, entry)
+			return 'started ' + args[0]
+
+		def leave(args):
+			quit.set()
+			return 'bye'
+
+		async def status(args):
+			return json.dumps(await rt.call_glib(sup.status))
+
+		rt.serve_control(control, {'status': status, 'stop': stop, 'start': restart, 'quit': leave})
+		await quit.wait()
+		for name in sup.entries:
+			await rt.call_glib(sup.stop, name)
+
+	runtime.run(main)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Camera sender')
+	parser.add_argument('--ip', default='192.168.2.0', help='receiver address')
+	parser.add_argument('--control', type=int, metavar='PORT',
+		help='start cameras only when a receiver subscribes on this TCP port')
+	parser.add_argument('--async', dest='use_async', action='store_true',
+		help='run from an asyncio runtime with a text control port (9300)')
+	args = parser.parse_args()
+	if args.use_async and args.control == 9300:
+		parser.error('--async uses port 9300 for its text control port, give --control another one')
+	if args.use_async: run_async(args.ip, control_port=args.control)
+	else: run(args.ip, args.control)
 
 
 if __name__=="__main__":
-	ref=0
-	run()
+	main()
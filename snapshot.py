@@ -0,0 +1,114 @@
+# File: snapshot.py
+
+# Contains:
+#   Class
+#	SnapshotEngine class - takes the next decoded frame of a camera at full
+#	decoded resolution. An appsink bin is attached to the camera's decoded tee
+#	(see branches.py) just long enough to pull one frame, the frame is encoded
+#	to PNG/JPEG on a worker thread and completion is reported back on the GLib
+#	main loop, so nothing blocks the GTK main thread. A camera that delivers
+#	nothing within 'timeout' seconds gets its bin detached and the snapshot
+#	reported as failed.
+
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import Gst, GLib, GdkPixbuf
+import builder
+
+
+class SnapshotEngine:
+	def __init__(self, pipeline, fmt='png', workers=1, timeout=5):
+		# fmt - any format GdkPixbuf can save ('png', 'jpeg')
+		self.pipeline = pipeline
+		self.fmt = fmt
+		self.timeout = timeout
+		self.lock = threading.Lock()	# 'taken' is claimed by the sample or the timeout
+		self.pool = ThreadPoolExecutor(max_workers=workers)
+		self.count = 0
+
+
+	def take(self, branch, location, done=None):
+		# done(location, ok) is called on the main loop when the file is written
+		self.count += 1
+		name = 'snap' + str(self.count)
+		conv = builder.display_convert()
+		snap = Gst.parse_bin_from_description(builder.chain(
+			'queue leaky=downstream max-size-buffers=1',
+			conv if conv != 'videoconvert' else '',
+			'videoconvert', 'video/x-raw, format=RGB',
+			'appsink name=' + name + ' emit-signals=true max-buffers=1 drop=true sync=false async=false'),
+			True)
+		self.pipeline.add(snap)
+		snap.sync_state_with_parent()
+		job = {'bin': snap, 'branch': branch, 'location': location, 'done': done, 'taken': False}
+		snap.get_by_name(name).connect('new-sample', self.on_sample, job)
+		branch.attach(snap)
+		job['timer'] = GLib.timeout_add_seconds(self.timeout, self.on_timeout, job)
+
+
+	def on_sample(self, sink, job):
+		# streaming thread: copy one frame out and get off the decoder's tee
+		sample = sink.emit('pull-sample')
+		with self.lock:
+			if job['taken']:
+				return Gst.FlowReturn.OK
+			job['taken'] = True
+		struct = sample.get_caps().get_structure(0)
+		width = struct.get_value('width')
+		height = struct.get_value('height')
+		stride = (width * 3 + 3) // 4 * 4
+		buff = sample.get_buffer()
+		data = buff.extract_dup(0, buff.get_size())
+		# the branch is only changed from the main loop
+		GLib.idle_add(self.release, job)
+		self.pool.submit(self.encode, job, data, width, height, stride)
+		return Gst.FlowReturn.OK
+
+
+	def on_timeout(self, job):
+		with self.lock:
+			if job['taken']:
+				return False
+			job['taken'] = True
+		job['timer'] = None	# this source is finishing
+		print('ERROR: snapshot', job['location'], ': no frame from the camera')
+		self.release(job)
+		if job['done'] is not None:
+			job['done'](job['location'], False)
+		return False
+
+
+	def release(self, job):
+		# main loop, get off the decoder's tee
+		if job['timer'] is not None:
+			GLib.source_remove(job['timer'])
+			job['timer'] = None
+		job['branch'].detach(job['bin'], lambda: GLib.idle_add(self.remove, job['bin']))
+		return False
+
+
+	def remove(self, snap):
+		snap.set_state(Gst.State.NULL)
+		self.pipeline.remove(snap)
+		return False
+
+
+	def encode(self, job, data, width, height, stride):
+		ok = True
+		try:
+			pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(data),
+				GdkPixbuf.Colorspace.RGB, False, 8, width, height, stride)
+			pixbuf.savev(job['location'], self.fmt, [], [])
+		except GLib.Error as e:
+			print('ERROR: snapshot', job['location'], ':', e.message)
+			ok = False
+		if job['done'] is not None:
+			GLib.idle_add(job['done'], job['location'], ok)
+
+
+	def shutdown(self):
+		self.pool.shutdown(wait=True)
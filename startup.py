@@ -0,0 +1,92 @@
+# File: startup.py
+
+# Contains:
+#   Class
+#	StartupTimer class - time-to-first-frame breakdown of one pipeline. Stages
+#	are marked as the pipeline comes up (built, set_state returned, PLAYING,
+#	first buffer out of the source / encoder / into the sink ...) and once the
+#	last one is reached a STARTUP line is printed with the time of every stage
+#	since the pipeline was requested, and since boot. The times are also kept
+#	in metrics.py as startup_seconds{camera, stage}.
+#   Functions
+#	since_boot() - seconds since the machine booted (CLOCK_BOOTTIME)
+
+
+import time
+import threading
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+import metrics
+
+
+def since_boot():
+	try:
+		return time.clock_gettime(time.CLOCK_BOOTTIME)
+	except (AttributeError, OSError):
+		return None
+
+
+class StartupTimer:
+	def __init__(self, name, last, registry=metrics.REGISTRY):
+		# last - the stage that completes the startup (e.g. the first packet sent)
+		self.name = name
+		self.last = last
+		self.registry = registry
+		self.start = time.monotonic()
+		self.boot = since_boot()
+		self.stages = []	# (stage, seconds), in the order they happened
+		self.lock = threading.Lock()
+		self.done = False
+
+
+	def mark(self, stage):
+		# any thread, only the first time a stage is reached counts
+		with self.lock:
+			if self.done or any(s == stage for s, t in self.stages):
+				return
+			elapsed = time.monotonic() - self.start
+			self.stages.append((stage, elapsed))
+			self.registry.gauge('startup_seconds', 'Seconds from the pipeline being requested to each startup stage',
+				camera=self.name, stage=stage).value = round(elapsed, 4)
+			if stage != self.last:
+				return
+			self.done = True
+		self.report()
+
+
+	def watch_pad(self, pad, stage):
+		# marks the stage on the first buffer through the pad
+		def probe(pad, info):
+			self.mark(stage)
+			return Gst.PadProbeReturn.REMOVE
+		if pad is not None:
+			pad.add_probe(Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST, probe)
+
+
+	def watch_source(self, pipeline, stage='source'):
+		# the first buffer a source element of the pipeline produces
+		it = pipeline.iterate_sources()
+		while True:
+			ok, element = it.next()
+			if ok != Gst.IteratorResult.OK:
+				break
+			self.watch_pad(element.get_static_pad('src'), stage)
+
+
+	def on_message(self, message, pipeline):
+		# from the pipeline's bus handler, marks when the pipeline itself reaches PLAYING
+		if message.type == Gst.MessageType.STATE_CHANGED and message.src == pipeline:
+			if message.parse_state_changed()[1] == Gst.State.PLAYING:
+				self.mark('playing')
+
+
+	def report(self):
+		line = ' '.join('%s=%.0fms' % (stage, t * 1000) for stage, t in self.stages)
+		if self.boot is not None:
+			line += ' (boot+%.1fs)' % (self.boot + self.stages[-1][1])
+		print('STARTUP %s %s' % (self.name, line))
+
+
+	def breakdown(self):
+		return {stage: round(t, 4) for stage, t in self.stages}
@@ -0,0 +1,183 @@
+# File: streams.py
+
+# Contains:
+#   Class
+#	StreamManager class - the incoming streams of a receiver pipeline, created
+#	from a list of (camera, port) and added or removed while the pipeline is
+#	PLAYING. Each stream gets its udpsrc ! tee, a branches.StreamBranch, the loss
+#	reporter for the sender's rate control, its metrics and (optionally) a
+#	pre-roll ring. A stream nobody watches or records costs a locked udpsrc, or
+#	with a pre-roll ring its depay/parse, never a decoder.
+#	With enable_mux() every camera arrives on one port (one socket, one udpsrc
+#	thread) and is told apart by SSRC, a stream is added for each SSRC as it
+#	appears on the rtpssrcdemux.
+#	request_keyframe() asks a stream's sender for an IDR over the rate control
+#	feedback channel, used() keeps the last 'warm' cameras displayed decoding.
+
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GLib
+import builder
+import branches
+import ratecontrol
+import preroll
+import metrics
+
+
+class Stream:
+	def __init__(self, cam, port, branch, reporter, ring, ssrc=None):
+		self.cam = cam
+		self.port = port
+		self.ssrc = ssrc
+		self.branch = branch
+		self.reporter = reporter
+		self.ring = ring
+
+
+class StreamManager:
+	def __init__(self, pipeline, ip, preroll_seconds=10, monitor=True, latency=builder.LATENCY, fec=True,
+			warm=0):
+		# preroll_seconds=0 - no pre-roll rings, streams are only depayed while used
+		# latency - jitter buffer latency (ms), fec - recover packets from ULPFEC
+		# warm - number of recently displayed cameras kept decoding
+		self.pipeline = pipeline
+		self.warm = warm
+		self.recent = []
+		self.ip = ip
+		self.latency = latency
+		self.fec = fec
+		self.preroll_seconds = preroll_seconds
+		self.monitor = monitor
+		self.streams = {}
+		self.listeners = []
+		self.mux = None
+		self.ssrcs = {}		# cam -> ssrc on the single-port transport
+		self.names = []
+
+
+	def add_listener(self, fn):
+		# fn(event, cam) with event 'added' or 'removed', on the main loop
+		self.listeners.append(fn)
+
+
+	def cameras(self):
+		return list(self.streams)
+
+
+	def branch(self, cam):
+		return self.streams[cam].branch
+
+
+	def ring(self, cam):
+		return self.streams[cam].ring
+
+
+	def request_keyframe(self, cam):
+		stream = self.streams[cam]
+		if stream.reporter is not None:
+			return stream.reporter.request_keyframe()
+		if self.mux is not None:
+			return self.mux.request_keyframe(stream.ssrc)
+		return False
+
+
+	def used(self, cam):
+		# cam was just displayed
+		if not self.warm:
+			return
+		self.recent = [cam] + [c for c in self.recent if c != cam and c in self.streams]
+		for i, c in enumerate(self.recent):
+			if i < self.warm: self.streams[c].branch.warm()
+			else: self.streams[c].branch.cool()
+		del self.recent[self.warm:]
+
+
+	def fec_stats(self):
+		return {cam: stream.branch.fec_stats() for cam, stream in self.streams.items()}
+
+
+	def enable_mux(self, port, names=()):
+		# names - cameras to look for, SSRCs of others are used as the name
+		self.names = list(names)
+		self.mux_port = port
+		src, demux = self.pipeline.get_by_name('src_mux'), self.pipeline.get_by_name('demux')
+		if src is None:
+			src, demux = [Gst.parse_launch(d) for d in builder.recv_mux(self.ip, port)]
+			self.pipeline.add(src)
+			self.pipeline.add(demux)
+			src.link(demux)
+		demux.connect('new-ssrc-pad', self.on_ssrc_pad)
+		self.mux = ratecontrol.MuxLossReporter(src, port)
+		if self.monitor:
+			metrics.watch_pad(src.get_static_pad('src'), 'mux', 'udpsrc')
+		demux.sync_state_with_parent()
+		src.sync_state_with_parent()
+
+
+	def on_ssrc_pad(self, demux, ssrc, pad):
+		# streaming thread: give the pad somewhere to go before the first
+		# packet is pushed, the rest of the stream is set up on the main loop
+		cam = builder.ssrc_camera(ssrc, self.names)
+		tee = self.pipeline.get_by_name(cam)
+		if tee is None:
+			tee = Gst.parse_launch(builder.recv_tee(cam))
+			self.pipeline.add(tee)
+			tee.sync_state_with_parent()
+			if self.monitor:
+				metrics.watch_pad(tee.get_static_pad('sink'), cam, 'demux')
+		if pad.link(tee.get_static_pad('sink')) != Gst.PadLinkReturn.OK:
+			print('ERROR: ssrc', ssrc, 'could not be linked to', cam)
+		self.ssrcs[cam] = ssrc
+		print('Found ssrc %08x: %s' % (ssrc, cam))
+		GLib.idle_add(lambda: self.add(cam, self.mux_port, ssrc) and False)
+
+
+	def add(self, cam, port, ssrc=None):
+		if cam in self.streams:
+			print('ERROR: stream', cam, 'already exists')
+			return None
+		if ssrc is None:
+			ssrc = self.ssrcs.get(cam)
+		if ssrc is None and self.pipeline.get_by_name('src_' + cam) is None:
+			# not in the launch string, add the source to the running pipeline
+			src, tee = [Gst.parse_launch(d) for d in builder.recv_source(self.ip, cam, port)]
+			self.pipeline.add(src)
+			self.pipeline.add(tee)
+			src.link(tee)
+			tee.sync_state_with_parent()
+		# the branch keeps the udpsrc locked (socket closed) until it is used
+		branch = branches.StreamBranch(self.pipeline, cam, monitor=self.monitor,
+			latency=self.latency, fec=self.fec)
+		reporter = None
+		if ssrc is None:
+			reporter = ratecontrol.LossReporter(branch.src, port)
+			if self.monitor:
+				metrics.watch_pad(branch.src.get_static_pad('src'), cam, 'udpsrc')
+		ring = None
+		if self.preroll_seconds:
+			ring = preroll.PrerollRing(self.pipeline, branch, self.preroll_seconds)
+		self.streams[cam] = Stream(cam, port, branch, reporter, ring, ssrc)
+		print('Stream ' + cam + ' added on port ' + str(port))
+		for fn in self.listeners:
+			fn('added', cam)
+		return self.streams[cam]
+
+
+	def remove(self, cam):
+		stream = self.streams.pop(cam, None)
+		if stream is None:
+			return
+		# listeners forget the stream, its consumers are unlinked by branch.close()
+		for fn in self.listeners:
+			fn('removed', cam)
+		if stream.reporter is not None:
+			stream.reporter.close()
+		stream.branch.close()
+		if stream.ring is not None:
+			stream.ring.close()
+
+
+	def close(self):
+		for cam in list(self.streams):
+			self.remove(cam)
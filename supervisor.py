@@ -0,0 +1,197 @@
+# File: supervisor.py
+
+# Contains:
+#   Class
+#	Supervisor class - owns the Senders of the rover. A Sender that stops (an
+#	ERROR or EOS on its bus, e.g. a USB camera glitching) is started again
+#	after a backoff that doubles on every failure and resets once the stream
+#	has stayed up for a while. A camera that is unplugged is waited for and
+#	restarted as soon as its USB port has a /dev/videoN again, whatever number
+#	it gets (see builder.find_device). Per-camera uptime and restart counts
+#	are kept, printed on every change and exported to metrics.py. Every start
+#	(at startup, after a backoff, on hot-plug or a control subscribe) builds
+#	and plays the Sender on its own thread, so a slow device open holds up
+#	neither the other cameras nor the main loop.
+#	Supervised class - one camera under the supervisor
+
+
+import time
+import threading
+from gi.repository import GLib
+import builder
+import metrics
+
+
+class Supervised:
+	def __init__(self, name, start, cam=None):
+		self.name = name
+		self.start = start	# start() -> playing Sender
+		self.cam = cam		# builder.CAMERAS key of a USB camera, None for others
+		self.sender = None
+		self.state = 'stopped'	# starting, running, backoff, unplugged, stopped
+		self.device = None
+		self.started = None
+		self.uptime = 0.0	# seconds up before the current run
+		self.restarts = 0
+		self.failures = 0	# in a row, for the backoff
+		self.timer = None
+		self.attempt = 0	# of the start in progress, a start that was stopped and superseded is dropped
+
+
+	def up(self):
+		if self.state != 'running': return 0.0
+		return time.monotonic() - self.started
+
+
+class Supervisor:
+	def __init__(self, min_backoff=0.5, max_backoff=30.0, stable=30.0, poll=1.0):
+		# stable - seconds up after which the backoff starts again from min_backoff
+		# poll - seconds between checks for cameras being plugged in
+		self.min_backoff = min_backoff
+		self.max_backoff = max_backoff
+		self.stable = stable
+		self.entries = {}
+		# on_launch(entry) - called after every (re)start of a Sender
+		self.on_launch = None
+		GLib.timeout_add(int(poll * 1000), self.poll)
+
+
+	def add(self, name, start, cam=None):
+		entry = Supervised(name, start, cam)
+		self.entries[name] = entry
+		metrics.REGISTRY.gauge('sender_uptime_seconds', 'Seconds since the sender was last (re)started',
+			entry.up, camera=name)
+		metrics.REGISTRY.gauge('sender_up', 'Whether the sender is running',
+			lambda: int(entry.state == 'running'), camera=name)
+		return entry
+
+
+	def start_all(self):
+		# in parallel, the Senders are handed back to the main loop as they come up
+		for entry in self.entries.values():
+			self.launch(entry)
+
+
+	def launch(self, entry):
+		# main loop: timers, hot-plug and control all start a camera this way
+		entry.timer = None
+		if self.prepare(entry):
+			entry.attempt += 1
+			self.set_state(entry, 'starting')
+			threading.Thread(target=self.start_thread, args=(entry, entry.attempt), daemon=True).start()
+		return False
+
+
+	def start_thread(self, entry, attempt):
+		try:
+			sender = entry.start()
+		except Exception as e:
+			print('ERROR: starting', entry.name, ':', e)
+			GLib.idle_add(self.start_failed, entry, str(e), attempt)
+			return
+		GLib.idle_add(self.started, entry, sender, attempt)
+
+
+	def start_failed(self, entry, reason, attempt):
+		# back off and retry like a Sender that stopped
+		if entry.state != 'starting' or attempt != entry.attempt:
+			return False
+		entry.state = 'running'
+		entry.started = time.monotonic()
+		self.on_stopped(entry, None, reason)
+		return False
+
+
+	def prepare(self, entry):
+		# False if the camera is unplugged
+		if entry.cam is not None:
+			entry.device = builder.find_device(entry.cam)
+			if entry.device is None:
+				self.set_state(entry, 'unplugged')
+				return False
+		if entry.started is not None:
+			entry.restarts += 1
+			metrics.REGISTRY.counter('sender_restarts_total', 'Times the sender was restarted',
+				camera=entry.name).value += 1
+		return True
+
+
+	def started(self, entry, sender, attempt):
+		if entry.state != 'starting' or attempt != entry.attempt:
+			# stopped while it was starting
+			sender._shutdown()
+			return False
+		sender.on_stopped = lambda sender, reason: self.on_stopped(entry, sender, reason)
+		entry.sender = sender
+		entry.started = time.monotonic()
+		self.set_state(entry, 'running')
+		if self.on_launch is not None:
+			self.on_launch(entry)
+		if not sender.running:
+			# an error shut it down before it was handed over
+			self.on_stopped(entry, sender, 'failed to start')
+		return False
+
+
+	def on_stopped(self, entry, sender, reason):
+		if sender is not entry.sender or entry.state != 'running':
+			return
+		up = entry.up()
+		entry.uptime += up
+		entry.sender = None
+		entry.failures = 0 if up >= self.stable else entry.failures + 1
+		delay = min(self.max_backoff, self.min_backoff * 2 ** entry.failures)
+		print('SUPERVISOR %s stopped (%s) after %.1fs, restart %d in %.1fs' % (
+			entry.name, reason, up, entry.restarts + 1, delay))
+		self.set_state(entry, 'backoff')
+		entry.timer = GLib.timeout_add(int(delay * 1000), self.launch, entry)
+
+
+	def poll(self):
+		# unplugged cameras start as soon as their USB port is back, running
+		# ones are restarted right away when they come back under a new number
+		devices = builder.video_devices()
+		for entry in self.entries.values():
+			if entry.cam is None: continue
+			device = builder.find_device(entry.cam, devices)
+			if entry.state == 'unplugged' and device is not None:
+				print('SUPERVISOR %s plugged in as %s' % (entry.name, device))
+				self.launch(entry)
+			elif entry.state == 'backoff' and device is not None and device != entry.device:
+				print('SUPERVISOR %s back as %s' % (entry.name, device))
+				GLib.source_remove(entry.timer)
+				self.launch(entry)
+			elif entry.state == 'running' and device is None:
+				# gone without an error from the pipeline
+				self.halt(entry)
+				self.set_state(entry, 'unplugged')
+		return True
+
+
+	def halt(self, entry):
+		if entry.timer is not None:
+			GLib.source_remove(entry.timer)
+			entry.timer = None
+		if entry.sender is not None:
+			entry.uptime += entry.up()
+			sender = entry.sender
+			entry.sender = None
+			sender._shutdown()
+
+
+	def set_state(self, entry, state):
+		entry.state = state
+		print('SUPERVISOR %s %s%s' % (entry.name, state,
+			' on ' + entry.device if entry.device and state == 'running' else ''))
+
+
+	def stop(self, name):
+		entry = self.entries[name]
+		self.halt(entry)
+		self.set_state(entry, 'stopped')
+
+
+	def status(self):
+		return {name: {'state': e.state, 'device': e.device, 'restarts': e.restarts,
+			'uptime': round(e.up(), 1), 'total_uptime': round(e.uptime + e.up(), 1)}
+			for name, e in self.entries.items()}